@@ -0,0 +1,461 @@
+"""
+Batch analytics engine.
+
+Groups (recipientId, messageId) pairs by peer and fetches each group with
+multi-id `get_messages(peer, ids=[...])` calls instead of one round trip per
+message. Peer groups run concurrently under a configurable bound.
+
+`fields` narrows what is fetched. Views, forwards and replies alone
+("counters") come from messages.GetMessagesViews(increment=False), which
+returns just the counters for up to 100 ids instead of whole messages with
+text, media and entities. Reactions then cost one GetMessagesReactions call
+per chunk, and only when asked for; poll voters still need the messages.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from telethon import TelegramClient, functions, types
+
+import log_config
+from entity_resolver import invalidate_on
+from metrics_cache import MetricsCache, annotate, cache_key
+
+logger = logging.getLogger(__name__)
+item_log = log_config.item_logger(__name__)
+
+# Telegram's messages.GetMessages / channels.GetMessages accept at most 100 ids
+MAX_IDS_PER_REQUEST = 100
+
+# How many peer chunks may be in flight at once for a single batch request
+BATCH_CONCURRENCY = int(os.getenv("ANALYTICS_BATCH_CONCURRENCY", 8))
+
+# resolve(chat_id, access_hash) -> InputPeer (entity_resolver.BoundResolver
+# in the app, told about peers Telegram rejects)
+Resolver = Callable[[str, str], Awaitable[object]]
+
+# Megagroups seen answering GetMessagesViews without counters; their
+# counters-only requests go straight to get_messages
+NO_COUNTERS_MAX = 10_000
+_no_counters: "OrderedDict[str, None]" = OrderedDict()
+
+METRIC_FIELDS = ("views", "forwards", "replies", "reactions", "voters")
+COUNTER_FIELDS = ("views", "forwards", "replies")
+# Named sets accepted by ?fields=, next to single field names
+FIELD_SETS = {"full": METRIC_FIELDS, "counters": COUNTER_FIELDS}
+
+
+def parse_fields(value: str = None) -> Tuple[str, ...]:
+    """
+    ?fields= value ("full", "counters", or a comma list such as
+    "counters,reactions") as metric names in METRIC_FIELDS order.
+    """
+    if not value:
+        return METRIC_FIELDS
+    fields = set()
+    for part in value.split(","):
+        part = part.strip()
+        if part in FIELD_SETS:
+            fields.update(FIELD_SETS[part])
+        elif part in METRIC_FIELDS:
+            fields.add(part)
+        else:
+            raise ValueError(f"Unknown field '{part}', expected {', '.join([*FIELD_SETS, *METRIC_FIELDS])}")
+    return tuple(field for field in METRIC_FIELDS if field in fields)
+
+
+def project(metrics: dict, fields: Tuple[str, ...]) -> dict:
+    if fields == METRIC_FIELDS:
+        return metrics
+    return {field: metrics[field] for field in fields}
+
+
+def resolve_peer(chat_id):
+    """
+    Numeric ids are passed to Telethon as ints, usernames as strings.
+    """
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id
+
+
+def extract_metrics(message) -> dict:
+    """
+    Pull views/forwards/replies/reactions/voters off a Telethon Message.
+    """
+    views = getattr(message, 'views', 0) or 0
+    forwards = getattr(message, 'forwards', 0) or 0
+
+    # Replies
+    replies = 0
+    if message.replies:
+        replies = message.replies.replies or 0
+
+    # Reactions
+    reactions = 0
+    if message.reactions and message.reactions.results:
+        reactions = sum(r.count for r in message.reactions.results)
+
+    # Voters (Polls)
+    voters = 0
+    if message.poll:  # Telethon message.poll property
+        if message.poll.results:
+            voters = message.poll.results.total_voters or 0
+    # Fallback check for media.poll
+    elif message.media and hasattr(message.media, "poll") and message.media.poll.results:
+        voters = message.media.poll.results.total_voters or 0
+
+    return {
+        "views": views,
+        "forwards": forwards,
+        "replies": replies,
+        "reactions": reactions,
+        "voters": voters
+    }
+
+
+def counters_of(views: types.MessageViews) -> dict:
+    """Views/forwards/replies from a messages.GetMessagesViews entry."""
+    return {
+        "views": views.views or 0,
+        "forwards": views.forwards or 0,
+        "replies": (views.replies.replies or 0) if views.replies else 0,
+    }
+
+
+def reactions_of(updates) -> Dict[int, int]:
+    """{msg_id: total reactions} from a messages.GetMessagesReactions result."""
+    totals = {}
+    for update in getattr(updates, "updates", []):
+        if isinstance(update, types.UpdateMessageReactions):
+            results = update.reactions.results if update.reactions else []
+            totals[update.msg_id] = sum(r.count for r in results or [])
+    return totals
+
+
+def group_by_peer(items: list) -> Dict[str, List[int]]:
+    """
+    Turn [{"recipientId": ..., "messageId": ...}, ...] into
+    {recipientId: [messageId, ...]}, dropping malformed and duplicate entries.
+    Insertion order is preserved so peers are fetched in payload order.
+    """
+    groups: Dict[str, List[int]] = {}
+    seen = set()
+
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        chat_id = item.get("recipientId")
+        msg_id = item.get("messageId")
+        if not chat_id or not msg_id:
+            continue
+        try:
+            msg_id = int(msg_id)
+        except (TypeError, ValueError):
+            continue
+
+        key = (str(chat_id), msg_id)
+        if key in seen:
+            continue
+        seen.add(key)
+        groups.setdefault(str(chat_id), []).append(msg_id)
+
+    return groups
+
+
+def access_hashes(items: list) -> Dict[str, str]:
+    """
+    {recipientId: accessHash} for payload entries that carry one, so peers
+    can be resolved without an RPC.
+    """
+    hashes = {}
+    for item in items:
+        if isinstance(item, dict) and item.get("recipientId") and item.get("accessHash"):
+            hashes[str(item["recipientId"])] = str(item["accessHash"])
+    return hashes
+
+
+def chunked(ids: List[int], size: int = MAX_IDS_PER_REQUEST) -> List[List[int]]:
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def item_result(chat_id: str, msg_id: int, metrics: dict = None, error: str = None) -> dict:
+    """
+    One resolved batch entry. Exactly one of metrics/error is set.
+    """
+    entry = {"recipientId": chat_id, "messageId": msg_id}
+    if error is not None:
+        entry["error"] = error
+    else:
+        entry["metrics"] = metrics
+    return entry
+
+
+def composite_key(chat_id, msg_id) -> str:
+    """
+    Result key that stays unique across chats, unlike the bare message id.
+    """
+    return f"{chat_id}:{msg_id}"
+
+
+class _BatchRun:
+    """
+    State shared by the fetch tasks of one iter_batch() call. Every id handed
+    to it produces exactly one entry on `out`, or iter_batch() never finishes.
+    """
+
+    def __init__(self, client: TelegramClient, concurrency: int,
+                 cache: MetricsCache = None, account: str = None,
+                 resolve: Resolver = None, hashes: Dict[str, str] = None,
+                 fields: Tuple[str, ...] = METRIC_FIELDS):
+        self.client = client
+        self.fields = fields
+        # Counters (and reactions) without downloading the messages
+        self.light = "voters" not in fields
+        self.resolve = resolve or (lambda chat_id, access_hash: client.get_input_entity(resolve_peer(chat_id)))
+        self.hashes = hashes or {}
+        self.semaphore = asyncio.Semaphore(max(1, concurrency or BATCH_CONCURRENCY))
+        self.out: asyncio.Queue = asyncio.Queue()
+        # Read-through only when we know whose cache entries these are
+        self.cache = cache if account is not None else None
+        self.account = account
+        self.owned = set()
+        # (chat_id, msg_id) already on `out`
+        self.emitted = set()
+
+    def emit(self, chat_id: str, msg_id: int, metrics: dict = None, error: str = None,
+             cached: bool = False, age: float = 0.0):
+        if self.cache is not None and metrics is not None:
+            metrics = annotate(metrics, cached, age)
+        self.emitted.add((chat_id, msg_id))
+        self.out.put_nowait(item_result(chat_id, msg_id, metrics=metrics, error=error))
+
+    def succeed(self, chat_id: str, msg_id: int, metrics: dict):
+        metrics = project(metrics, self.fields)
+        if self.cache is not None:
+            key = cache_key(self.account, chat_id, msg_id)
+            if key in self.owned:
+                self.cache.resolve(key, metrics)
+                self.owned.discard(key)
+            else:
+                # Partial fetches aren't claimed (nobody waits on them)
+                self.cache.put(key, metrics)
+        self.emit(chat_id, msg_id, metrics=metrics)
+
+    def failed(self, chat_id: str, msg_id: int, error: Exception):
+        if self.cache is not None:
+            key = cache_key(self.account, chat_id, msg_id)
+            if key in self.owned:
+                self.cache.fail(key, error)
+                self.owned.discard(key)
+        self.emit(chat_id, msg_id, error=str(error))
+
+    def abandon(self):
+        """Release in-flight claims nobody will complete (e.g. stream closed)."""
+        for key in self.owned:
+            self.cache.fail(key, RuntimeError("Fetch cancelled"))
+        self.owned.clear()
+
+    async def wait_inflight(self, chat_id: str, msg_id: int, future: asyncio.Future):
+        # Another request is already fetching this message; share its result
+        try:
+            metrics = await asyncio.shield(future)
+        except Exception as e:
+            self.emit(chat_id, msg_id, error=str(e))
+        else:
+            self.emit(chat_id, msg_id, metrics=metrics, cached=True)
+
+    async def fetch_counters(self, entity, chat_id: str, ids: List[int]):
+        async with self.semaphore:
+            try:
+                result = await self.client(functions.messages.GetMessagesViewsRequest(
+                    peer=entity, id=ids, increment=False
+                ))
+                reactions = {}
+                if "reactions" in self.fields:
+                    reactions = reactions_of(await self.client(
+                        functions.messages.GetMessagesReactionsRequest(peer=entity, id=ids)
+                    ))
+            except Exception as e:
+                logger.warning("Failed to fetch counters of %d msgs in %s: %s", len(ids), chat_id, e)
+                invalidate_on(self.resolve, chat_id, e)
+                for msg_id in ids:
+                    self.failed(chat_id, msg_id, e)
+                return
+
+        channel = next((chat for chat in result.chats
+                        if isinstance(chat, types.Channel) and chat.id == entity.channel_id), None)
+        if channel is not None and channel.megagroup:
+            _no_counters[chat_id] = None
+            if len(_no_counters) > NO_COUNTERS_MAX:
+                _no_counters.popitem(last=False)
+
+        # Entries line up with ids. Every broadcast post has a view count, so
+        # there an empty entry is a deleted message; elsewhere only the
+        # message itself tells a deleted one from one without counters.
+        broadcast = channel is not None and channel.broadcast
+        unknown = []
+        for index, msg_id in enumerate(ids):
+            views = result.views[index] if index < len(result.views) else None
+            if views is None or (views.views is None and views.forwards is None and views.replies is None):
+                if broadcast:
+                    item_log.debug("Message %s in %s not found", msg_id, chat_id)
+                    self.failed(chat_id, msg_id, LookupError("Message not found"))
+                else:
+                    unknown.append(msg_id)
+                continue
+            self.succeed(chat_id, msg_id, {**counters_of(views), "reactions": reactions.get(msg_id, 0)})
+        if unknown:
+            await self.fetch_messages(entity, chat_id, unknown)
+
+    async def fetch_chunk(self, entity, chat_id: str, ids: List[int]):
+        # Only channel posts have counters; users, chats and megagroups need the messages
+        if self.light and isinstance(entity, types.InputPeerChannel) and chat_id not in _no_counters:
+            await self.fetch_counters(entity, chat_id, ids)
+        else:
+            await self.fetch_messages(entity, chat_id, ids)
+
+    async def fetch_messages(self, entity, chat_id: str, ids: List[int]):
+        async with self.semaphore:
+            try:
+                messages = await self.client.get_messages(entity, ids=ids)
+            except Exception as e:
+                logger.warning("Failed to analyze %d msgs in %s: %s", len(ids), chat_id, e)
+                invalidate_on(self.resolve, chat_id, e)
+                for msg_id in ids:
+                    self.failed(chat_id, msg_id, e)
+                return
+
+        # get_messages(ids=[...]) returns a list aligned with ids, None for gaps
+        for index, msg_id in enumerate(ids):
+            message = messages[index] if index < len(messages) else None
+            if not message:
+                item_log.debug("Message %s in %s not found", msg_id, chat_id)
+                self.failed(chat_id, msg_id, LookupError("Message not found"))
+                continue
+            try:
+                metrics = extract_metrics(message)
+            except Exception as e:
+                self.failed(chat_id, msg_id, e)
+            else:
+                self.succeed(chat_id, msg_id, metrics)
+
+    async def fetch_peer(self, chat_id: str, ids: List[int]):
+        try:
+            await self._fetch_peer(chat_id, ids)
+        except Exception as e:
+            # A bug past the per-request handlers (parsing a reply, a cache
+            # or time-series hook) must still answer every id, or
+            # iter_batch() waits forever
+            logger.exception("Unexpected error fetching %s", chat_id)
+            for msg_id in ids:
+                if (chat_id, msg_id) not in self.emitted:
+                    self.failed(chat_id, msg_id, e)
+
+    async def _fetch_peer(self, chat_id: str, ids: List[int]):
+        # Resolve once per peer instead of once per chunk
+        try:
+            entity = await self.resolve(chat_id, self.hashes.get(chat_id))
+        except Exception as e:
+            logger.warning("Failed to resolve %s: %s", chat_id, e)
+            error = LookupError(f"Could not resolve peer: {e}")
+            for msg_id in ids:
+                self.failed(chat_id, msg_id, error)
+            return
+
+        await asyncio.gather(*(
+            self.fetch_chunk(entity, chat_id, chunk) for chunk in chunked(ids)
+        ))
+
+
+async def iter_batch(client: TelegramClient, items: list, concurrency: int = None,
+                     cache: MetricsCache = None, account: str = None, fresh: bool = False,
+                     resolve: Resolver = None, fields: Tuple[str, ...] = METRIC_FIELDS):
+    """
+    Async generator yielding one item_result() per valid payload entry as soon
+    as it resolves. Peer groups are fetched concurrently in the background;
+    closing the generator early cancels whatever is still in flight.
+
+    With a cache and account, fresh cached values are yielded first, messages
+    another request is already fetching are awaited rather than re-fetched,
+    and only the rest go to Telegram. fresh=True skips cached values.
+    Metrics then carry "cached" and "age" (seconds).
+
+    `resolve(chat_id, access_hash)` turns a recipient into an input peer;
+    it defaults to client.get_input_entity. Payload entries may carry an
+    "accessHash" that is passed along.
+
+    `fields` (see parse_fields) limits the metrics fetched and returned.
+    Cached values with at least those fields are used; narrower fetches are
+    cached but don't take part in request coalescing.
+    """
+    groups = group_by_peer(items)
+    run = _BatchRun(client, concurrency, cache, account, resolve, access_hashes(items), fields)
+    partial = fields != METRIC_FIELDS
+    remaining = sum(len(ids) for ids in groups.values())
+    tasks = []
+
+    to_fetch = groups
+    if run.cache is not None:
+        to_fetch = {}
+        for chat_id, ids in groups.items():
+            for msg_id in ids:
+                key = cache_key(account, chat_id, msg_id)
+                hit = None if fresh else run.cache.lookup(key, fields)
+                if hit:
+                    run.emit(chat_id, msg_id, metrics=project(hit[0], fields), cached=True, age=hit[1])
+                    continue
+                if partial:
+                    to_fetch.setdefault(chat_id, []).append(msg_id)
+                    continue
+                future = run.cache.inflight(key)
+                if future is not None:
+                    tasks.append(asyncio.create_task(run.wait_inflight(chat_id, msg_id, future)))
+                    continue
+                run.cache.claim(key)
+                run.owned.add(key)
+                to_fetch.setdefault(chat_id, []).append(msg_id)
+
+    tasks += [
+        asyncio.create_task(run.fetch_peer(chat_id, ids))
+        for chat_id, ids in to_fetch.items()
+    ]
+    try:
+        while remaining:
+            yield await run.out.get()
+            remaining -= 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if run.cache is not None:
+            run.abandon()
+
+
+async def fetch_batch(client: TelegramClient, items: list, concurrency: int = None,
+                      composite: bool = False, cache: MetricsCache = None,
+                      account: str = None, fresh: bool = False,
+                      resolve: Resolver = None, fields: Tuple[str, ...] = METRIC_FIELDS) -> Dict[str, dict]:
+    """
+    Fetch metrics for a batch payload.
+    Returns {str(messageId): {"views", "forwards", "replies", "reactions", "voters"}},
+    the same shape the serial implementation produced. With composite=True keys
+    are "recipientId:messageId" so equal ids in different chats don't collide.
+    Entries that failed are left out, as before.
+    """
+    results: Dict[str, dict] = {}
+    failed = 0
+
+    async for entry in iter_batch(client, items, concurrency, cache=cache, account=account,
+                                  fresh=fresh, resolve=resolve, fields=fields):
+        if "error" in entry:
+            failed += 1
+            continue
+        key = composite_key(entry["recipientId"], entry["messageId"]) if composite else str(entry["messageId"])
+        results[key] = entry["metrics"]
+
+    logger.info("Analyzed %d messages (%d failed)", len(results), failed)
+    return results
@@ -0,0 +1,115 @@
+"""
+Authorization and identity of each account, kept in memory.
+
+GET / (polled by authRoutes.js from every open dashboard tab) used to call
+is_user_authorized() and get_me() on every hit, and every other endpoint
+started with is_user_authorized(). Both are now answered from this cache:
+- filled by the first check of a client and by sign-in,
+- marked unauthorized when Telegram rejects the session
+  (AUTH_KEY_UNREGISTERED, SESSION_REVOKED, ...; reported by the scheduler),
+- patched by UpdateUserName, and refetched after UpdateUser, for the
+  account itself,
+- dropped on logout and when the pool closes the client.
+Only ?verify=true (GET /, /auth/me) asks Telegram again.
+"""
+import logging
+import time
+from typing import Dict, Optional
+
+from telethon import TelegramClient, types
+
+logger = logging.getLogger(__name__)
+
+
+def identity_of(user: types.User) -> dict:
+    return {
+        "id": user.id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+    }
+
+
+class AuthState:
+    def __init__(self):
+        # user_id -> {"authorized", "user" (identity_of or None), "checked_at"}
+        self._entries: Dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self.revoked = 0
+
+    async def authorized(self, client: TelegramClient, user_id: str, verify: bool = False) -> bool:
+        """Whether the account is logged in; a memory read unless `verify`."""
+        entry = self._entries.get(user_id)
+        if verify:
+            return await self.identity(client, user_id, verify=True) is not None
+        if entry is not None:
+            self.hits += 1
+            return entry["authorized"]
+
+        self.misses += 1
+        authorized = await client.is_user_authorized()
+        # Sign-in or a rejected session may have landed meanwhile
+        entry = self._entries.setdefault(user_id, {"authorized": authorized, "user": None})
+        entry["checked_at"] = time.time()
+        return entry["authorized"]
+
+    async def identity(self, client: TelegramClient, user_id: str, verify: bool = False) -> Optional[dict]:
+        """
+        The account's own user (identity_of), or None when not authorized.
+        Fetched once with get_me(); `verify` always asks Telegram.
+        """
+        if not verify:
+            if not await self.authorized(client, user_id):
+                return None
+            user = self._entries[user_id]["user"]
+            if user is not None:
+                return user
+
+        self.misses += 1
+        # get_me() answers None for a rejected session (UnauthorizedError is
+        # reported through the scheduler as well)
+        me = await client.get_me()
+        if me is None:
+            self.unauthorized(user_id)
+            return None
+        return self.signed_in(user_id, me)
+
+    def signed_in(self, user_id: str, user: types.User) -> dict:
+        identity = identity_of(user)
+        self._entries[user_id] = {"authorized": True, "user": identity, "checked_at": time.time()}
+        return identity
+
+    def unauthorized(self, user_id: str, error: Exception = None):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry["authorized"]:
+            self.revoked += 1
+            logger.warning("Session no longer authorized: %s", error or "get_me() failed",
+                           extra={"account": user_id})
+        self._entries[user_id] = {"authorized": False, "user": None, "checked_at": time.time()}
+
+    def on_update(self, user_id: str, update):
+        """UpdateUserName / UpdateUser pushed to the account's client."""
+        entry = self._entries.get(user_id)
+        user = entry["user"] if entry else None
+        if user is None or update.user_id != user["id"]:
+            return
+        if isinstance(update, types.UpdateUserName):
+            active = [u.username for u in update.usernames if u.active]
+            user.update(first_name=update.first_name, last_name=update.last_name,
+                        username=active[0] if active else None)
+        else:
+            # Something else about us changed; get_me() again when asked
+            entry["user"] = None
+
+    def forget(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "accounts": len(self._entries),
+            "authorized": sum(1 for e in self._entries.values() if e["authorized"]),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revoked": self.revoked,
+        }
@@ -0,0 +1,376 @@
+"""
+In-process stand-in for Telegram's servers, for benchmarks.
+
+FakeTelegramClient is a real ScheduledTelegramClient whose MTProto sender is
+replaced by FakeSender: every RPC still goes through the account scheduler
+and Telethon's own request/response handling (entity caching, iter_dialogs
+paging, get_messages id matching...), but is answered by a FakeBackend
+built from deterministic fixtures instead of the network.
+
+The backend has configurable latency, injects FloodWaits at a given rate and
+counts every RPC by request type so callers can report RPCs per request.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from telethon import errors, functions, types, utils
+from telethon.sessions import StringSession
+
+import scheduler
+
+KINDS = ("user", "group", "channel", "megagroup")
+
+SELF_ID = 777000001
+# Dialog i was last active BASE_DATE - i * DIALOG_STEP seconds ago, so
+# GetDialogs offsets map straight back to an index
+BASE_DATE = 1_760_000_000
+DIALOG_STEP = 60
+# Users and basic groups share one message id space per account; message ids
+# of dialog i start at (i + 1) * MSG_SPAN
+MSG_SPAN = 100_000
+# Channel message ids run 1..CHANNEL_TOP
+CHANNEL_TOP = 50_000
+
+USER_BASE = 1_000_000
+CHAT_BASE = 2_000_000
+CHANNEL_BASE = 1_500_000_000
+
+ASYNC_GRAPHS = ("interactions_graph", "views_by_source_graph")
+
+
+def _date(ts: float) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+def access_hash_for(raw_id: int) -> int:
+    return (raw_id * 2654435761) % (1 << 62)
+
+
+class FakeBackend:
+    def __init__(self, dialogs: int = 10_000, latency: float = 0.05, jitter: float = 0.5,
+                 flood_rate: float = 0.0, flood_seconds: int = 2, missing_every: int = 50,
+                 graph_points: int = 365, seed: int = 1):
+        self.dialogs = dialogs
+        # Each RPC takes latency * (1 +- jitter) seconds
+        self.latency = latency
+        self.jitter = jitter
+        # Fraction of RPCs answered with FLOOD_WAIT_<flood_seconds>
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        # Every Nth message id is gone (deleted), to exercise "not found" paths
+        self.missing_every = missing_every
+        self.graph_points = graph_points
+        self.random = random.Random(seed)
+        self.started = time.time()
+
+        self.calls: Counter = Counter()
+        self.flood_waits = 0
+
+    # --- Fixtures ---
+
+    def kind(self, index: int) -> str:
+        return KINDS[index % len(KINDS)]
+
+    def raw_id(self, index: int) -> int:
+        kind = self.kind(index)
+        if kind == "user":
+            return USER_BASE + index
+        if kind == "group":
+            return CHAT_BASE + index
+        return CHANNEL_BASE + index
+
+    def index_of(self, raw_id: int) -> int:
+        for base in (CHANNEL_BASE, CHAT_BASE, USER_BASE):
+            if raw_id >= base:
+                return raw_id - base
+        raise ValueError(raw_id)
+
+    def peer(self, index: int):
+        kind = self.kind(index)
+        if kind == "user":
+            return types.PeerUser(self.raw_id(index))
+        if kind == "group":
+            return types.PeerChat(self.raw_id(index))
+        return types.PeerChannel(self.raw_id(index))
+
+    def marked_id(self, index: int) -> int:
+        return utils.get_peer_id(self.peer(index))
+
+    def entity(self, index: int):
+        kind, raw_id = self.kind(index), self.raw_id(index)
+        date = _date(BASE_DATE - 86400 * 30)
+        if kind == "user":
+            return types.User(id=raw_id, access_hash=access_hash_for(raw_id),
+                              first_name=f"User {index}", username=f"user{index}")
+        if kind == "group":
+            return types.Chat(id=raw_id, title=f"Group {index}", photo=types.ChatPhotoEmpty(),
+                              participants_count=20, date=date, version=1)
+        return types.Channel(id=raw_id, title=f"{kind.title()} {index}", photo=types.ChatPhotoEmpty(),
+                             date=date, broadcast=kind == "channel", megagroup=kind == "megagroup",
+                             creator=index % 8 < 4, access_hash=access_hash_for(raw_id),
+                             participants_count=1000 + index)
+
+    def top_message(self, index: int) -> int:
+        if self.kind(index) in ("user", "group"):
+            return (index + 1) * MSG_SPAN + 1000
+        return CHANNEL_TOP
+
+    def channels(self, kind: str = "channel"):
+        """Indexes of every broadcast channel (or megagroup) in the fixture."""
+        return [i for i in range(self.dialogs) if self.kind(i) == kind]
+
+    def target(self, index: int, message_id: int) -> dict:
+        """A {recipientId, messageId, accessHash} payload item, as Node sends them."""
+        raw_id = self.raw_id(index)
+        item = {"recipientId": str(self.marked_id(index)), "messageId": message_id}
+        if self.kind(index) != "group":
+            item["accessHash"] = str(access_hash_for(raw_id))
+        return item
+
+    def message(self, peer, message_id: int):
+        if self.missing_every and message_id % self.missing_every == 0:
+            return types.MessageEmpty(id=message_id, peer_id=peer)
+        raw_id = utils.get_peer_id(peer, add_mark=False)
+        # Counters keep growing while the benchmark runs
+        views = (raw_id * 31 + message_id * 17) % 5000 + int((time.time() - self.started) * 2)
+        return types.Message(
+            id=message_id, peer_id=peer, date=_date(BASE_DATE - message_id % 86400),
+            message="", post=isinstance(peer, types.PeerChannel),
+            views=views, forwards=views // 50,
+            replies=types.MessageReplies(replies=views // 100, replies_pts=1),
+            reactions=types.MessageReactions(results=[
+                types.ReactionCount(reaction=types.ReactionEmoji(emoticon="\U0001F44D"), count=views // 20),
+            ]),
+        )
+
+    def graph(self, name: str, series: int = 2):
+        day = 86400
+        end = (BASE_DATE // day) * day
+        xs = [(end - (self.graph_points - i) * day) * 1000 for i in range(self.graph_points)]
+        columns = [["x", *xs]]
+        for s in range(series):
+            columns.append([f"y{s}", *((i * (s + 3) * 7919) % 1000 + 1000 * (s + 1)
+                                      for i in range(self.graph_points))])
+        data = {
+            "columns": columns,
+            "types": {"x": "x", **{f"y{s}": "line" for s in range(series)}},
+            "names": {f"y{s}": f"{name} {s}" for s in range(series)},
+            "colors": {f"y{s}": "#3497ED" for s in range(series)},
+        }
+        return types.StatsGraph(json=types.DataJSON(data=json.dumps(data)))
+
+    def graphs(self, names):
+        return {
+            name: (types.StatsGraphAsync(token=f"{name}:{self.graph_points}") if name in ASYNC_GRAPHS
+                   else self.graph(name))
+            for name in names
+        }
+
+    # --- RPCs ---
+
+    async def handle(self, request):
+        name = type(request).__name__
+        # channels.GetMessagesRequest and messages.GetMessagesRequest share a name
+        self.calls[f"{type(request).__module__.rsplit('.', 1)[-1]}.{name}"] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.jitter * (2 * self.random.random() - 1)))
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request=request, capture=self.flood_seconds)
+
+        handler = getattr(self, "_" + name, None)
+        if handler is None:
+            raise NotImplementedError(f"FakeBackend does not answer {name}")
+        return handler(request)
+
+    def _GetStateRequest(self, request):
+        return types.updates.State(pts=1, qts=0, date=_date(time.time()), seq=1, unread_count=0)
+
+    def _GetUsersRequest(self, request):
+        return [types.User(id=SELF_ID, is_self=True, access_hash=access_hash_for(SELF_ID),
+                           first_name="Bench", username="bench")]
+
+    def _GetDialogsRequest(self, request):
+        start = 0
+        if request.offset_date:
+            start = (BASE_DATE - int(request.offset_date.timestamp())) // DIALOG_STEP + 1
+        indexes = range(start, min(start + request.limit, self.dialogs))
+
+        dialogs, messages, chats, users = [], [], [], []
+        for index in indexes:
+            peer = self.peer(index)
+            top = self.top_message(index)
+            dialogs.append(types.Dialog(
+                peer=peer, top_message=top, read_inbox_max_id=top, read_outbox_max_id=top,
+                unread_count=0, unread_mentions_count=0, unread_reactions_count=0,
+                unread_poll_votes_count=0, notify_settings=types.PeerNotifySettings(),
+                folder_id=1 if index % 20 == 19 else None,
+            ))
+            messages.append(types.Message(id=top, peer_id=peer, message="",
+                                          date=_date(BASE_DATE - index * DIALOG_STEP)))
+            (users if self.kind(index) == "user" else chats).append(self.entity(index))
+        return types.messages.DialogsSlice(count=self.dialogs, dialogs=dialogs, messages=messages,
+                                           chats=chats, users=users)
+
+    def _channel_index(self, channel) -> int:
+        index = self.index_of(channel.channel_id)
+        if not 0 <= index < self.dialogs or self.kind(index) not in ("channel", "megagroup"):
+            raise errors.ChannelInvalidError(request=None)
+        return index
+
+    def _GetMessagesRequest(self, request):
+        if isinstance(request, functions.channels.GetMessagesRequest):
+            index = self._channel_index(request.channel)
+            peer = self.peer(index)
+            found = [self.message(peer, i.id) for i in request.id]
+            return types.messages.ChannelMessages(pts=1, count=len(found), messages=found, topics=[],
+                                                  chats=[self.entity(index)], users=[])
+
+        found, indexes = [], set()
+        for input_id in request.id:
+            index = input_id.id // MSG_SPAN - 1
+            if not 0 <= index < self.dialogs or self.kind(index) not in ("user", "group"):
+                found.append(types.MessageEmpty(id=input_id.id))
+                continue
+            indexes.add(index)
+            found.append(self.message(self.peer(index), input_id.id))
+        entities = [self.entity(i) for i in indexes]
+        return types.messages.Messages(
+            messages=found, topics=[],
+            chats=[e for e in entities if not isinstance(e, types.User)],
+            users=[e for e in entities if isinstance(e, types.User)],
+        )
+
+    def _peer_index(self, peer) -> int:
+        if isinstance(peer, types.InputPeerChannel):
+            return self._channel_index(peer)
+        return self.index_of(utils.get_peer_id(peer, add_mark=False))
+
+    def _GetMessagesViewsRequest(self, request):
+        # Only broadcast posts have counters; other entries come back empty
+        index = self._peer_index(request.peer)
+        peer = self.peer(index)
+        views = []
+        for message_id in request.id:
+            message = self.message(peer, message_id) if self.kind(index) == "channel" else None
+            if not isinstance(message, types.Message):
+                views.append(types.MessageViews())
+                continue
+            views.append(types.MessageViews(views=message.views, forwards=message.forwards,
+                                            replies=message.replies))
+        return types.messages.MessageViews(views=views, chats=[self.entity(index)], users=[])
+
+    def _GetMessagesReactionsRequest(self, request):
+        index = self._peer_index(request.peer)
+        peer = self.peer(index)
+        updates = []
+        for message_id in request.id:
+            message = self.message(peer, message_id)
+            if isinstance(message, types.Message):
+                updates.append(types.UpdateMessageReactions(peer=peer, msg_id=message_id,
+                                                            reactions=message.reactions))
+        return types.Updates(updates=updates, users=[], chats=[self.entity(index)],
+                             date=_date(time.time()), seq=0)
+
+    def _DeleteMessagesRequest(self, request):
+        if isinstance(request, functions.channels.DeleteMessagesRequest):
+            self._channel_index(request.channel)
+        return types.messages.AffectedMessages(pts=1, pts_count=len(request.id))
+
+    def _stats_index(self, request, kind: str) -> int:
+        index = self._channel_index(request.channel)
+        if not index % 8 < 4:
+            raise errors.ChatAdminRequiredError(request=request)
+        if self.kind(index) != kind:
+            raise (errors.BroadcastRequiredError if kind == "channel" else errors.MegagroupRequiredError)(request=request)
+        return index
+
+    def _GetBroadcastStatsRequest(self, request):
+        index = self._stats_index(request, "channel")
+        value = lambda current: types.StatsAbsValueAndPrev(current=current, previous=current * 0.9)
+        members = 1000 + index
+        return types.stats.BroadcastStats(
+            period=types.StatsDateRangeDays(min_date=_date(BASE_DATE - 30 * 86400), max_date=_date(BASE_DATE)),
+            followers=value(members), views_per_post=value(members // 2), shares_per_post=value(5),
+            reactions_per_post=value(12), views_per_story=value(0), shares_per_story=value(0),
+            reactions_per_story=value(0),
+            enabled_notifications=types.StatsPercentValue(part=members // 3, total=members),
+            recent_posts_interactions=[],
+            **self.graphs((
+                "growth_graph", "followers_graph", "mute_graph", "top_hours_graph", "interactions_graph",
+                "iv_interactions_graph", "views_by_source_graph", "new_followers_by_source_graph",
+                "languages_graph", "reactions_by_emotion_graph", "story_interactions_graph",
+                "story_reactions_by_emotion_graph",
+            )),
+        )
+
+    def _GetMegagroupStatsRequest(self, request):
+        index = self._stats_index(request, "megagroup")
+        value = lambda current: types.StatsAbsValueAndPrev(current=current, previous=current * 0.9)
+        return types.stats.MegagroupStats(
+            period=types.StatsDateRangeDays(min_date=_date(BASE_DATE - 30 * 86400), max_date=_date(BASE_DATE)),
+            members=value(1000 + index), messages=value(400), viewers=value(300), posters=value(40),
+            top_posters=[], top_admins=[], top_inviters=[], users=[],
+            **self.graphs((
+                "growth_graph", "members_graph", "new_members_by_source_graph", "languages_graph",
+                "messages_graph", "actions_graph", "top_hours_graph", "weekdays_graph",
+            )),
+        )
+
+    def _LoadAsyncGraphRequest(self, request):
+        return self.graph(request.token.split(":")[0])
+
+    def rpc_counts(self) -> Counter:
+        return Counter(self.calls)
+
+    def stats(self) -> dict:
+        return {"calls": sum(self.calls.values()), "flood_waits": self.flood_waits}
+
+
+class FakeSender:
+    """The slice of MTProtoSender that TelegramClient._call uses."""
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+        self._connected = True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def send(self, request, ordered=False):
+        # Telethon sends lists (e.g. delete_messages chunks) as one container
+        if isinstance(request, list):
+            return [asyncio.ensure_future(self.backend.handle(r)) for r in request]
+        return asyncio.ensure_future(self.backend.handle(request))
+
+    async def disconnect(self):
+        self._connected = False
+
+
+class FakeTelegramClient(scheduler.ScheduledTelegramClient):
+    def __init__(self, backend: FakeBackend, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backend = backend
+
+    async def connect(self):
+        self._sender = FakeSender(self.backend)
+
+    def is_connected(self) -> bool:
+        return isinstance(self._sender, FakeSender) and self._sender.is_connected()
+
+    async def disconnect(self):
+        if isinstance(self._sender, FakeSender):
+            await self._sender.disconnect()
+
+
+def client_factory(backend: FakeBackend):
+    """A ClientPool factory building fake clients with in-memory sessions."""
+    def build(user_id: str, api_id: str, api_hash: str) -> FakeTelegramClient:
+        return FakeTelegramClient(backend, StringSession(), int(api_id), api_hash,
+                                  scheduler=scheduler.schedulers.get(user_id))
+    return build
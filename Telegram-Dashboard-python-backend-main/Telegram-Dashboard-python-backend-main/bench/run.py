@@ -0,0 +1,381 @@
+"""
+Benchmarks for the hot endpoints, run in-process against a fake Telegram.
+
+The FastAPI app from main.py is driven through httpx's ASGI transport with
+every pooled client replaced by a FakeTelegramClient (see fake_telegram.py),
+so the whole request path runs (middleware, scheduler, caches, Telethon's
+response handling) without a network or a Telegram account.
+
+Usage, from the backend directory:
+    python bench/run.py                          # every scenario, full scale
+    python bench/run.py --scale small dialogs_warm analytics
+    python bench/run.py --save                   # write bench/baselines/<scale>.json
+    python bench/run.py --compare                # exit 1 on regressions vs that baseline
+    python bench/run.py --latency 0.1 --flood-rate 0.01 --json out.json
+
+Each scenario reports p50/p95/p99 latency, throughput, RPCs per request (in
+total and by request type), FloodWaits hit and process RSS.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import pathlib
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+BASELINE_DIR = BENCH_DIR / "baselines"
+
+# main.py reads these at import time. Session files, dialog indexes and the
+# metrics database go to a scratch directory removed after the run.
+SCRATCH_DIR = None
+if "SESSION_DIR" not in os.environ:
+    SCRATCH_DIR = os.environ["SESSION_DIR"] = tempfile.mkdtemp(prefix="tg-bench-")
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from fake_telegram import FakeBackend, client_factory  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Per-scale sizes. "full" is what production sees on a busy node; "small"
+# keeps a run under a minute for quick checks.
+SCALES = {
+    "full": {"dialogs": 10_000, "users": 500, "batch": 5_000, "delete": 1_000, "requests": 2_000},
+    "small": {"dialogs": 1_000, "users": 50, "batch": 500, "delete": 200, "requests": 200},
+}
+
+# A metric regresses when it is worse than the baseline by more than the
+# ratio AND by more than the absolute floor (keeps noise on tiny values out)
+TOLERANCES = {
+    "latency": (1.25, 10.0),  # ms
+    "throughput": (0.80, 0.0),  # rps, lower is worse
+    "rpc": (1.05, 0.05),  # RPCs per request
+    "rss": (1.25, 20.0),  # MB
+}
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return 0.0
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def headers_for(user_id: str) -> dict:
+    return {"x-user-id": user_id, "x-api-id": os.environ["API_ID"], "x-api-hash": os.environ["API_HASH"]}
+
+
+class Scenario:
+    """
+    `requests` calls of make_request(i) -> (method, path, kwargs), at most
+    `concurrency` in flight. setup() runs before timing starts.
+    """
+
+    def __init__(self, name: str, description: str, requests: int, concurrency: int,
+                 make_request, setup=None):
+        self.name = name
+        self.description = description
+        self.requests = requests
+        self.concurrency = concurrency
+        self.make_request = make_request
+        self.setup = setup
+
+
+def build_scenarios(backend: FakeBackend, scale: dict, seed: int) -> dict:
+    rng = random.Random(seed)
+    channels = backend.channels("channel")
+    groups = backend.channels("megagroup")
+    users = scale["users"]
+
+    def batch_items(size: int, peers: int, pool: list = None):
+        # Spread over a few peers like a broadcast task does
+        pool = pool or channels + groups
+        picked = rng.sample(pool, min(peers, len(pool)))
+        return [backend.target(picked[i % len(picked)], 1 + i // len(picked)) for i in range(size)]
+
+    def dialogs_request(prefix: str, count: int):
+        return lambda i: ("GET", "/dialogs", {"headers": headers_for(f"{prefix}-{i % count}")})
+
+    async def warm_dialogs(client: httpx.AsyncClient):
+        await asyncio.gather(*(client.get("/dialogs", headers=headers_for(f"dialogs-{i}"))
+                               for i in range(10)))
+
+    def analytics_request(fresh: bool):
+        def make(i):
+            index = channels[rng.randrange(len(channels))]
+            target = backend.target(index, rng.randrange(1, 1000))
+            params = {"chat_id": target["recipientId"], "message_id": target["messageId"],
+                      "access_hash": target["accessHash"]}
+            if fresh:
+                params["fresh"] = "true"
+            return "GET", "/analytics", {"params": params, "headers": headers_for(f"user-{i % users}")}
+        return make
+
+    cached_targets = [backend.target(channels[i % len(channels)], 1 + i) for i in range(100)]
+
+    def analytics_cached(i):
+        target = cached_targets[i % len(cached_targets)]
+        params = {"chat_id": target["recipientId"], "message_id": target["messageId"],
+                  "access_hash": target["accessHash"]}
+        return "GET", "/analytics", {"params": params, "headers": headers_for(f"user-{i % users}")}
+
+    async def warm_analytics(client: httpx.AsyncClient):
+        # Cache keys are per account: fetch every (user, message) pair once
+        requests = [analytics_cached(i) for i in range(math.lcm(users, len(cached_targets)))]
+        await asyncio.gather(*(client.request(method, path, **kwargs) for method, path, kwargs in requests))
+
+    def batch_request(fields: str = None):
+        def make(i):
+            params = {"fresh": "true"}
+            if fields:
+                params["fields"] = fields
+            # Counters only exist on broadcast posts
+            return "POST", "/analytics/batch", {
+                "params": params, "json": batch_items(scale["batch"], 50, channels if fields else None),
+                "headers": headers_for(f"batch-{i % 4}"),
+            }
+        return make
+
+    def delete_request(i):
+        return "POST", "/messages/delete", {
+            "json": {"messages": batch_items(scale["delete"], 10)},
+            "headers": headers_for(f"delete-{i % 4}"),
+        }
+
+    stats_channels = [i for i in channels + groups if i % 8 < 4][:50]
+
+    def stats_request(i):
+        index = stats_channels[i % len(stats_channels)]
+        target = backend.target(index, 1)
+        return "POST", "/channel-stats", {
+            "json": {"channelId": target["recipientId"], "accessHash": target["accessHash"], "points": 200},
+            "headers": headers_for(f"stats-{i % 10}"),
+        }
+
+    scenarios = [
+        Scenario("dialogs_cold", f"first GET /dialogs, {scale['dialogs']} dialogs, index build",
+                 10, 10, dialogs_request("cold", 10)),
+        Scenario("dialogs_warm", "GET /dialogs served from the index",
+                 max(50, scale["requests"] // 10), 20, dialogs_request("dialogs", 10), setup=warm_dialogs),
+        Scenario("analytics", f"GET /analytics?fresh=true, {users} concurrent users",
+                 scale["requests"], users, analytics_request(fresh=True)),
+        Scenario("analytics_cached", f"GET /analytics cache hits, {users} concurrent users",
+                 scale["requests"], users, analytics_cached, setup=warm_analytics),
+        Scenario("analytics_batch", f"POST /analytics/batch, {scale['batch']} messages over 50 peers",
+                 20, 4, batch_request()),
+        Scenario("analytics_counters", f"POST /analytics/batch?fields=counters, {scale['batch']} messages over 50 channels",
+                 20, 4, batch_request("counters")),
+        Scenario("messages_delete", f"POST /messages/delete, {scale['delete']} messages over 10 peers",
+                 20, 4, delete_request),
+        Scenario("channel_stats", "POST /channel-stats over 50 channels, 10 accounts",
+                 200, 50, stats_request),
+    ]
+    return {s.name: s for s in scenarios}
+
+
+async def run_scenario(client: httpx.AsyncClient, backend: FakeBackend, scenario: Scenario) -> dict:
+    if scenario.setup:
+        await scenario.setup(client)
+
+    latencies, statuses = [], Counter()
+    calls_before, floods_before = backend.rpc_counts(), backend.flood_waits
+    rss_start = peak = rss_mb()
+    next_index = iter(range(scenario.requests))
+
+    async def worker():
+        for i in next_index:
+            method, path, kwargs = scenario.make_request(i)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                statuses[response.status_code] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    async def sample_rss():
+        nonlocal peak
+        while True:
+            peak = max(peak, rss_mb())
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_rss())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(scenario.concurrency, scenario.requests))))
+    wall = time.perf_counter() - started
+    sampler.cancel()
+
+    calls = backend.rpc_counts() - calls_before
+    count = len(latencies)
+    return {
+        "description": scenario.description,
+        "requests": count,
+        "concurrency": scenario.concurrency,
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(count / wall, 2) if wall else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies, default=0), 2),
+            "mean": round(sum(latencies) / count, 2) if count else 0.0,
+        },
+        "rpc": {
+            "per_request": round(sum(calls.values()) / count, 3) if count else 0.0,
+            "by_method": {name: round(n / count, 3) for name, n in sorted(calls.items())},
+        },
+        "flood_waits": backend.flood_waits - floods_before,
+        "rss_mb": {"start": round(rss_start, 1), "end": round(rss_mb(), 1), "peak": round(peak, 1)},
+    }
+
+
+async def run(args) -> dict:
+    scale = SCALES[args.scale]
+    backend = FakeBackend(dialogs=scale["dialogs"], latency=args.latency, jitter=args.jitter,
+                          flood_rate=args.flood_rate, flood_seconds=args.flood_seconds, seed=args.seed)
+    scenarios = build_scenarios(backend, scale, args.seed)
+    unknown = set(args.scenarios) - set(scenarios)
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(sorted(unknown))}. "
+                         f"Available: {', '.join(scenarios)}")
+
+    main.pool.factory = client_factory(backend)
+    main.pool.max_clients = max(main.pool.max_clients, scale["users"] + 100)
+
+    results = {}
+    # Runs the app's startup/shutdown hooks (pool reaper, trackers, stores)
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in args.scenarios or scenarios:
+                print(f"running {name}...", file=sys.stderr)
+                results[name] = await run_scenario(client, backend, scenarios[name])
+
+    return {
+        "scale": args.scale,
+        "config": {**scale, "latency": args.latency, "jitter": args.jitter,
+                   "flood_rate": args.flood_rate, "flood_seconds": args.flood_seconds, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "scenarios": results,
+    }
+
+
+def print_report(report: dict):
+    print(f"{'scenario':<18} {'reqs':>6} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'rpc/req':>8} {'flood':>6} {'rss MB':>8}  statuses")
+    for name, r in report["scenarios"].items():
+        latency = r["latency_ms"]
+        print(f"{name:<18} {r['requests']:>6} {r['throughput_rps']:>9.1f} {latency['p50']:>9.1f} "
+              f"{latency['p95']:>9.1f} {latency['p99']:>9.1f} {r['rpc']['per_request']:>8.2f} "
+              f"{r['flood_waits']:>6} {r['rss_mb']['peak']:>8.1f}  {r['statuses']}")
+
+
+def _worse(metric: str, current: float, baseline: float) -> bool:
+    ratio, floor = TOLERANCES[metric]
+    if metric == "throughput":
+        return current < baseline * ratio
+    return current > baseline * ratio and current - baseline > floor
+
+
+def compare(report: dict, baseline: dict) -> list:
+    """Human-readable regressions of `report` against `baseline`."""
+    regressions = []
+    for name, current in report["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        for pct in ("p50", "p95", "p99"):
+            if _worse("latency", current["latency_ms"][pct], base["latency_ms"][pct]):
+                regressions.append(f"{name}: {pct} {base['latency_ms'][pct]} -> {current['latency_ms'][pct]} ms")
+        if _worse("throughput", current["throughput_rps"], base["throughput_rps"]):
+            regressions.append(f"{name}: throughput {base['throughput_rps']} -> {current['throughput_rps']} rps")
+        if _worse("rpc", current["rpc"]["per_request"], base["rpc"]["per_request"]):
+            regressions.append(f"{name}: RPCs per request {base['rpc']['per_request']} -> "
+                               f"{current['rpc']['per_request']} ({current['rpc']['by_method']})")
+        if _worse("rss", current["rss_mb"]["peak"], base["rss_mb"]["peak"]):
+            regressions.append(f"{name}: peak RSS {base['rss_mb']['peak']} -> {current['rss_mb']['peak']} MB")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run (default: all)")
+    parser.add_argument("--scale", choices=SCALES, default="full")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake RPC latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency varies by +- this fraction")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of RPCs that FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--save", action="store_true", help="save the report as the baseline for this scale")
+    parser.add_argument("--compare", action="store_true", help="compare with the baseline for this scale")
+    parser.add_argument("--baseline", help="baseline file (default: bench/baselines/<scale>.json)")
+    args = parser.parse_args()
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if SCRATCH_DIR:
+            shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+    print_report(report)
+
+    if args.json:
+        pathlib.Path(args.json).write_text(json.dumps(report, indent=2))
+
+    baseline_path = pathlib.Path(args.baseline) if args.baseline else BASELINE_DIR / f"{args.scale}.json"
+    if args.compare:
+        if not baseline_path.exists():
+            raise SystemExit(f"No baseline at {baseline_path}; run with --save first")
+        regressions = compare(report, json.loads(baseline_path.read_text()))
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {baseline_path}")
+    if args.save:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        if baseline_path.exists() and args.scenarios:
+            # Partial runs only replace the scenarios they ran
+            saved = json.loads(baseline_path.read_text())
+            saved["scenarios"].update(report["scenarios"])
+            report = {**report, "scenarios": saved["scenarios"]}
+        baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Saved baseline to {baseline_path}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,339 @@
+"""
+Cached channel/group statistics for POST /channel-stats.
+
+The handler used to try GetBroadcastStats and then GetMegagroupStats on
+every request, `json.loads` every graph blob and drop StatsGraphAsync graphs
+(which Telegram sends as a token to load separately). This module:
+- remembers per channel whether it is a broadcast channel or a megagroup,
+- caches the result per (account, channel) for STATS_CACHE_TTL (at most
+  STATS_CACHE_MAX entries, LRU), decoding graph JSON only when a graph is
+  actually requested,
+- loads async graphs with LoadAsyncGraphRequest in the background, waiting
+  at most STATS_GRAPH_WAIT for them on the request that triggered the load,
+- serves graphs decimated to ~N points (min/max per bucket) in Telegram's
+  own columns/names format, so the dashboard chart parser is unchanged.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import AbstractContextManager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from telethon import TelegramClient, errors, types
+from telethon.tl.functions.stats import (
+    GetBroadcastStatsRequest, GetMegagroupStatsRequest, LoadAsyncGraphRequest
+)
+
+import log_config
+import scheduler
+from entity_resolver import invalidate_on
+
+logger = logging.getLogger(__name__)
+item_log = log_config.item_logger(__name__)
+
+# Telegram recomputes channel stats a few times a day at most
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", 1800))  # seconds
+# Cached channels across accounts; entries hold every graph Telegram sent
+STATS_CACHE_MAX = int(os.getenv("STATS_CACHE_MAX", 2000))
+# How long a request waits for async graphs it started loading
+STATS_GRAPH_WAIT = float(os.getenv("STATS_GRAPH_WAIT", 3))  # seconds
+# Channels fetched at once by POST /channel-stats/batch
+STATS_BATCH_CONCURRENCY = int(os.getenv("STATS_BATCH_CONCURRENCY", 4))
+
+FIELDS = ("summary", "full")
+
+BROADCAST = "broadcast"
+MEGAGROUP = "megagroup"
+
+# Graph names in the legacy response ("followers" block read by Analytics.jsx)
+LEGACY_GRAPHS = {
+    BROADCAST: ("followers", "growth_graph", "followers_graph"),
+    MEGAGROUP: ("members", "growth_graph", "members_graph"),
+}
+
+Key = Tuple[str, str]
+# resolve(channel_id, access_hash) -> InputPeer
+Resolver = Callable[[str, str], Awaitable[object]]
+# on_counts(channel_id, followers) is called with every fresh follower/member count
+CountsCallback = Callable[[str, int], None]
+
+
+class StatsUnavailable(Exception):
+    """Neither broadcast nor megagroup stats can be fetched (not admin, too small...)."""
+
+
+def parse_graph(graph) -> Optional[dict]:
+    if isinstance(graph, types.StatsGraph):
+        data = json.loads(graph.json.data)
+        item_log.debug(
+            "Graph keys=%s columns=%s names=%s",
+            list(data.keys()), [c[0] for c in data.get("columns", [])], data.get("names")
+        )
+        return data
+    if isinstance(graph, types.StatsGraphError):
+        return {"error": graph.error}
+    if isinstance(graph, types.StatsGraphAsync):
+        return {"loading": True}
+    return None
+
+
+def decimate(graph: dict, points: int) -> dict:
+    """
+    Reduce a Telegram graph to about `points` x values. The series are split
+    into buckets and, per bucket, the positions of each series' min and max
+    are kept, so spikes survive. The first and last points are always kept.
+    """
+    columns = graph.get("columns") or []
+    x = next((c for c in columns if c and c[0] == "x"), None)
+    series = [c for c in columns if c and c[0] != "x"]
+    total = len(x) - 1 if x else 0
+    if not series or points <= 0 or total <= points:
+        return graph
+
+    buckets = max(1, points // (2 * len(series)))
+    size = total / buckets
+    keep = {0, total - 1}
+    for b in range(buckets):
+        start, end = int(b * size), min(total, int((b + 1) * size))
+        if start >= end:
+            continue
+        for column in series:
+            values = column[1 + start:1 + end]
+            keep.add(start + min(range(len(values)), key=lambda i: values[i] or 0))
+            keep.add(start + max(range(len(values)), key=lambda i: values[i] or 0))
+
+    indexes = sorted(keep)
+    return {**graph, "columns": [[c[0]] + [c[1 + i] for i in indexes] for c in columns]}
+
+
+def counters_of(stats) -> Dict[str, dict]:
+    """
+    {"followers": {"current", "previous"}, "enabled_notifications": {"part", "total"}, ...}
+    """
+    counters = {}
+    for name in stats.to_dict():
+        value = getattr(stats, name, None)
+        if isinstance(value, types.StatsAbsValueAndPrev):
+            counters[name] = {"current": value.current, "previous": value.previous}
+        elif isinstance(value, types.StatsPercentValue):
+            counters[name] = {"part": value.part, "total": value.total}
+    return counters
+
+
+class StatsEntry:
+    def __init__(self, kind: str, stats):
+        self.kind = kind
+        self.period = f"{stats.period.min_date} to {stats.period.max_date}"
+        self.counters = counters_of(stats)
+        self.fetched_at = time.monotonic()
+        # Graphs as Telegram sent them; decoded on first use
+        self.raw: Dict[str, object] = {
+            name: getattr(stats, name) for name in stats.to_dict() if name.endswith("_graph")
+        }
+        self._parsed: Dict[str, Optional[dict]] = {}
+        self._decimated: Dict[Tuple[str, int], dict] = {}
+        self.loads: Dict[str, asyncio.Task] = {}
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def pending(self) -> List[str]:
+        return [name for name, graph in self.raw.items() if isinstance(graph, types.StatsGraphAsync)]
+
+    def set_graph(self, name: str, graph):
+        self.raw[name] = graph
+        self._parsed.pop(name, None)
+        for key in [k for k in self._decimated if k[0] == name]:
+            del self._decimated[key]
+
+    def graph(self, name: str, points: int = None) -> Optional[dict]:
+        if name not in self._parsed:
+            self._parsed[name] = parse_graph(self.raw.get(name))
+        graph = self._parsed[name]
+        if not points or not graph or "columns" not in graph:
+            return graph
+        key = (name, points)
+        if key not in self._decimated:
+            self._decimated[key] = decimate(graph, points)
+        return self._decimated[key]
+
+    def view(self, fields: str = "full", points: int = None, cached: bool = False) -> dict:
+        """
+        Response body. "summary" is counters only (no graph decoding); "full"
+        adds every graph. Both keep the legacy {"period", "followers": {...}}
+        shape; for megagroups "followers" carries the member counts.
+        """
+        counter, growth, followers_graph = LEGACY_GRAPHS[self.kind]
+        counts = self.counters.get(counter, {})
+        body = {
+            "kind": self.kind,
+            "period": self.period,
+            "followers": {"current": counts.get("current"), "previous": counts.get("previous")},
+            "counters": self.counters,
+            "cached": cached,
+            "age": round(self.age, 1),
+        }
+        if fields == "full":
+            body["followers"]["growth_graph"] = self.graph(growth, points)
+            body["followers"]["followers_graph"] = self.graph(followers_graph, points)
+            body["graphs"] = {name: self.graph(name, points) for name in self.raw}
+            body["pending"] = self.pending()
+        return body
+
+
+class ChannelStatsStore:
+    def __init__(self, busy: Callable[[str], AbstractContextManager],
+                 ttl: int = STATS_CACHE_TTL, on_counts: CountsCallback = None,
+                 max_entries: int = STATS_CACHE_MAX):
+        self.busy = busy
+        self.ttl = ttl
+        self.on_counts = on_counts
+        self.max_entries = max_entries
+        self.kinds: Dict[str, str] = {}
+        self._entries: "OrderedDict[Key, StatsEntry]" = OrderedDict()
+        self._inflight: Dict[Key, asyncio.Task] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.graph_loads = 0
+
+    async def get(self, client: TelegramClient, account: str, channel_id: str, peer,
+                  fresh: bool = False) -> Tuple[StatsEntry, bool]:
+        """
+        Cached stats for a channel, fetching them once for concurrent callers.
+        Returns (entry, cached).
+        """
+        key = (account, str(channel_id))
+        entry = self._entries.get(key)
+        if entry is not None and not fresh and entry.age < self.ttl:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry, True
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._fetch(client, account, str(channel_id), peer))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task), False
+
+    async def _request(self, client: TelegramClient, kind: str, peer):
+        request = GetBroadcastStatsRequest if kind == BROADCAST else GetMegagroupStatsRequest
+        return await client(request(channel=peer, dark=False))
+
+    async def _fetch(self, client: TelegramClient, account: str, channel_id: str, peer) -> StatsEntry:
+        known = self.kinds.get(channel_id)
+        kinds = [known] if known else [BROADCAST, MEGAGROUP]
+        if known:
+            kinds.append(MEGAGROUP if known == BROADCAST else BROADCAST)
+
+        stats, kind, error = None, None, None
+        for index, candidate in enumerate(kinds):
+            try:
+                stats = await self._request(client, candidate, peer)
+                kind = candidate
+                break
+            except scheduler.Throttled:
+                raise
+            except errors.RPCError as e:
+                error = e
+                if index + 1 < len(kinds):
+                    logger.info("%s stats failed for %s, trying %s: %s",
+                                candidate, channel_id, kinds[index + 1], e)
+        if stats is None:
+            raise StatsUnavailable(f"Stats not available (Not Admin or too small?): {error}") from error
+
+        self.kinds[channel_id] = kind
+        entry = StatsEntry(kind, stats)
+        logger.info("Stats fetched for %s (%s). Period: %s", channel_id, kind, entry.period)
+
+        counts = entry.counters.get(LEGACY_GRAPHS[kind][0])
+        if self.on_counts and counts and counts.get("current") is not None:
+            self.on_counts(channel_id, counts["current"])
+
+        old = self._entries.get((account, channel_id))
+        self._put((account, channel_id), entry)
+        for name, graph in list(entry.raw.items()):
+            if not isinstance(graph, types.StatsGraphAsync):
+                continue
+            if old is not None and not isinstance(old.raw.get(name, graph), types.StatsGraphAsync):
+                # Keep the graph loaded last time until the new one arrives
+                entry.set_graph(name, old.raw[name])
+            entry.loads[name] = asyncio.create_task(
+                self._load_graph(client, account, entry, name, graph.token)
+            )
+        return entry
+
+    def _put(self, key: Key, entry: StatsEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def _load_graph(self, client: TelegramClient, account: str, entry: StatsEntry,
+                          name: str, token: str):
+        self.graph_loads += 1
+        try:
+            with self.busy(account), scheduler.priority(scheduler.BACKGROUND):
+                graph = await client(LoadAsyncGraphRequest(token=token))
+        except Exception as e:
+            logger.info("Async graph %s failed to load: %s", name, e)
+            graph = types.StatsGraphError(error=str(e))
+        entry.set_graph(name, graph)
+
+    async def wait_graphs(self, entry: StatsEntry, timeout: float = STATS_GRAPH_WAIT):
+        """Give in-progress async graph loads a moment to finish."""
+        tasks = [t for t in entry.loads.values() if not t.done()]
+        if tasks and timeout > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def get_many(self, client: TelegramClient, account: str, channels: List[Tuple[str, str]],
+                       resolve: Resolver, fields: str = "summary", points: int = None,
+                       fresh: bool = False, concurrency: int = None) -> Dict[str, dict]:
+        """
+        Stats for several (channel_id, access_hash) pairs, fetched concurrently
+        (the account's scheduler still paces the RPCs). Returns
+        {channel_id: view} with {"error": ...} for channels that failed;
+        throttled ones also carry "retry_after".
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency or STATS_BATCH_CONCURRENCY))
+        results: Dict[str, dict] = {}
+
+        async def one(channel_id: str, access_hash: str):
+            async with semaphore:
+                try:
+                    peer = await resolve(channel_id, access_hash)
+                    entry, cached = await self.get(client, account, channel_id, peer, fresh=fresh)
+                    if fields == "full":
+                        await self.wait_graphs(entry)
+                    results[channel_id] = entry.view(fields, points, cached)
+                except scheduler.Throttled as e:
+                    results[channel_id] = {"error": str(e), "retry_after": e.retry_after}
+                except Exception as e:
+                    logger.warning("Failed to fetch stats for %s: %s", channel_id, e)
+                    invalidate_on(resolve, channel_id, e)
+                    results[channel_id] = {"error": str(e)}
+
+        await asyncio.gather(*(one(channel_id, access_hash) for channel_id, access_hash in channels))
+        return {channel_id: results[channel_id] for channel_id, _ in channels}
+
+    def forget(self, account: str):
+        for key in [k for k in self._entries if k[0] == account]:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "kinds": len(self.kinds),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "graph_loads": self.graph_loads,
+        }
@@ -0,0 +1,236 @@
+"""
+Per-user Telethon client pool.
+
+Replaces the unbounded module-level `clients` dict:
+- single-flight init: one asyncio.Lock per user so concurrent first requests
+  share one client instead of racing to create two
+- LRU order plus an idle TTL; idle clients are disconnected by a reaper task
+- a cap on open connections, evicting the least recently used idle client
+- reconnect-on-demand for pooled clients whose socket dropped
+"""
+import asyncio
+import inspect
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Optional, Union
+
+from telethon import TelegramClient
+
+logger = logging.getLogger(__name__)
+
+CLIENT_POOL_MAX = int(os.getenv("CLIENT_POOL_MAX", 200))
+CLIENT_IDLE_TTL = int(os.getenv("CLIENT_IDLE_TTL", 900))  # seconds
+CLIENT_REAPER_INTERVAL = int(os.getenv("CLIENT_REAPER_INTERVAL", 60))  # seconds
+
+
+class PoolExhausted(Exception):
+    """Every pooled client is busy and the connection cap is reached."""
+
+
+class _Entry:
+    __slots__ = ("client", "last_used")
+
+    def __init__(self, client: TelegramClient):
+        self.client = client
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    def __init__(self, factory: Callable[[str, str, str], Union[TelegramClient, Awaitable[TelegramClient]]],
+                 max_clients: int = CLIENT_POOL_MAX, idle_ttl: int = CLIENT_IDLE_TTL,
+                 reaper_interval: int = CLIENT_REAPER_INTERVAL,
+                 on_close: Callable[[str], Optional[Awaitable[None]]] = None):
+        self.factory = factory
+        # Called with the user id once a client built by `factory` is closed
+        # or failed to connect (e.g. to release a session lease)
+        self.on_close = on_close
+        self.max_clients = max_clients
+        self.idle_ttl = idle_ttl
+        self.reaper_interval = reaper_interval
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._busy: Dict[str, int] = {}
+        self._pending = 0
+        self._reaper: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reconnects = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id: str):
+        return user_id in self._entries
+
+    def peek(self, user_id: str) -> Optional[TelegramClient]:
+        """
+        Return the pooled client without touching LRU order or counters.
+        """
+        entry = self._entries.get(user_id)
+        return entry.client if entry else None
+
+    @contextmanager
+    def busy(self, user_id: str):
+        """
+        Mark a user's client as in use for the duration of a request so it is
+        never evicted mid-call.
+        """
+        self._busy[user_id] = self._busy.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._busy[user_id] -= 1
+            if not self._busy[user_id]:
+                del self._busy[user_id]
+            entry = self._entries.get(user_id)
+            if entry:
+                entry.last_used = time.monotonic()
+
+    def _touch(self, user_id: str, entry: _Entry):
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(user_id)
+
+    async def get(self, user_id: str, api_id: str, api_hash: str) -> TelegramClient:
+        entry = self._entries.get(user_id)
+        if entry and entry.client.is_connected():
+            self.hits += 1
+            self._touch(user_id, entry)
+            return entry.client
+
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            # Another request may have finished init while we waited
+            entry = self._entries.get(user_id)
+            if entry:
+                if not entry.client.is_connected():
+                    self.reconnects += 1
+                    await entry.client.connect()
+                    logger.info("Reconnected Telethon client", extra={"pool_user": user_id})
+                else:
+                    self.hits += 1
+                self._touch(user_id, entry)
+                return entry.client
+
+            self.misses += 1
+            await self._reserve_slot()
+            try:
+                client = self.factory(user_id, api_id, api_hash)
+                if inspect.isawaitable(client):
+                    client = await client
+                try:
+                    await client.connect()
+                except BaseException:
+                    await self._closed(user_id)
+                    raise
+            finally:
+                self._pending -= 1
+
+            self._entries[user_id] = _Entry(client)
+            return client
+
+    async def _reserve_slot(self):
+        """
+        Make room for one more client, evicting LRU idle clients if needed.
+        """
+        victims = []
+        while len(self._entries) + self._pending >= self.max_clients:
+            victim = next(
+                (uid for uid in self._entries if uid not in self._busy), None
+            )
+            if victim is None:
+                raise PoolExhausted(
+                    f"Client pool full ({self.max_clients} connections, all busy)"
+                )
+            victims.append((victim, self._entries.pop(victim)))
+        self._pending += 1
+
+        for user_id, entry in victims:
+            await self._disconnect(user_id, entry, reason="capacity")
+
+    async def _closed(self, user_id: str):
+        if self.on_close is not None:
+            result = self.on_close(user_id)
+            if inspect.isawaitable(result):
+                await result
+
+    async def _disconnect(self, user_id: str, entry: _Entry, reason: str):
+        self.evictions += 1
+        lock = self._locks.get(user_id)
+        if lock is not None and not lock.locked():
+            # Nobody is initializing this client; get() makes a new lock if needed
+            del self._locks[user_id]
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            logger.warning("Error disconnecting client: %s", e, extra={"pool_user": user_id})
+        await self._closed(user_id)
+        logger.info("Evicted Telethon client (%s)", reason, extra={"pool_user": user_id})
+
+    async def remove(self, user_id: str, disconnect: bool = True):
+        """
+        Drop a user's client (e.g. after logout).
+        """
+        entry = self._entries.pop(user_id, None)
+        self._locks.pop(user_id, None)
+        if entry and disconnect:
+            try:
+                await entry.client.disconnect()
+            except Exception:
+                pass
+        if entry:
+            await self._closed(user_id)
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        expired = [
+            uid for uid, entry in self._entries.items()
+            if uid not in self._busy and now - entry.last_used > self.idle_ttl
+        ]
+        for user_id in expired:
+            entry = self._entries.pop(user_id, None)
+            if entry:
+                await self._disconnect(user_id, entry, reason="idle")
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reaper_interval)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.exception("Client pool reaper error: %s", e)
+
+    def start(self):
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_forever())
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+            self._reaper = None
+        entries = list(self._entries.items())
+        self._entries.clear()
+        for user_id, entry in entries:
+            try:
+                await entry.client.disconnect()
+            except Exception:
+                pass
+            await self._closed(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "connected": sum(1 for e in self._entries.values() if e.client.is_connected()),
+            "busy": len(self._busy),
+            "max": self.max_clients,
+            "idle_ttl": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "reconnects": self.reconnects,
+        }
@@ -0,0 +1,153 @@
+"""
+Bulk delete pipeline for POST /messages/delete.
+
+Ids are grouped by peer and split into chunks of at most 100 (Telegram's
+DeleteMessages limit). Peers run concurrently under a bound, and every chunk
+is accounted for separately so one failing chunk doesn't lose the others.
+Large deletes can run as a background job (see jobs.py); the results so far
+are its checkpoint, and a resumed job only retries what did not succeed.
+"""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telethon import TelegramClient
+
+from analytics_engine import chunked, resolve_peer
+from entity_resolver import invalidate_on
+
+logger = logging.getLogger(__name__)
+
+# channels.DeleteMessages / messages.DeleteMessages accept at most 100 ids
+MAX_DELETE_IDS = 100
+DELETE_CONCURRENCY = int(os.getenv("DELETE_CONCURRENCY", 4))
+
+# resolve(chat_id, access_hash) -> InputPeer, see analytics_engine.Resolver
+Resolver = Callable[[str, str], Awaitable[object]]
+Progress = Callable[[dict], None]
+
+
+def plan_deletes(messages: list):
+    """
+    Group [{"recipientId", "messageId", "accessHash"?}, ...] by peer.
+    Returns (ids_by_peer, access_hashes, invalid_count).
+    """
+    ids_by_peer: Dict[str, List[int]] = {}
+    hashes: Dict[str, str] = {}
+    invalid = 0
+
+    for msg in messages:
+        if not isinstance(msg, dict):
+            invalid += 1
+            continue
+        recipient_id = msg.get("recipientId")
+        message_id = msg.get("messageId")
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            message_id = None
+        if not recipient_id or not message_id:
+            invalid += 1
+            continue
+
+        recipient_id = str(recipient_id)
+        ids_by_peer.setdefault(recipient_id, []).append(message_id)
+        if msg.get("accessHash"):
+            hashes[recipient_id] = str(msg["accessHash"])
+
+    return ids_by_peer, hashes, invalid
+
+
+def new_results(total: int, invalid: int) -> dict:
+    # success/failed/errors keep the shape expiryService.js already reads
+    return {
+        "success": 0,
+        "failed": invalid,
+        "errors": [],
+        "total": total,
+        "done": invalid,
+        "chunks": [],
+    }
+
+
+def carry_over(results: dict, previous: dict, ids_by_peer: Dict[str, List[int]]):
+    """
+    Seed `results` with the chunks a previous attempt deleted and drop their
+    ids from `ids_by_peer`; failed chunks are tried again.
+    """
+    for chunk in previous.get("chunks", []):
+        recipient_id = chunk["recipientId"]
+        if not chunk["ok"] or recipient_id not in ids_by_peer:
+            continue
+        deleted = set(chunk["ids"])
+        ids_by_peer[recipient_id] = [i for i in ids_by_peer[recipient_id] if i not in deleted]
+        results["chunks"].append(chunk)
+        results["success"] += len(chunk["ids"])
+        results["done"] += len(chunk["ids"])
+    for recipient_id in [r for r, ids in ids_by_peer.items() if not ids]:
+        del ids_by_peer[recipient_id]
+
+
+async def run_delete(client: TelegramClient, resolve: Resolver, messages: list,
+                     concurrency: int = None, on_progress: Progress = None,
+                     previous: Optional[dict] = None, rejected: Optional[List[dict]] = None) -> dict:
+    """
+    Delete `messages`, reporting the running results to `on_progress`.
+    `previous` is the results of an interrupted run to continue from;
+    `rejected` the [{"index", "error"}] entries that failed validation, which
+    count as failed.
+    """
+    ids_by_peer, hashes, invalid = plan_deletes(messages)
+    rejected = rejected or []
+    total = invalid + len(rejected) + sum(len(ids) for ids in ids_by_peer.values())
+    results = new_results(total, invalid + len(rejected))
+    results["errors"] += [f"item {item['index']}: {item['error']}" for item in rejected]
+    if previous:
+        carry_over(results, previous, ids_by_peer)
+    semaphore = asyncio.Semaphore(max(1, concurrency or DELETE_CONCURRENCY))
+    if on_progress:
+        on_progress(results)
+
+    def record(recipient_id: str, ids: List[int], error: Exception = None):
+        chunk = {"recipientId": recipient_id, "ids": ids, "ok": error is None}
+        if error is None:
+            results["success"] += len(ids)
+        else:
+            chunk["error"] = str(error)
+            results["failed"] += len(ids)
+            results["errors"].append(f"{recipient_id}: {error}")
+        results["chunks"].append(chunk)
+        results["done"] += len(ids)
+        if on_progress:
+            on_progress(results)
+
+    async def delete_peer(recipient_id: str, ids: List[int]):
+        async with semaphore:
+            try:
+                entity = await resolve(recipient_id, hashes.get(recipient_id))
+            except ValueError as e:
+                logger.warning("Could not resolve entity %s: %s", recipient_id, e)
+                # Try raw peer as last resort
+                entity = resolve_peer(recipient_id)
+            except Exception as e:
+                record(recipient_id, ids, e)
+                return
+
+            for chunk in chunked(ids, MAX_DELETE_IDS):
+                try:
+                    await client.delete_messages(entity, chunk, revoke=True)
+                except Exception as e:
+                    logger.warning("Failed to delete %d messages in %s: %s", len(chunk), recipient_id, e)
+                    invalidate_on(resolve, recipient_id, e)
+                    record(recipient_id, chunk, e)
+                else:
+                    record(recipient_id, chunk)
+
+    await asyncio.gather(*(
+        delete_peer(recipient_id, ids) for recipient_id, ids in ids_by_peer.items()
+    ))
+    logger.info("Deleted %d messages (%d failed) across %d peers",
+                results["success"], results["failed"], len(ids_by_peer))
+    return results
+
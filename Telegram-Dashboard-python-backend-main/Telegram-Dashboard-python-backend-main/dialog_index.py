@@ -0,0 +1,374 @@
+"""
+Per-user dialog index persisted next to the Telethon session.
+
+GET /dialogs used to walk `iter_dialogs(limit=None)` on every call. The index
+keeps the classified dialog list in `user_sessions/dialogs_<user_id>.json` and
+serves it straight from memory/disk. Refreshes are incremental: dialogs come
+back from Telegram ordered by last activity, so we only walk until we reach
+dialogs whose top message hasn't changed since the last sync. A full rebuild
+runs periodically (to pick up deleted chats and renames) or on demand.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import pathlib
+import time
+from contextlib import AbstractContextManager, nullcontext
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+from telethon import TelegramClient
+
+import log_config
+import scheduler
+
+logger = logging.getLogger(__name__)
+item_log = log_config.item_logger(__name__)
+
+# Serve cached dialogs, but kick off a background incremental sync when older
+DIALOG_INDEX_TTL = int(os.getenv("DIALOG_INDEX_TTL", 300))  # seconds
+# Force a full rebuild in the background when the last one is older than this
+DIALOG_INDEX_FULL_TTL = int(os.getenv("DIALOG_INDEX_FULL_TTL", 6 * 3600))  # seconds
+# Stop an incremental walk after this many consecutive unchanged dialogs
+INCREMENTAL_STOP_AFTER = 3
+
+INDEX_VERSION = 1
+
+# Fields returned to Node by GET /dialogs (entityRoutes.js stores them as-is)
+PUBLIC_FIELDS = ("telegramId", "name", "username", "type", "accessHash")
+# Paginated responses also carry the flags the filters work on
+PAGE_FIELDS = PUBLIC_FIELDS + ("canSend", "archived", "folderId")
+
+DIALOG_TYPES = ("user", "group", "channel")
+MAX_PAGE_SIZE = 500
+
+
+def classify_dialog(dialog) -> Optional[dict]:
+    """
+    Turn a Telethon Dialog into an index entry.
+    Returns None for chats we've left or were kicked from.
+    """
+    entity = dialog.entity
+
+    item_log.debug("Inspecting dialog %s | %s", dialog.id, dialog.name)
+
+    # 1. Filter out chats we've left or are kicked from
+    if getattr(entity, 'left', False) or getattr(entity, 'kicked', False):
+        item_log.debug("Skipped dialog %s: left/kicked", dialog.id)
+        return None
+
+    # 2. Logic to determine if we can send messages
+    can_send = False
+    entity_type = "user"
+
+    if dialog.is_channel:
+        entity_type = "channel"
+        # Channel or Supergroup
+        if getattr(entity, 'broadcast', False):
+            # Broadcast Channel: Only Creator or Admin can post
+            if getattr(entity, 'creator', False) or (getattr(entity, 'admin_rights', None) and entity.admin_rights.post_messages):
+                can_send = True
+        elif getattr(entity, 'megagroup', False):
+            entity_type = "group"  # Supergroup treated as group
+            # Supergroup: we assume we can post unless specific restrictions exist.
+            can_send = True
+    elif dialog.is_group:
+        entity_type = "group"
+        # Basic Chat: Everyone can post usually
+        can_send = True
+    else:
+        # Users/Bots
+        can_send = True
+
+    # Extract username / access_hash safely
+    username = getattr(entity, "username", None)
+    access_hash = getattr(entity, "access_hash", None)
+
+    raw = getattr(dialog, "dialog", None)
+    top_message = getattr(raw, "top_message", None)
+    if top_message is None and getattr(dialog, "message", None) is not None:
+        top_message = dialog.message.id
+
+    return {
+        "telegramId": str(dialog.id),
+        "name": dialog.title or dialog.name or "Unknown",
+        "username": username,
+        "type": entity_type,
+        "accessHash": str(access_hash) if access_hash is not None else None,
+        "canSend": can_send,
+        "archived": getattr(dialog, "folder_id", None) == 1,
+        "folderId": getattr(dialog, "folder_id", None) or 0,
+        "pinned": bool(getattr(dialog, "pinned", False)),
+        "topMessageId": top_message,
+        "topDate": dialog.date.timestamp() if getattr(dialog, "date", None) else 0,
+    }
+
+
+def public_view(entry: dict, fields=PUBLIC_FIELDS) -> dict:
+    return {field: entry.get(field) for field in fields}
+
+
+def _sort_key(entry: dict):
+    # Same order Telegram uses: pinned first, then most recent activity.
+    # The id makes the order total so it can back a keyset cursor.
+    return (not entry.get("pinned"), -(entry.get("topDate") or 0), entry.get("telegramId"))
+
+
+def encode_cursor(entry: dict) -> str:
+    key = list(_sort_key(entry))
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Raises ValueError for anything that isn't a cursor we issued.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        pinned_last, neg_date, telegram_id = json.loads(base64.urlsafe_b64decode(padded))
+        return (bool(pinned_last), float(neg_date), str(telegram_id))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def filter_entries(entries: List[dict], types=None, can_send: Optional[bool] = True,
+                   query: str = None, prefix: str = None, archived: Optional[bool] = None,
+                   folder: Optional[int] = None) -> List[dict]:
+    """
+    Server-side filters for GET /dialogs. None means "don't filter on this".
+    Name matching is case-insensitive; `query` also matches usernames.
+    """
+    query = query.lower() if query else None
+    prefix = prefix.lower() if prefix else None
+    out = []
+
+    for entry in entries:
+        if types and entry["type"] not in types:
+            continue
+        if can_send is not None and entry["canSend"] != can_send:
+            continue
+        if archived is not None and entry.get("archived", False) != archived:
+            continue
+        if folder is not None and entry.get("folderId", 0) != folder:
+            continue
+
+        name = (entry.get("name") or "").lower()
+        username = (entry.get("username") or "").lower()
+        if prefix and not (name.startswith(prefix) or username.startswith(prefix)):
+            continue
+        if query and query not in name and query not in username:
+            continue
+        out.append(entry)
+
+    return out
+
+
+def paginate(entries: List[dict], limit: int, cursor: str = None):
+    """
+    Keyset pagination over entries already in index order.
+    Returns (page, next_cursor); next_cursor is None on the last page.
+    """
+    if cursor:
+        after = decode_cursor(cursor)
+        entries = [e for e in entries if _sort_key(e) > after]
+
+    page = entries[:limit]
+    next_cursor = encode_cursor(page[-1]) if len(entries) > limit else None
+    return page, next_cursor
+
+
+def _iso(ts: Optional[float]) -> Optional[str]:
+    if not ts:
+        return None
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
+
+class DialogIndex:
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self.synced_at: float = 0
+        self.full_synced_at: float = 0
+        self.lock = asyncio.Lock()
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.full_synced_at > 0
+
+    @property
+    def stale_since(self) -> Optional[str]:
+        """ISO timestamp of the last successful sync; data is current as of then."""
+        return _iso(self.synced_at)
+
+    def items(self) -> List[dict]:
+        return sorted(self.entries.values(), key=_sort_key)
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable dialog index %s: %s", self.path.name, e)
+            return
+        if data.get("version") != INDEX_VERSION:
+            return
+        self.entries = {e["telegramId"]: e for e in data.get("entries", [])}
+        self.synced_at = data.get("synced_at", 0)
+        self.full_synced_at = data.get("full_synced_at", 0)
+
+    def _dump(self) -> str:
+        return json.dumps({
+            "version": INDEX_VERSION,
+            "synced_at": self.synced_at,
+            "full_synced_at": self.full_synced_at,
+            "entries": self.items(),
+        })
+
+    async def save(self):
+        payload = self._dump()
+        tmp = self.path.with_suffix(".tmp")
+
+        def write():
+            tmp.write_text(payload)
+            os.replace(tmp, self.path)
+
+        await asyncio.to_thread(write)
+
+    async def refresh_full(self, client: TelegramClient):
+        entries = {}
+        async for dialog in client.iter_dialogs(limit=None, ignore_migrated=False, archived=None):
+            entry = classify_dialog(dialog)
+            if entry:
+                entries[entry["telegramId"]] = entry
+
+        now = time.time()
+        self.entries = entries
+        self.synced_at = self.full_synced_at = now
+        await self.save()
+        logger.info("Dialog index rebuilt: %d dialogs", len(entries))
+
+    async def refresh_incremental(self, client: TelegramClient):
+        changed = 0
+        unchanged_streak = 0
+
+        async for dialog in client.iter_dialogs(limit=None, ignore_migrated=False, archived=None):
+            dialog_id = str(dialog.id)
+            known = self.entries.get(dialog_id)
+            entry = classify_dialog(dialog)
+
+            if entry is None:
+                # Left/kicked since last sync
+                if self.entries.pop(dialog_id, None):
+                    changed += 1
+                continue
+
+            if known and known.get("topMessageId") == entry["topMessageId"]:
+                # Pinned dialogs are listed first regardless of activity,
+                # so they don't tell us we've caught up.
+                if not entry["pinned"]:
+                    unchanged_streak += 1
+                    if unchanged_streak >= INCREMENTAL_STOP_AFTER:
+                        break
+                if known == entry:
+                    continue
+            else:
+                unchanged_streak = 0
+
+            self.entries[dialog_id] = entry
+            changed += 1
+
+        self.synced_at = time.time()
+        await self.save()
+        logger.info("Dialog index refreshed incrementally: %d changed", changed)
+
+    async def refresh(self, client: TelegramClient, full: bool = False):
+        started = time.time()
+        async with self.lock:
+            # Single-flight: a sync that finished while we waited is good enough
+            if self.synced_at >= started and (not full or self.full_synced_at >= started):
+                return
+            if full or not self.loaded:
+                await self.refresh_full(client)
+            else:
+                await self.refresh_incremental(client)
+
+    def refresh_in_background(self, client: TelegramClient, full: bool = False,
+                              pin: AbstractContextManager = None):
+        """
+        Sync without blocking the caller. `pin` is held for the whole walk
+        (the pool's busy(), so the client isn't evicted and disconnected
+        halfway through).
+        """
+        if self.refresh_task and not self.refresh_task.done():
+            return
+
+        async def run():
+            # Background syncs yield to interactive requests for the same account
+            scheduler.current_priority.set(scheduler.BACKGROUND)
+            try:
+                with pin or nullcontext():
+                    await self.refresh(client, full=full)
+            except Exception as e:
+                logger.warning("Background dialog refresh failed: %s", e)
+
+        self.refresh_task = asyncio.create_task(run())
+
+
+class DialogIndexStore:
+    def __init__(self, directory: pathlib.Path, ttl: int = DIALOG_INDEX_TTL,
+                 full_ttl: int = DIALOG_INDEX_FULL_TTL,
+                 busy: Callable[[str], AbstractContextManager] = None):
+        self.directory = directory
+        self.busy = busy
+        self.ttl = ttl
+        self.full_ttl = full_ttl
+        self._indexes: Dict[str, DialogIndex] = {}
+
+    def index_for(self, user_id: str) -> DialogIndex:
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = DialogIndex(self.directory / f"dialogs_{user_id}.json")
+            index.load()
+            self._indexes[user_id] = index
+        return index
+
+    async def get(self, client: TelegramClient, user_id: str, refresh: str = None) -> DialogIndex:
+        """
+        Return the user's index, refreshed according to `refresh`:
+        - "full": rebuild from scratch before returning
+        - "incremental": walk recent dialogs before returning
+        - None: serve what we have; refresh in the background if stale.
+          Only the very first call for a user blocks on a full build.
+        """
+        index = self.index_for(user_id)
+
+        if refresh == "full":
+            await index.refresh(client, full=True)
+        elif not index.loaded:
+            await index.refresh(client)
+        elif refresh == "incremental":
+            await index.refresh(client)
+        else:
+            now = time.time()
+            pin = self.busy(user_id) if self.busy else None
+            if now - index.full_synced_at > self.full_ttl:
+                index.refresh_in_background(client, full=True, pin=pin)
+            elif now - index.synced_at > self.ttl:
+                index.refresh_in_background(client, pin=pin)
+
+        return index
+
+    def forget(self, user_id: str):
+        """
+        Drop a user's index from memory and disk (e.g. after logout).
+        """
+        index = self._indexes.pop(user_id, None)
+        path = index.path if index else self.directory / f"dialogs_{user_id}.json"
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,307 @@
+"""
+Per-account entity resolution with a persisted (id, access_hash) map.
+
+Endpoints used to fall back to `client.get_dialogs(limit=None)` whenever
+`get_input_entity` failed, once per unresolved peer. The resolver instead:
+1. uses pairs it learned before (from /dialogs, payloads and successful
+   lookups), kept in `user_sessions/entities_<user_id>.json`,
+2. builds the input peer straight from an access hash passed in the payload
+   (Node already has them from GET /dialogs),
+3. asks Telethon's session cache,
+4. and only then runs a warm-up, at most once per account per
+   ENTITY_WARMUP_WINDOW, shared by every caller that needs it.
+A stored pair is dropped when Telegram rejects it (see invalidate_on); only
+then does a payload hash take its place, so a stale payload can't evict a
+good pair.
+"""
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from telethon import TelegramClient, errors, types, utils
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+ENTITY_WARMUP_WINDOW = int(os.getenv("ENTITY_WARMUP_WINDOW", 300))  # seconds
+
+STORE_VERSION = 1
+
+# warmup(client, account) -> iterable of dialog index entries
+WarmupFn = Callable[[TelegramClient, str], Awaitable[Iterable[dict]]]
+
+# Telegram's answer to a peer whose id/access_hash pair is no longer usable
+PEER_INVALID = (errors.ChannelInvalidError, errors.ChannelPrivateError, errors.PeerIdInvalidError)
+
+
+def input_peer_for(marked_id: int, access_hash) -> Optional[types.TypeInputPeer]:
+    """
+    Build an InputPeer from a marked id (-100... channels, -... chats,
+    positive users) and its access hash. Returns None if a hash is required
+    but missing.
+    """
+    real_id, peer_type = utils.resolve_id(marked_id)
+    if peer_type is types.PeerChat:
+        return types.InputPeerChat(real_id)
+    if access_hash in (None, ""):
+        return None
+    if peer_type is types.PeerChannel:
+        return types.InputPeerChannel(real_id, int(access_hash))
+    return types.InputPeerUser(real_id, int(access_hash))
+
+
+def invalidate_on(resolve, chat_id, error: Exception) -> bool:
+    """
+    Forget chat_id's stored hash when `error` (or the error it was raised
+    from) says Telegram rejected the peer. `resolve` is the callback the
+    caller resolved with; only BoundResolver ones have anything to forget.
+    """
+    if not isinstance(error, PEER_INVALID) and not isinstance(error.__cause__, PEER_INVALID):
+        return False
+    invalidate = getattr(resolve, "invalidate", None)
+    return invalidate(chat_id) if invalidate else False
+
+
+def _marked_id(chat_id) -> Optional[int]:
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class EntityResolver:
+    def __init__(self, account: str, path: pathlib.Path, warmup: WarmupFn = None,
+                 window: int = ENTITY_WARMUP_WINDOW):
+        self.account = account
+        self.path = path
+        self.warmup = warmup
+        self.window = window
+
+        self.hashes: Dict[int, Optional[str]] = {}
+        self.warmed_at = 0.0
+        self._warmup_task: Optional[asyncio.Task] = None
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.warmups = 0
+        self.invalidated = 0
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable entity map %s: %s", self.path.name, e)
+            return
+        if data.get("version") == STORE_VERSION:
+            self.hashes = {int(k): v for k, v in data.get("peers", {}).items()}
+
+    def _write(self, payload: str):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(payload)
+        os.replace(tmp, self.path)
+
+    def _payload(self) -> str:
+        self._dirty = False
+        return json.dumps({
+            "version": STORE_VERSION,
+            "peers": {str(k): v for k, v in self.hashes.items()},
+        })
+
+    def flush(self):
+        """Synchronous save of pending changes (used at shutdown)."""
+        if self._dirty:
+            try:
+                self._write(self._payload())
+            except OSError as e:
+                logger.warning("Could not persist entity map: %s", e)
+
+    def _schedule_save(self):
+        self._dirty = True
+        if self._save_task and not self._save_task.done():
+            return
+
+        async def save():
+            # Coalesce bursts of learn() calls into one write
+            await asyncio.sleep(1)
+            try:
+                await asyncio.to_thread(self._write, self._payload())
+            except OSError as e:
+                logger.warning("Could not persist entity map: %s", e)
+
+        try:
+            self._save_task = asyncio.get_running_loop().create_task(save())
+        except RuntimeError:
+            pass  # No running loop (e.g. called at import time); saved on next learn
+
+    def learn(self, chat_id, access_hash) -> bool:
+        marked = _marked_id(chat_id)
+        if marked is None:
+            return False
+        access_hash = str(access_hash) if access_hash not in (None, "") else None
+        if access_hash is None and utils.resolve_id(marked)[1] is not types.PeerChat:
+            return False
+        if self.hashes.get(marked) == access_hash:
+            return False
+        self.hashes[marked] = access_hash
+        self._schedule_save()
+        return True
+
+    def invalidate(self, chat_id) -> bool:
+        """Drop a pair Telegram rejected; the next resolve() looks the peer up again."""
+        marked = _marked_id(chat_id)
+        if marked is None or marked not in self.hashes:
+            return False
+        del self.hashes[marked]
+        self.invalidated += 1
+        logger.info("Forgot rejected access hash of %s", marked, extra={"account": self.account})
+        self._schedule_save()
+        return True
+
+    def learn_dialogs(self, entries: Iterable[dict]):
+        for entry in entries:
+            self.learn(entry.get("telegramId"), entry.get("accessHash"))
+
+    def _remember_input_peer(self, chat_id, peer):
+        if isinstance(peer, (types.InputPeerChannel, types.InputPeerUser)):
+            self.learn(utils.get_peer_id(peer), peer.access_hash)
+        elif isinstance(peer, types.InputPeerChat):
+            self.learn(utils.get_peer_id(peer), None)
+
+    def _from_known(self, chat_id) -> Optional[types.TypeInputPeer]:
+        marked = _marked_id(chat_id)
+        if marked is None or marked not in self.hashes:
+            return None
+        return input_peer_for(marked, self.hashes[marked])
+
+    async def _warm_up(self, client: TelegramClient):
+        """
+        One shared warm-up per window; concurrent callers await the same task.
+        """
+        if self._warmup_task and not self._warmup_task.done():
+            await asyncio.shield(self._warmup_task)
+            return
+        if self.warmup is None or time.monotonic() - self.warmed_at < self.window:
+            return
+
+        async def run():
+            self.warmups += 1
+            self.warmed_at = time.monotonic()
+            logger.info("Warming entity cache from dialogs", extra={"account": self.account})
+            self.learn_dialogs(await self.warmup(client, self.account))
+
+        self._warmup_task = asyncio.create_task(run())
+        await asyncio.shield(self._warmup_task)
+
+    async def resolve(self, client: TelegramClient, chat_id, access_hash=None):
+        """
+        Return an InputPeer for chat_id (marked id or username).
+        Raises ValueError like Telethon's "Cannot find any entity" when it
+        can't be resolved.
+        """
+        with telemetry.phase("resolve"):
+            return await self._resolve(client, chat_id, access_hash)
+
+    async def _resolve(self, client: TelegramClient, chat_id, access_hash=None):
+        marked = _marked_id(chat_id)
+
+        # The stored pair goes first: whatever Telegram rejects after this
+        # call is then the hash invalidate() removes
+        peer = self._from_known(chat_id)
+        if peer is not None:
+            self.hits += 1
+            return peer
+
+        if marked is not None and access_hash not in (None, ""):
+            peer = input_peer_for(marked, access_hash)
+            if peer is not None:
+                self.learn(marked, access_hash)
+                self.hits += 1
+                return peer
+
+        target = marked if marked is not None else chat_id
+        try:
+            peer = await client.get_input_entity(target)
+        except ValueError as first_error:
+            try:
+                await self._warm_up(client)
+            except Exception as e:
+                logger.warning("Entity warm-up failed: %s", e, extra={"account": self.account})
+            peer = self._from_known(chat_id)
+            if peer is not None:
+                return peer
+            try:
+                peer = await client.get_input_entity(target)
+            except ValueError:
+                raise first_error
+
+        self._remember_input_peer(chat_id, peer)
+        return peer
+
+    def bind(self, client: TelegramClient) -> "BoundResolver":
+        return BoundResolver(self, client)
+
+    def stats(self) -> dict:
+        return {"known": len(self.hashes), "hits": self.hits, "warmups": self.warmups,
+                "invalidated": self.invalidated}
+
+
+class BoundResolver:
+    """
+    The resolve(chat_id, access_hash) callback taken by analytics_engine,
+    delete_pipeline and channel_stats, for one client. invalidate(chat_id)
+    lets them report peers Telegram rejected.
+    """
+
+    def __init__(self, resolver: EntityResolver, client: TelegramClient):
+        self.resolver = resolver
+        self.client = client
+
+    def __call__(self, chat_id, access_hash=None):
+        return self.resolver.resolve(self.client, chat_id, access_hash)
+
+    def invalidate(self, chat_id) -> bool:
+        return self.resolver.invalidate(chat_id)
+
+
+class ResolverStore:
+    def __init__(self, directory: pathlib.Path, warmup: WarmupFn = None):
+        self.directory = directory
+        self.warmup = warmup
+        self._resolvers: Dict[str, EntityResolver] = {}
+
+    def get(self, account: str) -> EntityResolver:
+        resolver = self._resolvers.get(account)
+        if resolver is None:
+            resolver = EntityResolver(account, self.directory / f"entities_{account}.json", self.warmup)
+            self._resolvers[account] = resolver
+        return resolver
+
+    def forget(self, account: str):
+        resolver = self._resolvers.pop(account, None)
+        path = resolver.path if resolver else self.directory / f"entities_{account}.json"
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        for resolver in self._resolvers.values():
+            resolver.flush()
+
+    def stats(self) -> dict:
+        return {
+            "accounts": len(self._resolvers),
+            "known": sum(len(r.hashes) for r in self._resolvers.values()),
+            "hits": sum(r.hits for r in self._resolvers.values()),
+            "warmups": sum(r.warmups for r in self._resolvers.values()),
+            "invalidated": sum(r.invalidated for r in self._resolvers.values()),
+        }
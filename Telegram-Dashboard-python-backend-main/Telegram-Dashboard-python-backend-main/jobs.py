@@ -0,0 +1,452 @@
+"""
+Background jobs for long-running operations.
+
+Big dialog syncs, analytics batches, bulk deletes and channel stats used to
+run inside the HTTP request, so Node's request timeouts (or the platform
+router's) killed them halfway and a retry started over from zero. Instead
+they can be submitted as jobs:
+- submit() returns a job id at once; the work runs in the background on a
+  per-account executor (at most JOB_CONCURRENCY running jobs per account,
+  JOB_QUEUE_MAX queued or running),
+- callers poll GET /jobs/{id}, long-poll it with ?since=<version>&wait=, or
+  follow GET /jobs/{id}/events (Server-Sent Events),
+- handlers checkpoint partial results through JobContext.save(); jobs and
+  checkpoints are persisted in `user_sessions/jobs_<user_id>.json`, so a job
+  interrupted by a restart or a failure resumes where it stopped,
+- submitting the same kind and parameters again returns the running job (or
+  one finished in the last JOB_DEDUP_WINDOW) instead of starting another;
+  a failed one is resumed from its checkpoint.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+import uuid
+from contextlib import AbstractContextManager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Jobs running at once per account; the rest wait in its queue
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 2))
+# Queued + running jobs per account before submit() refuses more
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", 20))
+# Finished jobs are kept this long for polling
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))  # seconds
+# An identical submission within this long after a job finished gets its result
+JOB_DEDUP_WINDOW = int(os.getenv("JOB_DEDUP_WINDOW", 600))  # seconds
+# Checkpoints are written at most this often
+JOB_SAVE_DELAY = 2  # seconds
+# SSE comment sent when nothing changed for this long
+JOB_KEEPALIVE = 15  # seconds
+
+STORE_VERSION = 1
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+# Never returned to callers
+PRIVATE_FIELDS = ("key", "account", "params", "checkpoint")
+
+
+class JobQueueFull(Exception):
+    """The account already has JOB_QUEUE_MAX jobs queued or running."""
+
+
+class UnknownJobKind(ValueError):
+    pass
+
+
+def job_key(kind: str, params: dict) -> str:
+    """Identity of a submission, for deduplication."""
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(f"{kind}\n{canonical}".encode()).hexdigest()
+
+
+class JobContext:
+    """What a handler gets: its parameters, the last checkpoint and progress reporting."""
+
+    def __init__(self, store: "JobStore", job: dict):
+        self._store = store
+        self._job = job
+        self.account: str = job["account"]
+        self.params: dict = job["params"]
+
+    @property
+    def checkpoint(self) -> dict:
+        """Checkpoint saved by a previous attempt of this job ({} on the first)."""
+        return self._job.get("checkpoint") or {}
+
+    def progress(self, done: int, total: int, partial=None):
+        self._job["progress"] = {"done": done, "total": total}
+        if partial is not None:
+            self._job["result"] = partial
+        self._store._changed(self._job)
+
+    def save(self, checkpoint: dict, done: int = None, total: int = None, partial=None):
+        """Record resumable state (and optionally progress / partial result)."""
+        self._job["checkpoint"] = checkpoint
+        if done is not None:
+            self.progress(done, total if total is not None else done, partial)
+        else:
+            self._store._changed(self._job)
+        self._store._schedule_save(self.account)
+
+
+Handler = Callable[[JobContext], Awaitable[object]]
+
+
+class _AccountJobs:
+    def __init__(self, path: pathlib.Path, concurrency: int):
+        self.path = path
+        self.jobs: Dict[str, dict] = {}
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.dirty = False
+        self.save_task: Optional[asyncio.Task] = None
+        # job id -> (version, encoded job, encoded params), see JobStore._payload
+        self.encoded: Dict[str, Tuple[int, str, str]] = {}
+
+
+class JobStore:
+    def __init__(self, directory: pathlib.Path, busy: Callable[[str], AbstractContextManager],
+                 concurrency: int = JOB_CONCURRENCY, queue_max: int = JOB_QUEUE_MAX,
+                 ttl: int = JOB_TTL, dedup_window: int = JOB_DEDUP_WINDOW):
+        self.directory = directory
+        self.busy = busy
+        self.concurrency = concurrency
+        self.queue_max = queue_max
+        self.ttl = ttl
+        self.dedup_window = dedup_window
+        self._handlers: Dict[str, Handler] = {}
+        self._accounts: Dict[str, _AccountJobs] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._events: Dict[str, asyncio.Event] = {}
+        self._closing = False
+
+        self.submitted = 0
+        self.deduplicated = 0
+        self.resumed = 0
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    @property
+    def kinds(self) -> List[str]:
+        return list(self._handlers)
+
+    # Persistence
+
+    def _account(self, account: str) -> _AccountJobs:
+        state = self._accounts.get(account)
+        if state is None:
+            state = self._accounts[account] = _AccountJobs(self.directory / f"jobs_{account}.json",
+                                                           self.concurrency)
+            self._load(account, state)
+        return state
+
+    def _load(self, account: str, state: _AccountJobs):
+        if not state.path.exists():
+            return
+        try:
+            data = json.loads(state.path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable job store %s: %s", state.path.name, e)
+            return
+        if data.get("version") != STORE_VERSION:
+            return
+        for job in data.get("jobs", []):
+            job["account"] = account
+            state.jobs[job["id"]] = job
+
+    def _payload(self, state: _AccountJobs) -> str:
+        """
+        The store file, built on the event loop every JOB_SAVE_DELAY while a
+        job runs. A job is encoded again only when its version changed, and
+        its params (thousands of items, fixed at submit) only once.
+        """
+        state.dirty = False
+        encoded = {}
+        for job_id, job in state.jobs.items():
+            cached = state.encoded.get(job_id)
+            if cached is None or cached[0] != job["version"]:
+                params = cached[2] if cached else json.dumps(job["params"], default=str)
+                fields = {k: v for k, v in job.items() if k not in ("account", "params")}
+                if job["status"] in ACTIVE:
+                    # A partial result is reported again from the checkpoint on resume
+                    fields["result"] = None
+                body = json.dumps(fields, default=str)
+                cached = (job["version"], f'{body[:-1]}, "params": {params}}}', params)
+            encoded[job_id] = cached
+        state.encoded = encoded
+        jobs = ", ".join(cached[1] for cached in encoded.values())
+        return f'{{"version": {STORE_VERSION}, "jobs": [{jobs}]}}'
+
+    @staticmethod
+    def _write(path: pathlib.Path, payload: str):
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(payload)
+        os.replace(tmp, path)
+
+    def _schedule_save(self, account: str):
+        state = self._accounts.get(account)
+        if state is None:
+            return  # Forgotten (logout) while a job was winding down
+        state.dirty = True
+        if state.save_task and not state.save_task.done():
+            return
+
+        async def save():
+            await asyncio.sleep(JOB_SAVE_DELAY)
+            try:
+                await asyncio.to_thread(self._write, state.path, self._payload(state))
+            except OSError as e:
+                logger.warning("Could not persist jobs: %s", e, extra={"account": account})
+
+        state.save_task = asyncio.create_task(save())
+
+    def _flush(self, state: _AccountJobs):
+        if state.dirty:
+            try:
+                self._write(state.path, self._payload(state))
+            except OSError as e:
+                logger.warning("Could not persist jobs: %s", e)
+
+    # Lifecycle
+
+    def _prune(self, state: _AccountJobs):
+        now = time.time()
+        expired = [job_id for job_id, job in state.jobs.items()
+                   if job["status"] not in ACTIVE and now - (job.get("finished_at") or now) > self.ttl]
+        for job_id in expired:
+            del state.jobs[job_id]
+            self._events.pop(job_id, None)
+        if expired:
+            state.dirty = True
+
+    def _changed(self, job: dict):
+        job["version"] = job.get("version", 0) + 1
+        event = self._events.pop(job["id"], None)
+        if event is not None:
+            event.set()
+
+    def submit(self, account: str, kind: str, params: dict, force: bool = False) -> Tuple[dict, bool]:
+        """
+        Queue a job. Returns (view, deduplicated). With force=True an
+        identical running/finished job is ignored and a new one started.
+        """
+        if kind not in self._handlers:
+            raise UnknownJobKind(f"Unknown job kind: {kind}")
+        state = self._account(account)
+        self._prune(state)
+        key = job_key(kind, params)
+
+        if not force:
+            now = time.time()
+            for job in sorted(state.jobs.values(), key=lambda j: -j["created_at"]):
+                if job["key"] != key:
+                    continue
+                if job["status"] in ACTIVE or (
+                        job["status"] == DONE and now - job["finished_at"] < self.dedup_window):
+                    self.deduplicated += 1
+                    return self.view(job), True
+                if job["status"] in (FAILED, CANCELLED):
+                    # Pick up from its checkpoint instead of starting over
+                    self._check_capacity(state)
+                    self.deduplicated += 1
+                    self.resumed += 1
+                    self._requeue(job)
+                    return self.view(job), True
+                break
+
+        self._check_capacity(state)
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "key": key,
+            "account": account,
+            "params": params,
+            "status": QUEUED,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "attempts": 0,
+            "version": 0,
+            "progress": {"done": 0, "total": 0},
+            "result": None,
+            "error": None,
+            "checkpoint": None,
+        }
+        state.jobs[job["id"]] = job
+        self.submitted += 1
+        self._start(job)
+        self._schedule_save(account)
+        return self.view(job), False
+
+    def _check_capacity(self, state: _AccountJobs):
+        active = sum(1 for job in state.jobs.values() if job["status"] in ACTIVE)
+        if active >= self.queue_max:
+            raise JobQueueFull(f"Too many jobs in progress ({active}), retry later")
+
+    def _requeue(self, job: dict):
+        job.update({"status": QUEUED, "error": None, "finished_at": None})
+        self._changed(job)
+        self._start(job)
+        self._schedule_save(job["account"])
+
+    def _start(self, job: dict):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["id"], None))
+
+    async def _run(self, job: dict):
+        account = job["account"]
+        state = self._account(account)
+        async with state.semaphore:
+            if job["status"] != QUEUED:
+                return
+            job.update({"status": RUNNING, "started_at": time.time()})
+            job["attempts"] += 1
+            self._changed(job)
+            try:
+                # Pinned in the pool; interactive requests go first
+                with self.busy(account), scheduler.priority(scheduler.BACKGROUND):
+                    result = await self._handlers[job["kind"]](JobContext(self, job))
+            except asyncio.CancelledError:
+                # Shutdown leaves the job queued so resume() restarts it
+                job["status"] = QUEUED if self._closing else CANCELLED
+                raise
+            except scheduler.Throttled as e:
+                job.update({"status": FAILED, "error": str(e), "retry_after": e.retry_after})
+            except Exception as e:
+                logger.exception("Job %s (%s) failed: %s", job["id"], job["kind"], e)
+                job.update({"status": FAILED, "error": str(e)})
+            else:
+                job.update({"status": DONE, "result": result, "checkpoint": None})
+            finally:
+                if job["status"] != QUEUED:
+                    job["finished_at"] = time.time()
+                self._changed(job)
+                if not self._closing:
+                    self._schedule_save(account)
+
+    # Reading
+
+    def get(self, account: str, job_id: str, kind: str = None) -> Optional[dict]:
+        job = self._account(account).jobs.get(job_id)
+        if job is None or (kind and job["kind"] != kind):
+            return None
+        return job
+
+    @staticmethod
+    def view(job: dict, result: bool = True) -> dict:
+        view = {k: v for k, v in job.items() if k not in PRIVATE_FIELDS}
+        if not result:
+            view.pop("result", None)
+        return view
+
+    def list(self, account: str) -> List[dict]:
+        state = self._account(account)
+        self._prune(state)
+        jobs = sorted(state.jobs.values(), key=lambda j: -j["created_at"])
+        return [self.view(job, result=False) for job in jobs]
+
+    async def wait(self, job: dict, since: int, timeout: float) -> dict:
+        """
+        Return the job once its version is past `since` (or it finished),
+        waiting at most `timeout` seconds.
+        """
+        if job["version"] <= since and job["status"] in ACTIVE and timeout > 0:
+            event = self._events.setdefault(job["id"], asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    async def events(self, job: dict) -> AsyncIterator[Optional[dict]]:
+        """
+        Views of the job as it changes, ending with the finished job (with its
+        result). Yields None when nothing changed for JOB_KEEPALIVE seconds.
+        """
+        version = -1
+        while True:
+            if job["version"] > version:
+                version = job["version"]
+                finished = job["status"] not in ACTIVE
+                yield self.view(job, result=finished)
+                if finished:
+                    return
+            else:
+                yield None
+            await self.wait(job, version, JOB_KEEPALIVE)
+
+    def cancel(self, job: dict) -> dict:
+        task = self._tasks.get(job["id"])
+        if task is not None:
+            task.cancel()
+        if job["status"] == QUEUED:
+            job.update({"status": CANCELLED, "finished_at": time.time()})
+            self._changed(job)
+        self._schedule_save(job["account"])
+        return self.view(job, result=False)
+
+    def resume(self, owns: Callable[[str], bool] = None):
+        """
+        Restart jobs that were queued or running when the process stopped
+        (only for accounts `owns` accepts, when sharded).
+        """
+        for path in self.directory.glob("jobs_*.json"):
+            account = path.stem[len("jobs_"):]
+            if owns is not None and not owns(account):
+                continue
+            for job in self._account(account).jobs.values():
+                if job["status"] in ACTIVE and job["kind"] in self._handlers:
+                    self.resumed += 1
+                    job["status"] = QUEUED
+                    logger.info("Resuming job %s (%s)", job["id"], job["kind"], extra={"account": account})
+                    self._start(job)
+
+    def forget(self, account: str):
+        state = self._accounts.pop(account, None)
+        if state is not None:
+            if state.save_task is not None:
+                state.save_task.cancel()
+            for job_id in state.jobs:
+                task = self._tasks.get(job_id)
+                if task is not None:
+                    task.cancel()
+        path = state.path if state else self.directory / f"jobs_{account}.json"
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    async def close(self):
+        self._closing = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for state in self._accounts.values():
+            state.dirty = True
+            self._flush(state)
+
+    def stats(self) -> dict:
+        jobs = [job for state in self._accounts.values() for job in state.jobs.values()]
+        return {
+            "accounts": len(self._accounts),
+            "queued": sum(1 for job in jobs if job["status"] == QUEUED),
+            "running": sum(1 for job in jobs if job["status"] == RUNNING),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "resumed": self.resumed,
+        }
@@ -0,0 +1,185 @@
+"""
+Structured, leveled logging for the Telethon service.
+
+- Records are formatted as one JSON object per line with user_id, endpoint and
+  duration_ms (when known), taken from per-request context variables.
+- Handlers never write on the event loop: records go through a QueueHandler and
+  a QueueListener thread does the actual stdout I/O.
+- DEBUG/INFO records can be sampled per endpoint; WARNING and above always pass.
+- Per-item debug output (one line per dialog/message/graph) goes to the
+  `items.*` logger tree, which is off by default and can be switched on at
+  runtime with set_item_debug() (exposed as POST /admin/logging).
+
+Env:
+    LOG_LEVEL=INFO
+    LOG_ITEM_DEBUG=false
+    LOG_SAMPLE_RATES=/analytics=0.1,/analytics/batch=0.5
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from typing import Dict, Optional
+
+request_user_id: contextvars.ContextVar = contextvars.ContextVar("request_user_id", default=None)
+request_endpoint: contextvars.ContextVar = contextvars.ContextVar("request_endpoint", default=None)
+
+ITEM_LOGGER = "items"
+
+# Attributes every LogRecord has; anything else was passed via `extra=`
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_sampler: Optional["EndpointSampler"] = None
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        endpoint, rate = part.split("=", 1)
+        try:
+            rates[endpoint.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Stamp the current request's user/endpoint onto every record."""
+
+    def filter(self, record):
+        if not hasattr(record, "user_id"):
+            record.user_id = request_user_id.get()
+        if not hasattr(record, "endpoint"):
+            record.endpoint = request_endpoint.get()
+        return True
+
+
+class EndpointSampler(logging.Filter):
+    """Keep only a fraction of DEBUG/INFO records for noisy endpoints."""
+
+    def __init__(self, rates: Dict[str, float] = None):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, "endpoint", None) or request_endpoint.get())
+        if rate is None:
+            return True
+        return random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key in _RESERVED or value is None:
+                continue
+            entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging():
+    """
+    Install the queue-backed JSON handler on the root logger. Idempotent.
+    """
+    global _listener, _sampler
+    if _listener is not None:
+        return
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Context must be captured on the calling task, before the record is queued
+    queue_handler.addFilter(ContextFilter())
+    _sampler = EndpointSampler(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")))
+    queue_handler.addFilter(_sampler)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    # Telethon is chatty at INFO (connection/migration messages)
+    logging.getLogger("telethon").setLevel(logging.WARNING)
+
+    set_item_debug(os.getenv("LOG_ITEM_DEBUG", "false").lower() in ("1", "true", "yes"))
+
+
+def shutdown_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def item_logger(name: str) -> logging.Logger:
+    """
+    Logger for per-item debug lines; silent unless item debug is switched on.
+    """
+    return logging.getLogger(f"{ITEM_LOGGER}.{name}")
+
+
+def set_item_debug(enabled: bool):
+    logging.getLogger(ITEM_LOGGER).setLevel(logging.DEBUG if enabled else logging.WARNING)
+
+
+def set_level(level: str):
+    logging.getLogger().setLevel(level.upper())
+
+
+def set_sample_rates(rates: Dict[str, float]):
+    if _sampler is not None:
+        _sampler.rates = {k: min(max(float(v), 0.0), 1.0) for k, v in rates.items()}
+
+
+def current_settings() -> dict:
+    return {
+        "level": logging.getLevelName(logging.getLogger().level),
+        "item_debug": logging.getLogger(ITEM_LOGGER).level <= logging.DEBUG,
+        "sample_rates": dict(_sampler.rates) if _sampler else {},
+    }
+
+
+class RequestContext:
+    """
+    Bind user_id/endpoint for the duration of a request and time it.
+    """
+
+    def __init__(self, user_id: Optional[str], endpoint: str):
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.started = 0.0
+        self._tokens = ()
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self._tokens = (request_user_id.set(self.user_id), request_endpoint.set(self.endpoint))
+        return self
+
+    def __exit__(self, *exc):
+        request_user_id.reset(self._tokens[0])
+        request_endpoint.reset(self._tokens[1])
+
+    @property
+    def duration_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 2)
@@ -1,24 +1,58 @@
 from fastapi import FastAPI, HTTPException, Body, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from telethon import TelegramClient, functions, types
-import uvicorn
+from starlette.datastructures import Headers
+from telethon import TelegramClient, events, functions, types
 import os
 import asyncio
 from dotenv import load_dotenv
-from typing import Dict
+from typing import Dict, List, Union
 import pathlib
+import logging
+
+import log_config
+import telemetry
+from telemetry import TimedJSONResponse
+import analytics_engine
+import task_rollup
+from client_pool import ClientPool, PoolExhausted
+import scheduler
+from scheduler import Throttled, schedulers
+import dialog_index
+from metrics_cache import MetricsCache, annotate, cache_key
+from entity_resolver import ResolverStore, invalidate_on
+import delete_pipeline
+import jobs as job_queue
+from jobs import JobQueueFull, JobStore
+from tracker import TrackerStore
+import timeseries
+import sharding
+from sharding import SessionLeased
+from session_store import SessionStore
+from warmup import ActivityLog, Warmup
+from auth_state import AuthState
+from channel_stats import STATS_BATCH_CONCURRENCY, ChannelStatsStore, StatsUnavailable
+import schemas
+from schemas import (
+    ChannelGrowthRequest, ChannelRef, ChannelStatsBatchRequest, ChannelStatsRequest, CodeRequest,
+    CredentialsRequest, DeleteRequest, LoggingSettingsRequest, SignInRequest,
+)
 
 # Load env variables initially
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 
+log_config.setup_logging()
+logger = logging.getLogger("main")
+item_log = log_config.item_logger("main")
+
 # Global State
 API_ID = os.getenv('API_ID')
 API_HASH = os.getenv('API_HASH')
 BACKEND_URL = os.getenv('BACKEND_URL')
 FRONTEND_URL = os.getenv('FRONTEND_URL')
 
-app = FastAPI()
+# JSON rendering is timed as the "serialize" phase in Server-Timing
+app = FastAPI(default_response_class=TimedJSONResponse)
 
 # Strict CORS
 origins = [
@@ -34,9 +68,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-clients: Dict[str, TelegramClient] = {}
-session_dir = pathlib.Path(__file__).parent / "user_sessions"
-session_dir.mkdir(exist_ok=True)
+session_dir = pathlib.Path(os.getenv("SESSION_DIR", pathlib.Path(__file__).parent / "user_sessions"))
+session_dir.mkdir(parents=True, exist_ok=True)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
 
 def get_user_id_from_request(request: Request) -> str:
     user_id = request.headers.get("x-user-id")
@@ -44,9 +79,191 @@ def get_user_id_from_request(request: Request) -> str:
         raise HTTPException(status_code=400, detail="x-user-id header required")
     return user_id
 
+def http_error(e: Exception, status_code: int = 500) -> HTTPException:
+    """
+    Map an exception caught in an endpoint to the HTTPException to raise.
+    HTTPExceptions pass through and FloodWaits become 429 + Retry-After.
+    """
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, Throttled):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return HTTPException(status_code=status_code, detail=str(e))
+
+def throttle_headers(user_id: str) -> dict:
+    """
+    Retry-After for responses that succeeded partially while the account is
+    in a FloodWait pause.
+    """
+    account = schedulers.peek(user_id)
+    retry_after = account.retry_after() if account else 0
+    return {"Retry-After": str(retry_after)} if retry_after else {}
+
+# Which users this process serves when running several shards, and the
+# per-session locks that keep a session open in one process only (see sharding.py)
+shards = sharding.ShardMap()
+leases = sharding.SessionLeases(session_dir)
+
+# File, in-memory or shared session storage (see session_store.py)
+session_store = SessionStore(session_dir)
+
+async def build_client(user_id: str, api_id: str, api_hash: str) -> TelegramClient:
+    leases.acquire(user_id)
+    try:
+        session = await session_store.open(user_id)
+        # Every RPC goes through the account's rate limiter / FloodWait backoff
+        client = scheduler.ScheduledTelegramClient(
+            session, int(api_id), api_hash, scheduler=schedulers.get(user_id)
+        )
+    except Exception:
+        await client_closed(user_id)
+        raise
+
+    async def on_self_update(update):
+        auth.on_update(user_id, update)
+
+    client.add_event_handler(on_self_update, events.Raw(types=[types.UpdateUserName, types.UpdateUser]))
+    logger.info("Telethon client initialized")
+    return client
+
+async def client_closed(user_id: str):
+    auth.forget(user_id)
+    # Snapshot before giving up the lease so the next owner sees it
+    await session_store.release(user_id)
+    leases.release(user_id)
+
+# Authorization and identity per account, so status polls don't cost RPCs (see auth_state.py)
+auth = AuthState()
+
+# Every RPC attempt feeds /metrics and the request's Server-Timing (see telemetry.py)
+schedulers.on_rpc = telemetry.registry.observe_rpc
+schedulers.on_unauthorized = auth.unauthorized
+
+# Bounded, LRU/idle-evicting pool of per-user clients (see client_pool.py)
+pool = ClientPool(build_client, on_close=client_closed)
+
+
+class PoolBusyMiddleware:
+    """
+    Pins the caller's client in the pool for the whole request, including
+    streamed bodies, so capacity/idle eviction never disconnects it mid-call.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        user_id = None
+        if scope["type"] == "http":
+            user_id = Headers(scope=scope).get("x-user-id")
+        if not user_id:
+            return await self.app(scope, receive, send)
+        with pool.busy(user_id):
+            await self.app(scope, receive, send)
+
+
+class RequestLogMiddleware:
+    """
+    Binds user_id/endpoint to every log record emitted while handling the
+    request and writes one access line with the duration once the response
+    (streamed or not) is finished.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        user_id = Headers(scope=scope).get("x-user-id")
+        with log_config.RequestContext(user_id, scope["path"]) as ctx:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                logger.info(
+                    "%s %s %s", scope["method"], scope["path"], status["code"],
+                    extra={"status": status["code"], "duration_ms": ctx.duration_ms}
+                )
+
+
+# Interactive endpoints are admitted ahead of bulk/background work when an
+# account's request budget is contended. Anything unlisted is NORMAL.
+ROUTE_PRIORITIES = {
+    "/": scheduler.INTERACTIVE,
+    "/dialogs": scheduler.INTERACTIVE,
+    "/analytics": scheduler.BACKGROUND,
+}
+
+class PriorityMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        level = scheduler.INTERACTIVE if path.startswith("/auth/") else ROUTE_PRIORITIES.get(path, scheduler.NORMAL)
+        with scheduler.priority(level):
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(PriorityMiddleware)
+app.add_middleware(PoolBusyMiddleware)
+app.add_middleware(sharding.ShardMiddleware, shards=shards)
+app.add_middleware(RequestLogMiddleware)
+app.add_middleware(telemetry.TelemetryMiddleware)
+
+@app.exception_handler(Throttled)
+async def throttled_handler(request: Request, exc: Throttled):
+    return TimedJSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# Persisted per-user dialog lists behind GET /dialogs (see dialog_index.py)
+dialog_indexes = dialog_index.DialogIndexStore(session_dir, busy=pool.busy)
+
+# History of every fetched snapshot, rolled up hourly/daily (see timeseries.py)
+metrics_store = timeseries.MetricsStore(
+    pathlib.Path(os.getenv("METRICS_DB_PATH", session_dir / "metrics.sqlite3"))
+)
+
+# Parsed /channel-stats results and async graph loads (see channel_stats.py)
+channel_stats = ChannelStatsStore(pool.busy, on_counts=metrics_store.record_channel)
+
+MIN_GRAPH_POINTS = 10
+
+# Short-TTL message metrics shared by /analytics and /analytics/batch; every
+# fresh fetch is also recorded in metrics_store
+metrics_cache = MetricsCache(on_put=metrics_store.record)
+
+async def warm_entities(client: TelegramClient, user_id: str):
+    # Reuses (and refreshes) the /dialogs index instead of a separate crawl
+    index = await dialog_indexes.get(client, user_id, refresh="incremental")
+    return index.items()
+
+# Known (id, access_hash) pairs per account, shared by every endpoint that
+# takes a recipient/channel id (see entity_resolver.py)
+resolvers = ResolverStore(session_dir, warmup=warm_entities)
+
+def peer_resolver(client: TelegramClient, user_id: str):
+    return resolvers.get(user_id).bind(client)
+
+# Accounts that used their client recently, reconnected at startup (see warmup.py)
+activity = ActivityLog(session_dir, shard=shards.index if shards.enabled else None)
+
 async def get_or_init_client(user_id: str, api_id: str = None, api_hash: str = None) -> TelegramClient:
-    if user_id in clients and clients[user_id].is_connected():
-        return clients[user_id]
+    activity.touch(user_id)
+    client = pool.peek(user_id)
+    if client and client.is_connected():
+        return await pool.get(user_id, api_id, api_hash)
 
     # Load per-user credentials if not provided
     if not api_id or not api_hash:
@@ -58,69 +275,400 @@ async def get_or_init_client(user_id: str, api_id: str = None, api_hash: str = N
     if not api_id or not api_hash:
         raise HTTPException(status_code=400, detail="API credentials not configured for user")
 
-    session_path = session_dir / f"session_{user_id}"
-
-    client = TelegramClient(str(session_path), int(api_id), api_hash)
-    await client.connect()
-    clients[user_id] = client
-    print(f"✅ Telethon Client Initialized for user {user_id}")
+    try:
+        return await pool.get(user_id, api_id, api_hash)
+    except PoolExhausted as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except SessionLeased as e:
+        # Still open in the shard that owned it before a restart/resize
+        raise HTTPException(status_code=503, detail=str(e), headers={
+            "Retry-After": "5", sharding.OWNER_HEADER: str(shards.owner(user_id))
+        })
+
+# Messages registered with POST /analytics/track, refreshed server-side
+# (see tracker.py)
+trackers = TrackerStore(session_dir, get_or_init_client, pool.busy,
+                        cache=metrics_cache, resolver_for=peer_resolver)
+
+# Long-running work submitted with ?mode=async, polled at /jobs/{id} (see jobs.py)
+jobs = JobStore(session_dir, pool.busy)
+
+async def job_client(ctx: job_queue.JobContext) -> TelegramClient:
+    client = await get_or_init_client(ctx.account)
+    if not await auth.authorized(client, ctx.account):
+        raise PermissionError("Userbot not authorized")
     return client
 
+async def dialogs_job(ctx: job_queue.JobContext):
+    client = await job_client(ctx)
+    index = await dialog_indexes.get(client, ctx.account, refresh=ctx.params.get("refresh"))
+    resolvers.get(ctx.account).learn_dialogs(index.items())
+    return {"total": len(index.items()), "stale_since": index.stale_since}
+
+async def analytics_batch_job(ctx: job_queue.JobContext):
+    client = await job_client(ctx)
+    items = ctx.params["items"]
+    groups = analytics_engine.group_by_peer(items)
+    hashes = analytics_engine.access_hashes(items)
+    total = sum(len(ids) for ids in groups.values())
+
+    # Checkpoint: metrics fetched so far by composite key; failures are retried
+    fetched = dict(ctx.checkpoint.get("metrics", {}))
+    pending = [{"recipientId": chat_id, "messageId": msg_id, "accessHash": hashes.get(chat_id)}
+               for chat_id, ids in groups.items() for msg_id in ids
+               if analytics_engine.composite_key(chat_id, msg_id) not in fetched]
+    done = total - len(pending)
+    ctx.progress(done, total)
+
+    fields = tuple(ctx.params.get("fields") or analytics_engine.METRIC_FIELDS)
+    async for entry in analytics_engine.iter_batch(client, pending, cache=metrics_cache, account=ctx.account,
+                                                   fresh=ctx.params.get("fresh", False),
+                                                   resolve=peer_resolver(client, ctx.account), fields=fields):
+        done += 1
+        if "error" in entry:
+            ctx.progress(done, total)
+            continue
+        fetched[analytics_engine.composite_key(entry["recipientId"], entry["messageId"])] = entry["metrics"]
+        ctx.save({"metrics": fetched}, done, total)
+
+    if ctx.params.get("composite"):
+        return fetched
+    # Same {"<messageId>": metrics} shape as the synchronous endpoint
+    return {key.rsplit(":", 1)[1]: metrics for key, metrics in fetched.items()}
+
+async def delete_job(ctx: job_queue.JobContext):
+    client = await job_client(ctx)
+    return await delete_pipeline.run_delete(
+        client, peer_resolver(client, ctx.account), ctx.params["messages"],
+        rejected=ctx.params.get("rejected"), previous=ctx.checkpoint.get("results"),
+        on_progress=lambda results: ctx.save({"results": results}, results["done"], results["total"], results),
+    )
+
+async def channel_stats_job(ctx: job_queue.JobContext):
+    client = await job_client(ctx)
+    channels = [tuple(channel) for channel in ctx.params["channels"]]
+    # Checkpoint: channels fetched so far; failed ones are tried again
+    results = {channel_id: view for channel_id, view in ctx.checkpoint.get("results", {}).items()
+               if "error" not in view}
+    pending = [channel for channel in channels if channel[0] not in results]
+    done = len(channels) - len(pending)
+    ctx.progress(done, len(channels))
+
+    for group in analytics_engine.chunked(pending, STATS_BATCH_CONCURRENCY):
+        results.update(await channel_stats.get_many(
+            client, ctx.account, group, peer_resolver(client, ctx.account),
+            fields=ctx.params["fields"], points=ctx.params.get("points"), fresh=ctx.params.get("fresh", False),
+        ))
+        done += len(group)
+        ctx.save({"results": results}, done, len(channels))
+    return {channel_id: results[channel_id] for channel_id, _ in channels}
+
+def task_types(user_id: str, items: list) -> Dict[str, str]:
+    """recipientId -> channel/group/user: the item's own "type", the dialog index, or a guess from the id."""
+    known = dialog_indexes.index_for(user_id).entries
+    types_by_id = {}
+    for item in items:
+        chat_id = str(item["recipientId"])
+        if chat_id not in types_by_id:
+            entry = known.get(chat_id)
+            types_by_id[chat_id] = item.get("type") or (entry["type"] if entry else task_rollup.peer_type(chat_id))
+    return types_by_id
+
+async def task_rows(client: TelegramClient, user_id: str, params: dict, progress=None) -> list:
+    """One {"recipientId", "messageId", "type", "metrics" | "error"} row per message of a task."""
+    if params.get("taskId") is not None:
+        # Tracked task: latest polled metrics, no RPC
+        tracker = trackers.get(user_id)
+        entries = [e for e in tracker.entries.values() if str(e.get("taskId")) == params["taskId"]]
+        types_by_id = task_types(user_id, entries)
+        return [{"recipientId": e["recipientId"], "messageId": e["messageId"],
+                 "type": types_by_id[e["recipientId"]], "metrics": e.get("metrics")} for e in entries]
+
+    items = params["items"]
+    types_by_id = task_types(user_id, items)
+    fields = tuple(params.get("fields") or analytics_engine.METRIC_FIELDS)
+    rows = []
+    async for entry in analytics_engine.iter_batch(client, items, cache=metrics_cache, account=user_id,
+                                                   fresh=params.get("fresh", False),
+                                                   resolve=peer_resolver(client, user_id), fields=fields):
+        rows.append({**entry, "type": types_by_id[str(entry["recipientId"])]})
+        if progress:
+            progress(len(rows), len(items))
+    return rows
+
+async def summarize_task(rows: list, params: dict) -> dict:
+    # Off the event loop: a 10k-message task is tens of milliseconds of NumPy
+    return await asyncio.to_thread(task_rollup.summarize, rows, top=params.get("top", task_rollup.TOP_DEFAULT),
+                                   rank=params.get("rank", "views"), detail=params.get("detail", False))
+
+async def task_summary_job(ctx: job_queue.JobContext):
+    client = await job_client(ctx) if ctx.params.get("taskId") is None else None
+    rows = await task_rows(client, ctx.account, ctx.params, progress=ctx.progress)
+    return await summarize_task(rows, ctx.params)
+
+async def warm_client(user_id: str) -> bool:
+    client = await get_or_init_client(user_id)
+    if await auth.authorized(client, user_id):
+        return True
+    # Never finished logging in: nothing to keep warm
+    await pool.remove(user_id)
+    activity.forget(user_id)
+    return False
+
+warmup = Warmup(activity, warm_client)
+
+jobs.register("dialogs", dialogs_job)
+jobs.register("analytics_batch", analytics_batch_job)
+jobs.register("messages_delete", delete_job)
+jobs.register("channel_stats", channel_stats_job)
+jobs.register("task_summary", task_summary_job)
+
+def wants_job(request: Request, run_async: bool = False) -> bool:
+    # ?mode=async, or "async": true in a JSON object body
+    return run_async or request.query_params.get("mode") == "async"
+
+def submit_job(request: Request, user_id: str, kind: str, params: dict) -> TimedJSONResponse:
+    """
+    Queue a job and answer 202 with it; an identical job already running (or
+    just finished) is returned instead, with "deduplicated": true. ?force=true
+    always starts a new one.
+    """
+    force = parse_bool_param(request.query_params, "force", False)
+    try:
+        job, deduplicated = jobs.submit(user_id, kind, params, force=force)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    return TimedJSONResponse(status_code=202, content={**job, "deduplicated": deduplicated},
+                             headers={"Location": f"/jobs/{job['id']}", **throttle_headers(user_id)})
+
+def validate_batch(item_type: type, data, request: Request):
+    """
+    Per-item validation of a batch body: (valid items, [{"index", "error"}]).
+    Invalid items are skipped, or with ?strict=true reject the batch (422).
+    """
+    try:
+        items, invalid = schemas.validate_items(item_type, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if invalid:
+        logger.warning("%d invalid item(s) in batch, first: item %d: %s",
+                       len(invalid), invalid[0]["index"], invalid[0]["error"])
+        if parse_bool_param(request.query_params, "strict", False):
+            raise HTTPException(status_code=422, detail=invalid)
+    return items, invalid
+
+def invalid_headers(invalid: list) -> dict:
+    return {"X-Invalid-Items": str(len(invalid))} if invalid else {}
+
+def metric_fields(value: str = None) -> tuple:
+    try:
+        return analytics_engine.parse_fields(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.on_event("startup")
 async def startup_event():
-    pass  # No global init; clients are lazy per user
+    pool.start()  # Idle reaper; clients themselves are lazy per user
+    session_store.start()
+    trackers.resume(owns=shards.owns)
+    jobs.resume(owns=shards.owns)
+    metrics_store.start()
+    # Reconnects run in the background; readiness doesn't wait for them
+    warmup.start(owns=shards.owns)
+    app.state.ready = True
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    for c in clients.values():
-        try:
-            await c.disconnect()
-        except:
-            pass
+    app.state.ready = False
+    await warmup.close()
+    activity.flush()
+    trackers.close()
+    await jobs.close()
+    await pool.close()
+    await session_store.close()
+    resolvers.flush()
+    await metrics_store.close()
+    log_config.shutdown_logging()
 
 @app.get("/")
-async def health_check(request: Request = None):
+async def health_check(verify: bool = False, request: Request = None):
+    """
+    Service status, plus the caller's login status and identity (x-user-id)
+    from the auth cache. ?verify=true checks them with Telegram.
+    """
     response = {
         "status": "running",
         "service": "analytics-telethon",
         "configured": bool(API_ID and API_HASH),
-        "active_sessions": len([c for c in clients.values() if c.is_connected()]),
+        "active_sessions": pool.stats()["connected"],
+        "pool": pool.stats(),
+        "scheduler": schedulers.stats(),
+        "metrics_cache": metrics_cache.stats(),
+        "entities": resolvers.stats(),
+        "tracking": trackers.stats(),
+        "jobs": jobs.stats(),
+        "warmup": {**warmup.stats(), "activity": activity.stats()},
+        "metrics_store": metrics_store.stats(),
+        "channel_stats": channel_stats.stats(),
+        "shard": {**shards.stats(), "leases": leases.held()},
+        "sessions": session_store.stats(),
+        "auth": auth.stats(),
         "authorized": False
     }
 
     if request:
         user_id = request.headers.get("x-user-id")
         if user_id:
-            client = clients.get(user_id)
+            client = pool.peek(user_id)
             if client and client.is_connected():
                 try:
-                     # Check auth status - usually cached or fast
-                     if await client.is_user_authorized():
+                    # Memory reads unless ?verify=true
+                    me = await auth.identity(client, user_id, verify=verify)
+                    if me:
                         response["authorized"] = True
-                        # Get cached ME if possible, or fetch
-                        me = await client.get_me()
-                        if me:
-                            response["user"] = {
-                                "id": str(me.id), 
-                                "username": me.username, 
-                                "firstName": me.first_name,
-                                "lastName": me.last_name
-                            }
+                        response["user"] = {
+                            "id": str(me["id"]),
+                            "username": me["username"],
+                            "firstName": me["first_name"],
+                            "lastName": me["last_name"]
+                        }
                 except Exception as e:
-                    print(f"Status check error for {user_id}: {e}")
+                    logger.warning("Status check error: %s", e)
     
     return response
 
+@app.get("/ready")
+async def readiness(warm: bool = False):
+    """
+    Readiness probe: 200 once startup finished, 503 before and while shutting
+    down. Reconnecting recently active sessions doesn't hold readiness back;
+    its progress is under "warmup". ?warm=true also answers 503 until the
+    warm-up finished, for rollouts that should only shift traffic to warm
+    instances.
+    """
+    started = getattr(app.state, "ready", False)
+    ready = started and not (warm and warmup.running)
+    return TimedJSONResponse(status_code=200 if ready else 503, content={
+        "ready": ready,
+        "started": started,
+        "warmup": warmup.stats(),
+        "sessions": len(pool),
+    })
+
+@app.get("/shard")
+async def shard_info(user_id: str = None, request: Request = None):
+    """
+    Shard layout and, for ?user_id= (or x-user-id), which shard owns that
+    user. Answered by every shard, so a front proxy can route on it.
+    """
+    return {
+        **shards.describe(user_id or request.headers.get("x-user-id")),
+        "sessions": len(pool),
+        "leases": leases.held(),
+    }
+
+def collect_metrics():
+    """Gauges and counters kept by the stores themselves, read at scrape time."""
+    family = telemetry.family
+    pool_stats = pool.stats()
+    yield family("client_pool_clients", "gauge", "Pooled Telethon clients", value=pool_stats["size"])
+    yield family("client_pool_connected", "gauge", "Pooled clients with a live connection",
+                 value=pool_stats["connected"])
+    yield family("client_pool_busy", "gauge", "Clients pinned by in-flight requests", value=pool_stats["busy"])
+    yield family("client_pool_max", "gauge", "Client pool capacity", value=pool_stats["max"])
+    yield family("client_pool_events_total", "counter", "Client pool lookups and evictions", {
+        key: pool_stats[key] for key in ("hits", "misses", "evictions", "reconnects")
+    }, label="event")
+
+    scheduler_stats = schedulers.stats()
+    yield family("telegram_flood_waits_total", "counter", "FloodWaits received",
+                 value=scheduler_stats["flood_waits"])
+    yield family("telegram_flood_wait_seconds_total", "counter", "Seconds of FloodWait imposed",
+                 value=scheduler_stats["flood_wait_seconds"])
+    yield family("telegram_throttled_total", "counter", "Requests rejected with 429 during a FloodWait",
+                 value=scheduler_stats["throttled"])
+    yield family("telegram_accounts_paused", "gauge", "Accounts currently in a FloodWait pause",
+                 value=scheduler_stats["paused"])
+
+    caches = {
+        "metrics": metrics_cache.stats(),
+        "channel_stats": channel_stats.stats(),
+        "auth": auth.stats(),
+    }
+    hits = {name: s["hits"] + s.get("coalesced", 0) for name, s in caches.items()}
+    misses = {name: s["misses"] for name, s in caches.items()}
+    yield family("cache_hits_total", "counter", "Cache hits (incl. requests joining an in-flight fetch)",
+                 hits, label="cache")
+    yield family("cache_misses_total", "counter", "Cache misses", misses, label="cache")
+    yield family("cache_hit_ratio", "gauge", "Hits over lookups since start", {
+        name: round(hits[name] / (hits[name] + misses[name]), 4) if hits[name] + misses[name] else 0
+        for name in caches
+    }, label="cache")
+    yield family("entity_resolver_hits_total", "counter", "Peers resolved without an RPC",
+                 value=resolvers.stats()["hits"])
+    yield family("entity_resolver_invalidated_total", "counter", "Stored access hashes Telegram rejected",
+                 value=resolvers.stats()["invalidated"])
+    yield family("auth_sessions_revoked_total", "counter", "Sessions Telegram stopped accepting",
+                 value=auth.stats()["revoked"])
+    yield family("tracked_messages", "gauge", "Messages tracked server-side", value=trackers.stats()["tracked"])
+    job_stats = jobs.stats()
+    yield family("jobs", "gauge", "Background jobs by state", {
+        key: job_stats[key] for key in ("queued", "running")
+    }, label="state")
+    yield family("jobs_submitted_total", "counter", "Background jobs submitted, deduplicated or resumed", {
+        key: job_stats[key] for key in ("submitted", "deduplicated", "resumed")
+    }, label="event")
+
+telemetry.registry.add_collector(collect_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus scrape endpoint: route latency histograms, Telethon RPC
+    counts/latency per request type, FloodWaits, client pool and caches.
+    """
+    return PlainTextResponse(telemetry.registry.render(), media_type=telemetry.CONTENT_TYPE)
+
+# --- Admin Endpoints ---
+
+def require_admin(request: Request):
+    token = os.getenv("ADMIN_TOKEN")
+    if token and request.headers.get("x-admin-token") != token:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/logging")
+async def get_logging_settings(request: Request = None):
+    require_admin(request)
+    return log_config.current_settings()
+
+@app.post("/admin/logging")
+async def update_logging_settings(data: LoggingSettingsRequest, request: Request = None):
+    """
+    Change logging at runtime, no restart needed.
+    Input: {"level": "DEBUG", "item_debug": true, "sample_rates": {"/analytics": 0.1}}
+    """
+    require_admin(request)
+    try:
+        if data.level is not None:
+            log_config.set_level(data.level)
+        if data.item_debug is not None:
+            log_config.set_item_debug(data.item_debug)
+        if "sample_rates" in data.model_fields_set:
+            log_config.set_sample_rates(data.sample_rates or {})
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return log_config.current_settings()
+
 # --- Auth Endpoints ---
 
 @app.post("/auth/setup")
-async def setup_credentials(data: dict = Body(...), request: Request = None):
+async def setup_credentials(data: CredentialsRequest, request: Request = None):
     """
     Update API ID/Hash dynamically (called after Node updates .env)
     """
     user_id = get_user_id_from_request(request)
-    new_api_id = data.get("api_id")
-    new_api_hash = data.get("api_hash")
+    new_api_id = data.api_id
+    new_api_hash = data.api_hash
     
     if not new_api_id or not new_api_hash:
          raise HTTPException(status_code=400, detail="Missing api_id or api_hash")
@@ -128,12 +676,14 @@ async def setup_credentials(data: dict = Body(...), request: Request = None):
     try:
         client = await get_or_init_client(user_id, new_api_id, new_api_hash)
         return {"status": "success", "message": "Credentials updated and client initialized"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to initialize client: {str(e)}")
 
 
 @app.post("/auth/request-code")
-async def request_code(data: dict = Body(...), request: Request = None):
+async def request_code(data: CodeRequest, request: Request = None):
     user_id = get_user_id_from_request(request)
     
     # Extract Credentials from Headers
@@ -142,7 +692,7 @@ async def request_code(data: dict = Body(...), request: Request = None):
     
     client = await get_or_init_client(user_id, api_id, api_hash)
 
-    phone = data.get("phone")
+    phone = data.phone
     if not phone:
         raise HTTPException(status_code=400, detail="Phone number required")
 
@@ -151,11 +701,11 @@ async def request_code(data: dict = Body(...), request: Request = None):
         sent = await client.send_code_request(phone)
         return {"phone_code_hash": sent.phone_code_hash}
     except Exception as e:
-        print(f"Error requesting code: {e}")
-        raise HTTPException(status_code=400, detail=str(e))
+        logger.warning("Error requesting code: %s", e)
+        raise http_error(e, 400)
 
 @app.post("/auth/sign-in")
-async def sign_in_route(data: dict = Body(...), request: Request = None):
+async def sign_in_route(data: SignInRequest, request: Request = None):
     user_id = get_user_id_from_request(request)
     
     # Extract Credentials from Headers
@@ -164,442 +714,706 @@ async def sign_in_route(data: dict = Body(...), request: Request = None):
     
     client = await get_or_init_client(user_id, api_id, api_hash)
 
-    print(f"Received sign-in data: {data}")
-    
-    phone = data.get("phone")
-    code = data.get("code")
-    phone_code_hash = data.get("phone_code_hash")
-    
-    print(f"Extracted: phone={phone}, code={code}, hash={phone_code_hash}")
+    phone = data.phone
+    code = data.code
+    phone_code_hash = data.phone_code_hash
     
+    # Never log the payload itself: it carries the login code
     if not phone or not code or not phone_code_hash:
-        print("Missing required fields!")
+        logger.warning("Sign-in rejected: missing phone, code or hash")
         raise HTTPException(status_code=400, detail="Missing phone, code, or hash")
 
     try:
         user = await client.sign_in(phone=phone, code=code, phone_code_hash=phone_code_hash)
+        auth.signed_in(user_id, user)
+        # Don't wait for the periodic snapshot to persist a fresh login
+        await session_store.save(user_id)
         return {"status": "success", "user": {"id": user.id, "username": user.username}}
     except Exception as e:
-        print(f"Error signing in: {e}")
-        raise HTTPException(status_code=400, detail=str(e))
+        logger.warning("Error signing in: %s", e)
+        raise http_error(e, 400)
 
 @app.get("/auth/me")
-async def get_me(request: Request = None):
+async def get_me(verify: bool = False, request: Request = None):
     """
-    Get current authorized user info.
+    Get current authorized user info, from the auth cache unless ?verify=true.
     """
     user_id = get_user_id_from_request(request)
     client = await get_or_init_client(user_id)
 
-    if not await client.is_user_authorized():
-        raise HTTPException(status_code=401, detail="Userbot not authorized")
-
     try:
-        me = await client.get_me()
-        return {"id": str(me.id), "username": me.username, "first_name": me.first_name}
+        me = await auth.identity(client, user_id, verify=verify)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+    if me is None:
+        raise HTTPException(status_code=401, detail="Userbot not authorized")
+    return {"id": str(me["id"]), "username": me["username"], "first_name": me["first_name"]}
 
 @app.post("/auth/logout")
 async def logout(request: Request = None):
     user_id = get_user_id_from_request(request)
-    client = clients.get(user_id)
+    client = pool.peek(user_id)
     if not client:
         return {"status": "ignored", "detail": "No client"}
 
     try:
         await client.log_out()
-        # Remove from dict
-        clients.pop(user_id, None)
+        auth.forget(user_id)
+        # Drop the stored session first so removing the client doesn't snapshot it again
+        await session_store.delete(user_id)
+        # Remove from pool (log_out already disconnected it)
+        await pool.remove(user_id, disconnect=False)
+        dialog_indexes.forget(user_id)
+        resolvers.forget(user_id)
+        trackers.forget(user_id)
+        jobs.forget(user_id)
+        activity.forget(user_id)
+        channel_stats.forget(user_id)
         return {"status": "success", "message": "Logged out"}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+def parse_bool_param(params, name: str, default=None):
+    value = params.get(name)
+    if value is None or value == "any":
+        return default if value is None else None
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    raise HTTPException(status_code=400, detail=f"{name} must be true, false or any")
+
+def parse_dialog_filters(params) -> dict:
+    types = None
+    if params.get("type"):
+        types = {t.strip() for t in params["type"].split(",") if t.strip()}
+        unknown = types - set(dialog_index.DIALOG_TYPES)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown dialog type(s): {', '.join(sorted(unknown))}")
+
+    folder = params.get("folder")
+    if folder is not None:
+        try:
+            folder = int(folder)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="folder must be an integer")
+
+    return {
+        "types": types,
+        "can_send": parse_bool_param(params, "can_send", default=True),
+        "query": params.get("q"),
+        "prefix": params.get("prefix"),
+        "archived": parse_bool_param(params, "archived"),
+        "folder": folder,
+    }
 
-@app.get("/dialogs")
+@app.get("/dialogs", response_model=Union[List[schemas.Dialog], schemas.DialogPage])
 async def get_dialogs(request: Request = None):
     """
     Fetch all dialogs (users, groups, channels) from the active session.
+    ?refresh=full rebuilds the dialog index, ?refresh=incremental syncs recent
+    dialogs first. The X-Stale-Since header says when the index was last synced.
+
+    Filters: type=user,group,channel  can_send=true|false|any (default true)
+             q=<substring>  prefix=<name prefix>  archived=true|false  folder=<id>
+    Passing limit and/or cursor switches to a paginated response:
+        {"items": [...], "next_cursor": "...", "total": N, "stale_since": "..."}
+    ?mode=async syncs the index in a background job instead (202, see /jobs);
+    its result is {"total", "stale_since"} and later calls read the index.
     """
     user_id = get_user_id_from_request(request)
     
     # Extract Credentials from Headers (Source of Truth from Node)
     api_id = request.headers.get("x-api-id")
     api_hash = request.headers.get("x-api-hash")
-    print(f"[DEBUG] 📥 Python received request. API_ID={api_id}, API_HASH={api_hash[:5] if api_hash else 'None'}...")
     
     # Init client with specific user creds
     client = await get_or_init_client(user_id, api_id, api_hash)
 
-    if not await client.is_user_authorized():
+    if not await auth.authorized(client, user_id):
         raise HTTPException(status_code=401, detail="Userbot not authorized")
 
+    params = request.query_params
+    refresh = params.get("refresh")
+    if refresh not in (None, "full", "incremental"):
+        raise HTTPException(status_code=400, detail="refresh must be 'full' or 'incremental'")
+    if wants_job(request):
+        return submit_job(request, user_id, "dialogs", {"refresh": refresh})
+
+    filters = parse_dialog_filters(params)
+    paginated = "limit" in params or "cursor" in params
+    if paginated:
+        try:
+            limit = min(max(int(params.get("limit", 100)), 1), dialog_index.MAX_PAGE_SIZE)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="limit must be an integer")
+
     try:
-        # Telethon get_dialogs - iterate explicitly to ensure all are fetched
-        # Explicitly disable filters to get EVERYTHING
-        print("🔄 Starting Fresh Dialog Fetch via Telethon (Refined Logic)...")
-        
-        results = []
-        count = 0
-        async for dialog in client.iter_dialogs(limit=None, ignore_migrated=False, archived=None):
-            entity = dialog.entity
-            count += 1
-            
-            # DEBUG: Print everything to see what is being found
-            print(f"[DEBUG] Inspecting: {dialog.id} | {dialog.name}")
-
-            # 1. Filter out chats we've left or are kicked from
-            if getattr(entity, 'left', False) or getattr(entity, 'kicked', False):
-                print(f"   ❌ Skipped {dialog.id}: Left/Kicked")
-                continue
-
-            # 2. Logic to determine if we can send messages
-            can_send = False
-            entity_type = "user"
-            
-            if dialog.is_channel:
-                entity_type = "channel"
-                # Channel or Supergroup
-                if getattr(entity, 'broadcast', False):
-                    # Broadcast Channel: Only Creator or Admin can post
-                    if getattr(entity, 'creator', False) or (getattr(entity, 'admin_rights', None) and entity.admin_rights.post_messages):
-                        can_send = True
-                    else:
-                        pass # Cannot post in this channel
-                elif getattr(entity, 'megagroup', False):
-                    entity_type = "group" # Supergroup treated as group
-                    # Supergroup: Usually can posting unless restricted
-                    # Simple check: If we are just a member, we can post.
-                    # For simplicity, we assume we can post unless specific restrictions exist.
-                    can_send = True
-            elif dialog.is_group:
-                entity_type = "group"
-                # Basic Chat: Everyone can post usually
-                can_send = True
-            else:
-                # Users/Bots
-                can_send = True
-            
-            if can_send:
-                # Extract username safely
-                username = None
-                if hasattr(entity, "username"):
-                    username = entity.username
-                
-                # Extract access_hash safely
-                access_hash = None
-                if hasattr(entity, "access_hash"):
-                    access_hash = str(entity.access_hash)
-
-                if count <= 5:
-                    name_display = getattr(entity, 'title', None) or getattr(entity, 'name', 'Unknown')
-                    print(f"   -> Found Valid: {dialog.id} | {name_display} | {entity_type}")
-
-                results.append({
-                    "telegramId": str(dialog.id),
-                    "name": dialog.title or dialog.name or "Unknown",
-                    "username": username,
-                    "type": entity_type,
-                    "accessHash": access_hash
-                })
-            
-        print(f"✅ Telethon Iteration Complete. Valid Dialogs: {len(results)}")
-        return results
+        # Served from the persisted per-user index; Telegram is only walked
+        # for a first build, an explicit ?refresh=, or a stale background sync.
+        index = await dialog_indexes.get(client, user_id, refresh=refresh)
+        resolvers.get(user_id).learn_dialogs(index.items())
+        matches = dialog_index.filter_entries(index.items(), **filters)
+        headers = {"X-Stale-Since": index.stale_since or ""}
+
+        if not paginated:
+            results = [dialog_index.public_view(e) for e in matches]
+            logger.info("Serving %d dialogs (index synced %s)", len(results), index.stale_since)
+            return TimedJSONResponse(content=results, headers=headers)
+
+        try:
+            page, next_cursor = dialog_index.paginate(matches, limit, params.get("cursor"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return TimedJSONResponse(content={
+            "items": [dialog_index.public_view(e, dialog_index.PAGE_FIELDS) for e in page],
+            "next_cursor": next_cursor,
+            "total": len(matches),
+            "stale_since": index.stale_since,
+        }, headers=headers)
+    except (HTTPException, Throttled):
+        raise
     except Exception as e:
-        print(f"❌ Error fetching dialogs: {e}")
-        import traceback
-        traceback.print_exc() 
+        logger.exception("Error fetching dialogs: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/analytics")
-async def get_analytics(chat_id: str, message_id: int, request: Request = None):
+async def get_analytics(chat_id: str, message_id: int, fresh: bool = False,
+                        access_hash: str = None, fields: str = None, request: Request = None):
     """
     Fetch analytics for a specific message.
+    ?access_hash= (as returned by /dialogs) lets the peer resolve without an RPC.
+    Reads through the metrics cache; ?fresh=true skips the cached value.
+    The response says whether it was served from cache ("cached") and how
+    old it is in seconds ("age").
+    ?fields=counters returns views/forwards/replies only, fetched through
+    messages.GetMessagesViews instead of downloading the message; add
+    reactions or voters as needed ("counters,reactions").
     """
+    fields = metric_fields(fields)
     try:
         user_id = get_user_id_from_request(request)
         client = await get_or_init_client(user_id)
 
-        if not await client.is_user_authorized():
+        if not await auth.authorized(client, user_id):
             raise HTTPException(status_code=401, detail="Userbot not authorized. Please log in.")
 
-        # Resolve chat_id
-        peer = None
-        try:
-            peer = int(chat_id)
-        except ValueError:
-            peer = chat_id 
-
-        message = await client.get_messages(peer, ids=message_id)
-        
-        if not message:
-            raise HTTPException(status_code=404, detail="Message not found")
-
-        # Extract analytics
-        views = getattr(message, 'views', 0) or 0
-        forwards = getattr(message, 'forwards', 0) or 0
-        
-        replies = 0
-        if message.replies:
-             replies = message.replies.replies or 0
-
-        reactions = 0
-        if message.reactions and message.reactions.results:
-            reactions = sum(r.count for r in message.reactions.results)
-
-        return {
-            "views": views,
-            "forwards": forwards,
-            "replies": replies,
-            "reactions": reactions
-        }
+        resolve = peer_resolver(client, user_id)
+        if fields != analytics_engine.METRIC_FIELDS:
+            item = {"recipientId": chat_id, "messageId": message_id, "accessHash": access_hash}
+            async for entry in analytics_engine.iter_batch(client, [item], cache=metrics_cache, account=user_id,
+                                                           fresh=fresh, resolve=resolve,
+                                                           fields=fields):
+                if "error" not in entry:
+                    return entry["metrics"]
+                if entry["error"] == "Message not found":
+                    raise HTTPException(status_code=404, detail="Message not found")
+                raise RuntimeError(entry["error"])
+
+        async def fetch():
+            peer = await resolve(chat_id, access_hash)
+            try:
+                message = await client.get_messages(peer, ids=message_id)
+            except Exception as e:
+                invalidate_on(resolve, chat_id, e)
+                raise
+            if not message:
+                raise HTTPException(status_code=404, detail="Message not found")
+            return analytics_engine.extract_metrics(message)
+
+        metrics, cached, age = await metrics_cache.get_or_fetch(
+            cache_key(user_id, chat_id, message_id), fetch, fresh=fresh
+        )
+        return annotate(metrics, cached, age)
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = str(e)
-        print(f"❌ Error fetching analytics: {error_msg}")
+        logger.warning("Error fetching analytics: %s", error_msg)
         if "Cannot find any entity" in error_msg:
              raise HTTPException(status_code=404, detail="Channel/Group not found or not accessible")
-        raise HTTPException(status_code=500, detail=error_msg)
+        raise http_error(e)
 
-@app.post("/analytics/batch")
+@app.post("/analytics/batch", response_model=Dict[str, schemas.MessageMetrics])
 async def get_analytics_batch(data: list = Body(...), request: Request = None):
     """
     Fetch analytics for a batch of messages.
-    Input: [{"recipientId": "...", "messageId": 123}, ...]
+    Input: [{"recipientId": "...", "messageId": 123, "accessHash": "..."?}, ...]
+
+    Default response: {"<messageId>": metrics}. Pass ?key=composite to key by
+    "<recipientId>:<messageId>" instead.
+    Reads through the metrics cache (?fresh=true skips cached values); each
+    metrics object carries "cached" and "age" in seconds.
+    With `Accept: application/x-ndjson` the response is streamed, one line per
+    message as soon as it resolves:
+        {"recipientId": "...", "messageId": 123, "metrics": {...}}
+        {"recipientId": "...", "messageId": 456, "error": "..."}
+    ?mode=async runs the batch as a background job (202, see /jobs) whose
+    result has the same shape.
+    ?fields=counters fetches views/forwards/replies only, up to 100 ids per
+    GetMessagesViews call; "counters,reactions" adds reactions (one more call
+    per chunk). Omitted fields are left out of each metrics object.
+    Items are validated one by one: invalid ones are skipped and counted in
+    X-Invalid-Items (streamed as {"index": 3, "error": "..."} lines), or
+    with ?strict=true the batch is rejected with a 422 listing them.
     """
     user_id = get_user_id_from_request(request)
     client = await get_or_init_client(user_id)
 
-    if not await client.is_user_authorized():
+    if not await auth.authorized(client, user_id):
         raise HTTPException(status_code=401, detail="Userbot not authorized")
 
-    results = {}
-    
-    for item in data:
-        chat_id = item.get("recipientId")
-        msg_id = item.get("messageId")
-        
-        if not chat_id or not msg_id:
-            continue
-            
-        try:
-            # Resolve peer
-            peer = None
-            try:
-                peer = int(chat_id)
-            except ValueError:
-                peer = chat_id
-                
-            # Fetch message
-            message = await client.get_messages(peer, ids=int(msg_id))
-            
-            if message:
-                # Extract metrics
-                views = getattr(message, 'views', 0) or 0
-                forwards = getattr(message, 'forwards', 0) or 0
-                
-                # Replies
-                replies = 0
-                if message.replies:
-                     replies = message.replies.replies or 0
-                
-                # Reactions
-                reactions = 0
-                if message.reactions and message.reactions.results:
-                    reactions = sum(r.count for r in message.reactions.results)
-                
-                # Voters (Polls)
-                voters = 0
-                if message.poll: # Telethon message.poll property
-                     if message.poll.results:
-                         voters = message.poll.results.total_voters or 0
-                # Fallback check for media.poll
-                elif message.media and hasattr(message.media, "poll") and message.media.poll.results:
-                     voters = message.media.poll.results.total_voters or 0
-                    
-                results[str(msg_id)] = {
-                    "views": views,
-                    "forwards": forwards,
-                    "replies": replies,
-                    "reactions": reactions,
-                    "voters": voters
-                }
-                print(f"✅ Analyzed msg {msg_id}: V={views} R={reactions} P={voters}")
+    fresh = request.query_params.get("fresh", "").lower() in ("1", "true", "yes")
+    composite = request.query_params.get("key") == "composite"
+    fields = metric_fields(request.query_params.get("fields"))
+    items, invalid = validate_batch(schemas.MessageRef, data, request)
+
+    if wants_job(request):
+        params = {"items": items, "composite": composite, "fresh": fresh}
+        if fields != analytics_engine.METRIC_FIELDS:
+            params["fields"] = list(fields)
+        return submit_job(request, user_id, "analytics_batch", params)
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        async def stream():
+            for error in invalid:
+                yield telemetry.dumps(error) + b"\n"
+            async for entry in analytics_engine.iter_batch(client, items, cache=metrics_cache,
+                                                           account=user_id, fresh=fresh,
+                                                           resolve=peer_resolver(client, user_id), fields=fields):
+                yield telemetry.dumps(entry) + b"\n"
+
+        return StreamingResponse(stream(), media_type=NDJSON_MEDIA_TYPE, headers=invalid_headers(invalid))
+
+    # Grouped by peer, multi-id get_messages, peers fetched concurrently
+    results = await analytics_engine.fetch_batch(client, items, composite=composite, cache=metrics_cache,
+                                                 account=user_id, fresh=fresh,
+                                                 resolve=peer_resolver(client, user_id), fields=fields)
+    return TimedJSONResponse(content=results, headers={**throttle_headers(user_id), **invalid_headers(invalid)})
+
+
+def track_items(data) -> list:
+    # Accept a bare list or {"items": [...]}, like the batch endpoints
+    items = data.get("items", []) if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a list of messages")
+    return items
+
+async def register_tracked(user_id: str, items: list, live: bool = False) -> int:
+    """Track validated items (see AccountTracker.track); returns how many were new."""
+    tracker = trackers.get(user_id)
+    added = tracker.track(items, live=live)
+
+    # Remember which messages belong to which task for /analytics/history/task
+    by_task = {}
+    for key, entry in tracker.entries.items():
+        if entry.get("taskId"):
+            by_task.setdefault(str(entry["taskId"]), []).append(key)
+    for task_id in {i["taskId"] for i in items if i.get("taskId")}:
+        await metrics_store.link_task(user_id, task_id, by_task.get(task_id, []))
+    return added
+
+@app.post("/analytics/track", response_model=schemas.TrackResult)
+async def track_messages(data=Body(...), request: Request = None):
+    """
+    Register messages for server-side tracking (replaces per-message polling
+    from analyticsWorker.js).
+    Input: [{"recipientId": "...", "messageId": 123, "accessHash": "..."?,
+             "taskId": "..."?, "postedAt": <epoch s|ms or ISO>?}, ...]
+    Messages are refreshed until TRACK_DURATION after postedAt; read what
+    changed with GET /analytics/changes. Invalid items are listed in
+    "invalid" as {"index", "error"} (?strict=true rejects the whole list).
+    """
+    user_id = get_user_id_from_request(request)
+    client = await get_or_init_client(user_id)
+
+    if not await auth.authorized(client, user_id):
+        raise HTTPException(status_code=401, detail="Userbot not authorized")
+
+    tracker = trackers.get(user_id)
+    items, invalid = validate_batch(schemas.TrackItem, track_items(data), request)
+    added = await register_tracked(user_id, items)
+    return {"tracked": added, "total": len(tracker.entries), "seq": tracker.seq, "invalid": invalid}
+
+@app.post("/analytics/untrack")
+async def untrack_messages(data=Body(...), request: Request = None):
+    """
+    Stop tracking messages.
+    Input: [{"recipientId": "...", "messageId": 123}, ...] or {"taskId": "..."}
+    """
+    user_id = get_user_id_from_request(request)
+    client = await get_or_init_client(user_id)
+
+    if not await auth.authorized(client, user_id):
+        raise HTTPException(status_code=401, detail="Userbot not authorized")
+
+    tracker = trackers.get(user_id)
+    task_id = data.get("taskId") if isinstance(data, dict) else None
+    items = validate_batch(schemas.MessageRef, track_items(data), request)[0] if task_id is None else []
+    removed = tracker.untrack(items, task_id=task_id)
+    return {"removed": removed, "total": len(tracker.entries)}
+
+@app.get("/analytics/track")
+async def get_tracked(request: Request = None):
+    """
+    Every tracked message with its latest metrics, plus the current change
+    sequence number to pass as ?since= to GET /analytics/changes.
+    """
+    user_id = get_user_id_from_request(request)
+    return TimedJSONResponse(content=trackers.get(user_id).snapshot())
+
+@app.get("/analytics/changes")
+async def get_tracked_changes(since: int = 0, wait: float = 0, request: Request = None):
+    """
+    Tracked messages whose metrics changed after sequence number `since`
+    (latest change per message). ?wait=<seconds> (max 30) holds the request
+    until something changes. Entries with "expired": true are no longer
+    tracked. "reset": true means the cursor is too old; reload GET /analytics/track.
+    """
+    user_id = get_user_id_from_request(request)
+    changes = await trackers.get(user_id).wait_changes(since, min(max(wait, 0), 30))
+    return TimedJSONResponse(content=changes)
+
+@app.post("/analytics/subscribe")
+async def subscribe_metrics(data=Body(...), request: Request = None):
+    """
+    Live metrics for a task page, as Server-Sent Events.
+    Input: [{"recipientId": "...", "messageId": 123, "accessHash": "..."?,
+             "taskId": "..."?, "postedAt": ...?}, ...] (or {"items": [...]}),
+    or {"taskId": "..."} for the task's tracked messages. Messages that
+    aren't tracked yet (POST /analytics/track) are tracked only while
+    someone is subscribed to them.
+    While anyone is subscribed the messages are refreshed every
+    TRACK_LIVE_INTERVAL seconds by the account's tracker, so any number of
+    subscribers cost the Telegram traffic of one. Events:
+        event: snapshot  {"seq", "items": [{"recipientId", "messageId", "metrics"}]}
+        event: delta     {"seq", "items": [{"recipientId", "messageId", "metrics": <changed counters>}
+                                           | {"recipientId", "messageId", "expired": true}]}
+    """
+    user_id = get_user_id_from_request(request)
+    client = await get_or_init_client(user_id)
+
+    if not await auth.authorized(client, user_id):
+        raise HTTPException(status_code=401, detail="Userbot not authorized")
+
+    tracker = trackers.get(user_id)
+    task_id = data.get("taskId") if isinstance(data, dict) and "items" not in data else None
+    if task_id is not None:
+        keys = [key for key, entry in tracker.entries.items() if str(entry.get("taskId")) == str(task_id)]
+        if not keys:
+            raise HTTPException(status_code=404, detail="No tracked messages for this task")
+    else:
+        items, _ = validate_batch(schemas.TrackItem, track_items(data), request)
+        if not items:
+            raise HTTPException(status_code=400, detail="No messages to subscribe to")
+        await register_tracked(user_id, items, live=True)
+        keys = [(str(item["recipientId"]), item["messageId"]) for item in items]
+
+    async def stream():
+        async for event in tracker.subscribe(keys):
+            if event is None:
+                yield b": keepalive\n\n"
             else:
-                print(f"⚠️ Message {msg_id} in {chat_id} not found")
-                
-        except Exception as e:
-            print(f"❌ Failed to analyze {msg_id} in {chat_id}: {e}")
-            
-    return results
+                yield b"event: %s\nid: %d\ndata: %s\n\n" % (
+                    event["event"].encode(), event["seq"],
+                    telemetry.dumps({"seq": event["seq"], "items": event["items"]}))
 
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def history_range(resolution: str, since: str = None, until: str = None):
+    try:
+        step = timeseries.parse_resolution(resolution)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    since_ts, until_ts = timeseries.parse_timestamp(since), timeseries.parse_timestamp(until)
+    if (since and since_ts is None) or (until and until_ts is None):
+        raise HTTPException(status_code=400, detail="since/until must be epoch seconds or ISO dates")
+    return step, int(since_ts or 0), int(until_ts) if until_ts else None
+
+@app.get("/analytics/history")
+async def get_message_history(chat_id: str, message_id: int, resolution: str = "hour",
+                              since: str = None, until: str = None, request: Request = None):
+    """
+    Recorded metrics curve of one message, from the local store (no Telegram
+    calls). ?resolution=raw|hour|day, ?since/?until as epoch seconds or ISO.
+    Scoped to the caller's account when x-user-id is sent.
+    """
+    step, since_ts, until_ts = history_range(resolution, since, until)
+    points = await metrics_store.message_history(chat_id, message_id, step, since_ts, until_ts,
+                                                 account=request.headers.get("x-user-id"))
+    return {"chat_id": chat_id, "message_id": message_id, "resolution": resolution, "points": points}
+
+@app.get("/analytics/history/task/{task_id}")
+async def get_task_history(task_id: str, resolution: str = "hour", since: str = None,
+                           until: str = None, request: Request = None):
+    """
+    Summed metrics curve of every message registered for a task through
+    POST /analytics/track.
+    """
+    user_id = get_user_id_from_request(request)
+    step, since_ts, until_ts = history_range(resolution, since, until)
+    history = await metrics_store.task_history(user_id, task_id, step, since_ts, until_ts)
+    return {"task_id": task_id, "resolution": resolution, **history}
 
-@app.post("/messages/delete")
-async def delete_messages(data: dict = Body(...), request: Request = None):
+@app.post("/analytics/task/summary")
+async def get_task_summary(data=Body(...), request: Request = None):
+    """
+    Task-level rollup, instead of aggregating /analytics/batch results in
+    analyticsService.getTaskAnalytics.
+    Input: [{"recipientId": "...", "messageId": 123, "accessHash": "..."?,
+             "type": "channel"|"group"|"user"?}, ...] (or {"items": [...]}),
+    read through the metrics cache like /analytics/batch (?fresh=true,
+    ?fields=), or {"taskId": "..."} to summarize the latest metrics of the
+    task's tracked messages (POST /analytics/track) without any RPC.
+    Returns totals, a per-type breakdown, percentiles, engagement rates and
+    the ?top=N (default 10, max 100) best and worst recipients by ?rank=
+    (a counter, "engagement" or "messages"). ?detail=true adds the
+    per-message rows; ?mode=async runs it as a job.
+    """
+    user_id = get_user_id_from_request(request)
+    query = request.query_params
+    rank = query.get("rank", "views")
+    if rank not in task_rollup.RANK_KEYS:
+        raise HTTPException(status_code=400, detail=f"rank must be one of {', '.join(task_rollup.RANK_KEYS)}")
+    try:
+        top = int(query.get("top", task_rollup.TOP_DEFAULT))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="top must be an integer")
+    params = {"top": top, "rank": rank, "detail": parse_bool_param(query, "detail", False)}
+
+    task_id = data.get("taskId") if isinstance(data, dict) else None
+    client = None
+    invalid = []
+    if task_id is not None:
+        params["taskId"] = str(task_id)
+    else:
+        client = await get_or_init_client(user_id)
+        if not await auth.authorized(client, user_id):
+            raise HTTPException(status_code=401, detail="Userbot not authorized")
+        fields = metric_fields(query.get("fields"))
+        items, invalid = validate_batch(schemas.TaskItem, track_items(data), request)
+        params.update({"items": items, "fresh": parse_bool_param(query, "fresh", False)})
+        if fields != analytics_engine.METRIC_FIELDS:
+            params["fields"] = list(fields)
+
+    if wants_job(request):
+        return submit_job(request, user_id, "task_summary", params)
+
+    rows = await task_rows(client, user_id, params)
+    summary = await summarize_task(rows, params)
+    return TimedJSONResponse(content={**summary, "invalid": invalid}, headers=invalid_headers(invalid))
+
+@app.post("/analytics/growth")
+async def get_channel_growth(data: ChannelGrowthRequest, request: Request = None):
+    """
+    Daily growth of a channel from recorded history (proxied by
+    analyticsRoutes.js). Input: {"channel_id": "...", "days": 30}
+    Returns one point per day with summed message counters, the number of
+    recorded messages and the follower count seen by /channel-stats.
+    """
+    channel_id = data.channel_id
+    if not channel_id:
+        raise HTTPException(status_code=400, detail="channel_id required")
+    days = min(max(int(data.days or 30), 1), 730)
+
+    points = await metrics_store.channel_growth(channel_id, days, account=request.headers.get("x-user-id"))
+    return {"channel_id": channel_id, "days": days, "points": points}
+
+
+@app.post("/messages/delete", response_model=schemas.DeleteResult)
+async def delete_messages(data: DeleteRequest, request: Request = None):
     """
     Delete a list of messages using the user's Telethon session.
-    Input: {"messages": [{"recipientId": "...", "messageId": 123}, ...]}
+    Input: {"messages": [{"recipientId": "...", "messageId": 123, "accessHash": "..."?}, ...], "async": false}
+    Returns {success, failed, errors, total, done, chunks}, where each chunk is
+    {recipientId, ids, ok, error?}. With "async": true (or ?mode=async) returns
+    202 with a job to poll at GET /jobs/{job_id} (or /messages/delete/{job_id});
+    a failed or interrupted job resubmitted resumes after the chunks it deleted.
+    Invalid entries count as failed, with "item <index>: <reason>" in errors.
     """
     user_id = get_user_id_from_request(request)
     client = await get_or_init_client(user_id)
 
-    if not await client.is_user_authorized():
+    if not await auth.authorized(client, user_id):
         raise HTTPException(status_code=401, detail="Userbot not authorized")
 
-    messages = data.get("messages", [])
-    if not messages:
+    if not data.messages:
         raise HTTPException(status_code=400, detail="No messages provided")
+    messages, invalid = validate_batch(schemas.MessageRef, data.messages, request)
 
-    results = {"success": 0, "failed": 0, "errors": []}
-
-    # Group messages by peer (recipientId) to batch delete operations
-    # Format: { recipientId: [messageId1, messageId2] }
-    updates_by_peer = {}
+    # Large lists (e.g. expiring a broadcast) can run as a job instead of
+    # holding this request open
+    if wants_job(request, data.run_async):
+        return submit_job(request, user_id, "messages_delete", {"messages": messages, "rejected": invalid})
 
-    for msg in messages:
-        recipient_id = msg.get("recipientId")
-        message_id = msg.get("messageId")
-        
-        if not recipient_id or not message_id:
-            results["failed"] += 1
-            continue
-            
-        if recipient_id not in updates_by_peer:
-            updates_by_peer[recipient_id] = []
-        updates_by_peer[recipient_id].append(int(message_id))
+    results = await delete_pipeline.run_delete(client, peer_resolver(client, user_id), messages,
+                                               rejected=invalid)
+    return TimedJSONResponse(content=results, headers=throttle_headers(user_id))
 
-    for recipient_id, msg_ids in updates_by_peer.items():
-        try:
-            # Resolve peer - try as int first, then string
-            peer = None
-            try:
-                peer = int(recipient_id)
-            except ValueError:
-                peer = recipient_id
-            
-            # Explicitly resolve entity to ensure it's in cache or fetched
-            entity = None
-            try:
-                entity = await client.get_input_entity(peer)
-            except Exception as resolve_error:
-                print(f"⚠️ Resolution failed for {recipient_id}, trying explicit fetch... {resolve_error}")
-                try:
-                    # If resolution fails, try fetching dialogs first to populate cache
-                    await client.get_dialogs(limit=None) 
-                    entity = await client.get_input_entity(peer)
-                except Exception as fetch_error:
-                     print(f"❌ Could not resolve entity {recipient_id}: {fetch_error}")
-                     # Try raw peer as last resort
-                     entity = peer
-
-            # Perform deletion
-            await client.delete_messages(entity, msg_ids, revoke=True)
-            
-            print(f"✅ Deleted {len(msg_ids)} messages in {recipient_id}")
-            results["success"] += len(msg_ids)
-            
-        except Exception as e:
-            error_msg = str(e)
-            print(f"❌ Failed to delete messages in {recipient_id}: {error_msg}")
-            results["failed"] += len(msg_ids)
-            results["errors"].append(f"{recipient_id}: {error_msg}")
-
-    return results
+@app.get("/messages/delete/{job_id}", response_model=schemas.Job)
+async def get_delete_job(job_id: str, request: Request = None):
+    """
+    Progress and (partial) results of a delete job submitted with "async": true.
+    Same as GET /jobs/{job_id}, kept for existing callers.
+    """
+    user_id = get_user_id_from_request(request)
+    job = jobs.get(user_id, job_id, kind="messages_delete")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Delete job not found")
+    return TimedJSONResponse(content=jobs.view(job))
+
+def parse_points(value):
+    if value in (None, ""):
+        return None
+    try:
+        points = int(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="points must be a number")
+    return max(points, MIN_GRAPH_POINTS)
 
 @app.post("/channel-stats")
-async def get_channel_stats(data: dict = Body(...), request: Request = None):
-    print("🔹 Received request for /channel-stats")
+async def get_channel_stats(data: ChannelStatsRequest, request: Request = None):
     """
     Fetch official Telegram Channel Statistics (Growth, Followers).
     Requires Admin privileges and sufficient channel size.
+    Served from a per-channel cache (?fresh=true refetches). ?points=200 (or
+    "points" in the body) decimates every graph to about that many points,
+    keeping Telegram's columns/names format. Async graphs load in the
+    background; names still loading are listed in "pending".
+    ?mode=async fetches in a background job (202, see /jobs) that waits for
+    every graph; its result is {"<channelId>": stats}.
     """
     user_id = get_user_id_from_request(request)
     client = await get_or_init_client(user_id)
 
-    if not await client.is_user_authorized():
+    if not await auth.authorized(client, user_id):
         raise HTTPException(status_code=401, detail="Userbot not authorized")
 
-    channel_id = data.get("channelId")
+    channel_id = data.channelId
     if not channel_id:
         raise HTTPException(status_code=400, detail="Channel ID required")
 
-    try:
-        # Resolve peer
-        peer = None
-        try:
-            peer = int(channel_id)
-        except ValueError:
-            peer = channel_id
-
-        # Fetch stats
-        # Note: This works for Channels. For Groups, uses GetMegagroupStatsRequest.
-        # We try BroadcastStats first.
-        
-        # Telethon return complex structures. The graphs are 'types.StatsGraph' or 'types.StatsGraphError'.
-        # We need to extract the JSON from 'types.StatsGraph(json=...)'.
-        
-        from telethon.tl.functions.stats import GetBroadcastStatsRequest, GetMegagroupStatsRequest
-        from telethon.tl.types import StatsGraph, StatsGraphError
-        import json
-
-        stats = None
-        try:
-            stats = await client(GetBroadcastStatsRequest(channel=peer, dark=False))
-        except Exception as e:
-            # If failed (e.g. it's a group), try Megagroup stats
-            print(f"⚠️ GetBroadcastStats failed for {channel_id}, trying MegagroupStats: {e}")
-            try:
-                stats = await client(GetMegagroupStatsRequest(channel=peer, dark=False))
-            except Exception as e2:
-                raise HTTPException(status_code=400, detail=f"Stats not available (Not Admin or too small?): {e2}")
-
-        if not stats:
-             print("❌ No stats returned from Telethon call.")
-             raise HTTPException(status_code=404, detail="No stats returned")
-
-        # Helper to parse graph
-        def parse_graph(graph_obj):
-            if isinstance(graph_obj, StatsGraph):
-                data = json.loads(graph_obj.json.data)
-                print(f"📊 Graph Data Keys: {data.keys()}") 
-                if 'columns' in data:
-                     print(f"   Columns: {[c[0] for c in data['columns']]}")
-                if 'names' in data:
-                     print(f"   Names: {data['names']}")
-                return data
-            elif isinstance(graph_obj, StatsGraphError):
-                print(f"⚠️ Graph Error: {graph_obj.error}")
-                return {"error": graph_obj.error}
-            return None
-
-        print(f"✅ Stats Fetched for {channel_id}. Period: {stats.period.min_date} - {stats.period.max_date}")
-        
-        # Extract Growth (Total Subscribers) and Followers (Joined/Left)
-        # Note: 'growth_graph' is total, 'followers_graph' is net change usually.
-        # stats.followers.growth_graph -> usually the detailed subscriber count over time
-        # stats.growth_graph -> general growth
-        
-        # Let's return raw parsed graphs and let frontend process or map them here.
-        growth_data = parse_graph(stats.growth_graph)
-        followers_data = parse_graph(stats.followers.followers_graph) # Try pulling from interactions or checking other attrs if empty
-
-        return {
-            "period": f"{stats.period.min_date} to {stats.period.max_date}",
-            "followers": {
-                "current": stats.followers.current,
-                "previous": stats.followers.previous,
-                "growth_graph": growth_data,     
-                "followers_graph": followers_data 
-            },
-        }
+    points = parse_points(data.points if data.points is not None else request.query_params.get("points"))
+    fresh = parse_bool_param(request.query_params, "fresh", False) or data.fresh
+    if wants_job(request, data.run_async):
+        return submit_job(request, user_id, "channel_stats", {
+            "channels": [(channel_id, data.accessHash)],
+            "fields": "full", "points": points, "fresh": fresh,
+        })
 
+    resolve = peer_resolver(client, user_id)
+    try:
+        peer = await resolve(channel_id, data.accessHash)
+        entry, cached = await channel_stats.get(client, user_id, channel_id, peer, fresh=fresh)
+        await channel_stats.wait_graphs(entry)
+        return entry.view("full", points, cached)
+    except StatsUnavailable as e:
+        invalidate_on(resolve, channel_id, e)
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        print(f"❌ Failed to fetch stats for {channel_id}: {e}")
-        # Return generic structure to prevent frontend crash, but with error
-        return JSONResponse(status_code=500, content={"detail": str(e)})
-        # Or just raise:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.warning("Failed to fetch stats for %s: %s", channel_id, e)
+        invalidate_on(resolve, channel_id, e)
+        # Same {"detail": ...} body the frontend already handles; keeps 4xx/429 intact
+        raise http_error(e)
+
+
+@app.post("/channel-stats/batch")
+async def get_channel_stats_batch(data: ChannelStatsBatchRequest, request: Request = None):
+    """
+    Stats for many channels in one call (dashboard overview).
+    Input: {"channelIds": ["...", {"channelId": "...", "accessHash": "..."}, ...],
+            "fields": "summary" | "full", "points": 200?}
+    "summary" (default) returns counters only and never decodes graphs.
+    Returns {"<channelId>": stats} with {"error": "..."} for channels that failed.
+    With "async": true (or ?mode=async) channels are fetched in a background
+    job (202, see /jobs), checkpointed as they complete.
+    """
+    user_id = get_user_id_from_request(request)
+    client = await get_or_init_client(user_id)
+
+    if not await auth.authorized(client, user_id):
+        raise HTTPException(status_code=401, detail="Userbot not authorized")
+
+    channels = []
+    for item in data.channelIds:
+        if isinstance(item, ChannelRef):
+            channel_id, access_hash = item.channelId, item.accessHash
+        else:
+            channel_id, access_hash = item, None
+        if channel_id not in {c for c, _ in channels}:
+            channels.append((channel_id, access_hash))
+    if not channels:
+        raise HTTPException(status_code=400, detail="channelIds required")
+
+    fields = data.fields
+    points = parse_points(data.points if data.points is not None else request.query_params.get("points"))
+    fresh = parse_bool_param(request.query_params, "fresh", False) or data.fresh
+    if wants_job(request, data.run_async):
+        return submit_job(request, user_id, "channel_stats",
+                          {"channels": channels, "fields": fields, "points": points, "fresh": fresh})
+
+    results = await channel_stats.get_many(client, user_id, channels, peer_resolver(client, user_id),
+                                           fields=fields, points=points, fresh=fresh)
+    return TimedJSONResponse(content=results, headers=throttle_headers(user_id))
+
+
+# --- Jobs ---
+
+def get_job(request: Request, job_id: str) -> dict:
+    job = jobs.get(get_user_id_from_request(request), job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs")
+async def list_jobs(request: Request = None):
+    """The account's jobs, newest first (without results)."""
+    return {"jobs": jobs.list(get_user_id_from_request(request))}
+
+@app.get("/jobs/{job_id}", response_model=schemas.Job)
+async def get_job_status(job_id: str, since: int = -1, wait: float = 0, request: Request = None):
+    """
+    A job's status, progress and (partial) result. Long-poll with
+    ?since=<version>&wait=<seconds>: returns as soon as the job's "version"
+    moves past `since` or it finishes (wait capped at 30s).
+    """
+    job = get_job(request, job_id)
+    await jobs.wait(job, since, min(max(wait, 0), 30))
+    return TimedJSONResponse(content=jobs.view(job))
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request = None):
+    """
+    Server-Sent Events: an "event: job" with the job's status and progress on
+    every change, the last one (status done/failed/cancelled) with its result.
+    """
+    job = get_job(request, job_id)
+
+    async def stream():
+        async for view in jobs.events(job):
+            if view is None:
+                yield b": keepalive\n\n"
+            else:
+                yield b"event: job\nid: %d\ndata: %s\n\n" % (view["version"], telemetry.dumps(view))
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, request: Request = None):
+    """Cancel a queued or running job; results so far stay in its checkpoint."""
+    return jobs.cancel(get_job(request, job_id))
 
 
 if __name__ == "__main__":
     port = int(os.getenv("PYTHON_PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if shards.enabled and "SHARD_INDEX" not in os.environ:
+        # One process per shard on this host; see sharding.py
+        sharding.launch("main:app", shards.count, port)
+    else:
+        import uvicorn  # only needed to serve directly
+        uvicorn.run(app, host="0.0.0.0", port=port)
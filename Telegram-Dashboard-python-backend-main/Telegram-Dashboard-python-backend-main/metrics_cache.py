@@ -0,0 +1,162 @@
+"""
+Short-TTL, in-process cache of per-message metrics.
+
+Keyed by (account, peer, message_id). Bounded with LRU eviction. Identical
+lookups that arrive while a fetch is already in flight wait for that fetch
+instead of issuing their own RPC (request coalescing). Both GET /analytics and
+POST /analytics/batch read through it.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", 60))  # seconds
+METRICS_CACHE_MAX = int(os.getenv("METRICS_CACHE_MAX", 100_000))
+
+Key = Tuple[str, str, int]
+
+
+def cache_key(account: str, chat_id, msg_id) -> Key:
+    return (str(account), str(chat_id), int(msg_id))
+
+
+def annotate(metrics: dict, cached: bool, age: float) -> dict:
+    """
+    Copy of `metrics` saying whether it came from cache and how old it is.
+    """
+    return {**metrics, "cached": cached, "age": round(age, 1)}
+
+
+class MetricsCache:
+    def __init__(self, ttl: float = METRICS_CACHE_TTL, max_entries: int = METRICS_CACHE_MAX,
+                 on_put: Callable[[Key, dict], None] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Called with every freshly fetched snapshot (e.g. to record history)
+        self.on_put = on_put
+        self._entries: "OrderedDict[Key, Tuple[dict, float]]" = OrderedDict()
+        self._inflight: Dict[Key, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key: Key, fields: Iterable[str] = None) -> Optional[Tuple[dict, float]]:
+        """
+        Fresh (metrics, age) for key, or None. Counts a hit on success.
+        With `fields`, an entry lacking any of them (a counters-only fetch
+        when full metrics are wanted) is a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        metrics, fetched_at = entry
+        age = time.monotonic() - fetched_at
+        if age > self.ttl:
+            del self._entries[key]
+            return None
+        if fields is not None and any(field not in metrics for field in fields):
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return metrics, age
+
+    def inflight(self, key: Key) -> Optional[asyncio.Future]:
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    def claim(self, key: Key) -> asyncio.Future:
+        """
+        Register the caller as the one fetching `key`; others will wait on
+        the returned future. Must be followed by resolve() or fail().
+        """
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    def put(self, key: Key, metrics: dict):
+        """
+        Store a fresh snapshot. A narrower one (?fields=counters) over a
+        fresh wider entry updates its fields and keeps the rest, with the
+        older timestamp so those still expire on time.
+        """
+        entry, fetched_at = (metrics, time.monotonic())
+        current = self._entries.get(key)
+        if (current is not None and not current[0].keys() <= metrics.keys()
+                and fetched_at - current[1] <= self.ttl):
+            entry, fetched_at = {**current[0], **metrics}, current[1]
+        self._entries[key] = (entry, fetched_at)
+        if self.on_put is not None:
+            self.on_put(key, metrics)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def resolve(self, key: Key, metrics: dict):
+        self.put(key, metrics)
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(metrics)
+
+    def fail(self, key: Key, error: BaseException):
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+            # Nobody may be waiting; don't let asyncio log "never retrieved"
+            future.exception()
+
+    async def get_or_fetch(self, key: Key, fetch: Callable[[], Awaitable[dict]],
+                           fresh: bool = False) -> Tuple[dict, bool, float]:
+        """
+        Single-key read-through. Returns (metrics, cached, age).
+        fresh=True skips the cached value but still coalesces with, and
+        feeds, concurrent lookups.
+        """
+        if not fresh:
+            hit = self.lookup(key)
+            if hit:
+                return hit[0], True, hit[1]
+
+        future = self.inflight(key)
+        if future is not None:
+            return await asyncio.shield(future), True, 0.0
+
+        self.claim(key)
+        try:
+            metrics = await fetch()
+        except BaseException as e:
+            self.fail(key, e if isinstance(e, Exception) else RuntimeError("Fetch cancelled"))
+            raise
+        self.resolve(key, metrics)
+        return metrics, False, 0.0
+
+    def invalidate(self, account: str = None):
+        if account is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] == account]:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "inflight": len(self._inflight),
+            "ttl": self.ttl,
+            "max": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,298 @@
+"""
+FloodWait-aware request scheduler, one per Telegram account.
+
+Every Telethon RPC made by a pooled client goes through
+ScheduledTelegramClient.__call__, so the high-level helpers
+(get_messages, iter_dialogs, delete_messages, ...) are covered too.
+
+- A token bucket keeps each account under Telegram's rate limits.
+- Waiting callers are served by priority (interactive before normal before
+  background), FIFO within a priority.
+- A FloodWait pauses every caller for that account, not just the request that
+  hit it. Callers sleep through pauses up to a per-priority limit and retry;
+  longer pauses raise Throttled carrying retry_after so the HTTP layer can
+  answer 429 instead of holding the request open.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from telethon import TelegramClient, errors
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BACKGROUND: "background"}
+
+# Sustained RPCs per second per account, and how many may burst at once
+TG_RPC_RATE = float(os.getenv("TG_RPC_RATE", 20))
+TG_RPC_BURST = int(os.getenv("TG_RPC_BURST", 30))
+# Longest FloodWait pause a caller of each priority will sleep through before
+# giving up with Throttled. Interactive requests fail fast; background work
+# (analytics polling) is happy to wait.
+MAX_WAIT = {
+    INTERACTIVE: int(os.getenv("INTERACTIVE_MAX_WAIT", 10)),  # seconds
+    NORMAL: int(os.getenv("NORMAL_MAX_WAIT", 30)),  # seconds
+    BACKGROUND: int(os.getenv("BACKGROUND_MAX_WAIT", 300)),  # seconds
+}
+
+# on_rpc(method, seconds, queued_seconds, outcome, flood_wait_seconds) after
+# every attempt; outcome is "ok", "flood" or "error"
+RpcCallback = Callable[[str, float, float, str, float], None]
+# on_unauthorized(account, error) when Telegram rejects the account's session
+# (AUTH_KEY_UNREGISTERED, SESSION_REVOKED, USER_DEACTIVATED, ...)
+UnauthorizedCallback = Callable[[str, Exception], None]
+
+current_priority: contextvars.ContextVar = contextvars.ContextVar("rpc_priority", default=NORMAL)
+
+
+@contextmanager
+def priority(level: int):
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class Throttled(Exception):
+    """The account is in a FloodWait; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        self.retry_after = max(1, int(retry_after))
+        super().__init__(f"FloodWait: retry after {self.retry_after}s")
+
+
+def request_name(request) -> str:
+    """
+    "channels.GetMessagesRequest": the TL namespace tells apart requests that
+    share a class name. Lists (sent as one container) use their first item.
+    """
+    if isinstance(request, (list, tuple)):
+        request = request[0] if request else None
+    return f"{type(request).__module__.rsplit('.', 1)[-1]}.{type(request).__name__}"
+
+
+def is_account_flood(e: Exception) -> bool:
+    # SLOW_MODE_WAIT is per chat, not per account
+    return (isinstance(e, errors.FloodError)
+            and not isinstance(e, errors.SlowModeWaitError)
+            and hasattr(e, "seconds"))
+
+
+class AccountScheduler:
+    def __init__(self, account: str, rate: float = TG_RPC_RATE, burst: int = TG_RPC_BURST,
+                 on_rpc: RpcCallback = None, on_unauthorized: UnauthorizedCallback = None):
+        self.account = account
+        # Called after every attempt (see RpcCallback), e.g. for /metrics
+        self.on_rpc = on_rpc
+        self.on_unauthorized = on_unauthorized
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+        self.calls = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.throttled = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self) -> int:
+        """Seconds left in the current FloodWait pause, 0 if not paused."""
+        return max(0, math.ceil(self.paused_until - time.monotonic()))
+
+    def pause(self, seconds: int):
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self._wakeup.set()
+        logger.warning("FloodWait of %ss, pausing account", seconds, extra={"account": self.account})
+
+    async def acquire(self, level: int = NORMAL):
+        remaining = self.retry_after()
+        if remaining > MAX_WAIT[level]:
+            self.throttled += 1
+            raise Throttled(remaining)
+
+        # Fast path: nobody queued, not paused, token available
+        if not self._waiters and not remaining:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted a token just as we were cancelled: give it back
+                self.tokens = min(self.burst, self.tokens + 1)
+            raise
+
+    async def _sleep(self, delay: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def _reject_impatient(self, remaining: int):
+        """Fail queued callers that won't wait out a pause this long."""
+        for level, _, future in self._waiters:
+            if not future.done() and remaining > MAX_WAIT[level]:
+                self.throttled += 1
+                future.set_exception(Throttled(remaining))
+
+    async def _dispatch(self):
+        while True:
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                return
+
+            now = time.monotonic()
+            if self.paused_until > now:
+                self._reject_impatient(math.ceil(self.paused_until - now))
+                await self._sleep(self.paused_until - now)
+                continue
+
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                _, _, future = heapq.heappop(self._waiters)
+                future.set_result(None)
+                continue
+
+            await self._sleep((1 - self.tokens) / self.rate)
+
+    async def call(self, fn, method: str = "rpc"):
+        """
+        Run `fn()` (a coroutine factory) once a token is available, handling
+        FloodWait for the whole account. `method` names the request in
+        on_rpc reports.
+        """
+        level = current_priority.get()
+        while True:
+            paused = self.retry_after() > 0
+            queued_at = time.perf_counter()
+            await self.acquire(level)
+            started = time.perf_counter()
+            queued = started - queued_at
+            self.calls += 1
+            outcome = "error"
+            try:
+                result = await fn()
+                outcome = "ok"
+                return result
+            except errors.UnauthorizedError as e:
+                if self.on_unauthorized is not None:
+                    self.on_unauthorized(self.account, e)
+                raise
+            except errors.FloodError as e:
+                if not is_account_flood(e):
+                    raise
+                outcome = "flood"
+                seconds = max(1, e.seconds)
+                self.pause(seconds)
+                if seconds <= MAX_WAIT[level]:
+                    continue
+                self.throttled += 1
+                raise Throttled(seconds) from e
+            finally:
+                if self.on_rpc is not None:
+                    # Waiting out a pause counts as FloodWait time, not queueing
+                    self.on_rpc(method, time.perf_counter() - started, queued,
+                                outcome, queued if paused else 0.0)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "queued": len(self._waiters),
+            "tokens": round(self.tokens, 2),
+            "retry_after": self.retry_after(),
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+            "throttled": self.throttled,
+        }
+
+
+class SchedulerRegistry:
+    """
+    Schedulers outlive pooled clients so a FloodWait pause survives eviction
+    and reconnects.
+    """
+
+    def __init__(self, on_rpc: RpcCallback = None, on_unauthorized: UnauthorizedCallback = None):
+        self._schedulers: Dict[str, AccountScheduler] = {}
+        # Passed to every scheduler created from now on
+        self.on_rpc = on_rpc
+        self.on_unauthorized = on_unauthorized
+
+    def get(self, account: str) -> AccountScheduler:
+        scheduler = self._schedulers.get(account)
+        if scheduler is None:
+            scheduler = self._schedulers[account] = AccountScheduler(account, on_rpc=self.on_rpc,
+                                                                     on_unauthorized=self.on_unauthorized)
+        return scheduler
+
+    def peek(self, account: str):
+        return self._schedulers.get(account)
+
+    def stats(self) -> dict:
+        return {
+            "accounts": len(self._schedulers),
+            "paused": sum(1 for s in self._schedulers.values() if s.retry_after()),
+            "flood_waits": sum(s.flood_waits for s in self._schedulers.values()),
+            "flood_wait_seconds": sum(s.flood_wait_seconds for s in self._schedulers.values()),
+            "throttled": sum(s.throttled for s in self._schedulers.values()),
+            "calls": sum(s.calls for s in self._schedulers.values()),
+        }
+
+
+schedulers = SchedulerRegistry()
+
+
+class ScheduledTelegramClient(TelegramClient):
+    """
+    TelegramClient whose every RPC is admitted by the account's scheduler.
+    Telethon's own flood sleeping is disabled so FloodWaits reach us.
+    """
+
+    def __init__(self, *args, scheduler: AccountScheduler, **kwargs):
+        kwargs.setdefault("flood_sleep_threshold", 0)
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        return await self.scheduler.call(
+            lambda: TelegramClient.__call__(self, request, ordered=ordered,
+                                            flood_sleep_threshold=flood_sleep_threshold),
+            method=request_name(request),
+        )
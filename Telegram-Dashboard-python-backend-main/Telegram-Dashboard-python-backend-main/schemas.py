@@ -0,0 +1,229 @@
+"""
+Request and response models.
+
+- Request bodies are Pydantic (v2) models. Optional fields stay optional where
+  an endpoint already answers 400 with its own message for a missing value.
+- Batch payloads (analytics, tracking, deletes) are validated item by item
+  with validate_items(): valid entries come back as plain dicts, the same
+  thing the pipelines consumed before, and each invalid one is reported as
+  {"index", "error"} instead of being dropped silently.
+- Response models describe what the endpoints return (OpenAPI). The hot
+  endpoints return a TimedJSONResponse (orjson) themselves, so FastAPI
+  neither re-validates nor runs jsonable_encoder over 10k-entry bodies.
+"""
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, StringConstraints, TypeAdapter, ValidationError
+from typing_extensions import Annotated, NotRequired, TypedDict
+
+
+def _id_string(value):
+    # Node sends ids as strings, but plain JSON numbers are fine too
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+PeerId = Annotated[str, StringConstraints(min_length=1), BeforeValidator(_id_string)]
+# Same, but "" gets through: the endpoint answers it with its own 400, or
+# (access hashes) treats it as missing
+OptionalId = Annotated[str, BeforeValidator(_id_string)]
+MessageId = Annotated[int, Field(gt=0)]
+
+
+class Model(BaseModel):
+    model_config = ConfigDict(extra="ignore", populate_by_name=True)
+
+
+# --- Batch items (validated per item, kept as dicts) ---
+
+class MessageRef(TypedDict):
+    recipientId: PeerId
+    messageId: MessageId
+    accessHash: NotRequired[Optional[PeerId]]
+
+
+class TrackItem(MessageRef):
+    taskId: NotRequired[Optional[PeerId]]
+    postedAt: NotRequired[Union[float, str, None]]
+
+
+class TaskItem(MessageRef):
+    type: NotRequired[Optional[Literal["channel", "group", "user"]]]
+
+
+class ItemError(Model):
+    index: int
+    error: str
+
+
+_adapters: Dict[type, TypeAdapter] = {}
+
+
+def _adapter(item_type: type) -> TypeAdapter:
+    adapter = _adapters.get(item_type)
+    if adapter is None:
+        adapter = _adapters[item_type] = TypeAdapter(List[item_type])
+    return adapter
+
+
+def describe(errors: List[dict]) -> str:
+    """One line per Pydantic error: "messageId: Input should be greater than 0"."""
+    return "; ".join(
+        f"{'.'.join(str(part) for part in error['loc']) or 'item'}: {error['msg']}" for error in errors
+    )
+
+
+def validate_items(item_type: type, items) -> Tuple[List[dict], List[dict]]:
+    """
+    Validate a batch payload. Returns (valid items as dicts in payload order,
+    [{"index", "error"}, ...] for the rest). The whole list is validated in
+    one pass; only a batch with bad entries needs a second one.
+    """
+    if not isinstance(items, list):
+        raise ValueError("Expected a list of messages")
+    adapter = _adapter(item_type)
+    try:
+        return adapter.validate_python(items), []
+    except ValidationError as e:
+        by_index: Dict[int, List[dict]] = {}
+        for error in e.errors(include_url=False):
+            index, *loc = error["loc"]
+            by_index.setdefault(index, []).append({**error, "loc": tuple(loc)})
+
+    valid = adapter.validate_python([item for i, item in enumerate(items) if i not in by_index])
+    errors = [{"index": index, "error": describe(errors)} for index, errors in sorted(by_index.items())]
+    return valid, errors
+
+
+# --- Request bodies ---
+
+class CredentialsRequest(Model):
+    api_id: Optional[OptionalId] = None
+    api_hash: Optional[str] = None
+
+
+class CodeRequest(Model):
+    phone: Optional[str] = None
+
+
+class SignInRequest(Model):
+    phone: Optional[str] = None
+    code: Optional[OptionalId] = None
+    phone_code_hash: Optional[str] = None
+
+
+class LoggingSettingsRequest(Model):
+    level: Optional[str] = None
+    item_debug: Optional[bool] = None
+    sample_rates: Optional[Dict[str, float]] = None
+
+
+class DeleteRequest(Model):
+    # Items are validated one by one so a bad entry only fails itself
+    messages: List[Any] = []
+    run_async: bool = Field(False, alias="async")
+
+
+class ChannelRef(Model):
+    channelId: PeerId
+    accessHash: Optional[OptionalId] = None
+
+
+class ChannelStatsRequest(Model):
+    channelId: Optional[OptionalId] = None
+    accessHash: Optional[OptionalId] = None
+    points: Optional[int] = None
+    fresh: bool = False
+    run_async: bool = Field(False, alias="async")
+
+
+class ChannelStatsBatchRequest(Model):
+    channelIds: List[Union[ChannelRef, PeerId]] = []
+    fields: Literal["summary", "full"] = "summary"
+    points: Optional[int] = None
+    fresh: bool = False
+    run_async: bool = Field(False, alias="async")
+
+
+class ChannelGrowthRequest(Model):
+    channel_id: Optional[PeerId] = None
+    days: Optional[float] = None
+
+
+# --- Responses ---
+
+class Dialog(Model):
+    telegramId: str
+    name: Optional[str] = None
+    username: Optional[str] = None
+    type: str
+    accessHash: Optional[str] = None
+
+
+class DialogPageEntry(Dialog):
+    canSend: bool
+    archived: bool
+    folderId: Optional[int] = None
+
+
+class DialogPage(Model):
+    items: List[DialogPageEntry]
+    next_cursor: Optional[str] = None
+    total: int
+    stale_since: Optional[str] = None
+
+
+class MessageMetrics(Model):
+    # With ?fields= only the requested counters are present
+    views: Optional[int] = None
+    forwards: Optional[int] = None
+    replies: Optional[int] = None
+    reactions: Optional[int] = None
+    voters: Optional[int] = None
+    cached: Optional[bool] = None
+    age: Optional[float] = None
+
+
+class DeleteChunk(Model):
+    recipientId: str
+    ids: List[int]
+    ok: bool
+    error: Optional[str] = None
+
+
+class DeleteResult(Model):
+    success: int
+    failed: int
+    errors: List[str]
+    total: int
+    done: int
+    chunks: List[DeleteChunk]
+
+
+class TrackResult(Model):
+    tracked: int
+    total: int
+    seq: int
+    invalid: List[ItemError] = []
+
+
+class JobProgress(Model):
+    done: int
+    total: int
+
+
+class Job(Model):
+    id: str
+    kind: str
+    status: Literal["queued", "running", "done", "failed", "cancelled"]
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    attempts: int
+    version: int
+    progress: JobProgress
+    result: Any = None
+    error: Optional[str] = None
+    retry_after: Optional[int] = None
+    deduplicated: Optional[bool] = None
@@ -0,0 +1,233 @@
+"""
+Pluggable storage for Telethon sessions.
+
+SESSION_BACKEND selects where a client's session lives:
+- "file" (default): Telethon's SQLite file `user_sessions/session_<user_id>.session`,
+  as before. Every entity cache update is a synchronous disk write.
+- "memory": an in-memory StringSession. The parts needed to reconnect (DC and
+  auth key) are snapshotted every SESSION_SNAPSHOT_INTERVAL seconds when they
+  changed, and when the client closes, to `user_sessions/session_<user_id>.snap`.
+  Entities are cached in memory only; entity_resolver.py persists the ones
+  we need.
+- "shared": like "memory" but snapshots go to a store every node can reach:
+  Redis when SESSION_REDIS_URL is set (needs the `redis` package), otherwise
+  a directory (SESSION_SHARED_DIR, e.g. a network mount) as a stand-in.
+
+Existing SQLite sessions are imported on first use in the snapshot modes.
+With SESSION_ENCRYPTION_KEY (a Fernet key; needs the `cryptography` package)
+snapshots are encrypted at rest.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import pathlib
+from typing import Dict, Optional, Union
+
+from telethon.sessions import Session, SQLiteSession, StringSession
+
+logger = logging.getLogger(__name__)
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "file")
+SESSION_SNAPSHOT_INTERVAL = int(os.getenv("SESSION_SNAPSHOT_INTERVAL", 60))  # seconds
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL")
+SESSION_SHARED_DIR = os.getenv("SESSION_SHARED_DIR")
+SESSION_ENCRYPTION_KEY = os.getenv("SESSION_ENCRYPTION_KEY")
+
+BACKENDS = ("file", "memory", "shared")
+REDIS_PREFIX = "tg:session:"
+
+
+def optional_import(name: str):
+    """
+    Import an optional dependency only when its feature is configured, so
+    deployments that don't use it don't pay for the import at startup.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+class DirectorySnapshotStore:
+    """One file per user; writes are atomic."""
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, user_id: str) -> pathlib.Path:
+        return self.directory / f"session_{user_id}.snap"
+
+    async def get(self, user_id: str) -> Optional[bytes]:
+        path = self._path(user_id)
+        try:
+            return await asyncio.to_thread(path.read_bytes)
+        except FileNotFoundError:
+            return None
+
+    async def put(self, user_id: str, data: bytes):
+        path = self._path(user_id)
+        tmp = path.with_suffix(".tmp")
+
+        def write():
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+
+        await asyncio.to_thread(write)
+
+    async def delete(self, user_id: str):
+        try:
+            self._path(user_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def describe(self) -> str:
+        return f"dir:{self.directory}"
+
+
+class RedisSnapshotStore:
+    def __init__(self, url: str, aioredis):
+        self.url = url
+        self._redis = aioredis.from_url(url)
+
+    async def get(self, user_id: str) -> Optional[bytes]:
+        return await self._redis.get(REDIS_PREFIX + user_id)
+
+    async def put(self, user_id: str, data: bytes):
+        await self._redis.set(REDIS_PREFIX + user_id, data)
+
+    async def delete(self, user_id: str):
+        await self._redis.delete(REDIS_PREFIX + user_id)
+
+    def describe(self) -> str:
+        return "redis"
+
+
+class SessionStore:
+    def __init__(self, session_dir: pathlib.Path, backend: str = SESSION_BACKEND,
+                 encryption_key: str = SESSION_ENCRYPTION_KEY,
+                 interval: int = SESSION_SNAPSHOT_INTERVAL):
+        if backend not in BACKENDS:
+            raise ValueError(f"SESSION_BACKEND must be one of {', '.join(BACKENDS)}")
+        fernet = optional_import("cryptography.fernet") if encryption_key else None
+        if encryption_key and fernet is None:
+            raise RuntimeError("SESSION_ENCRYPTION_KEY requires the cryptography package")
+
+        self.session_dir = session_dir
+        self.backend = backend
+        self.interval = interval
+        self._fernet = fernet.Fernet(encryption_key) if encryption_key else None
+        self.snapshots = None
+        if backend == "memory":
+            self.snapshots = DirectorySnapshotStore(session_dir)
+        elif backend == "shared":
+            aioredis = optional_import("redis.asyncio") if SESSION_REDIS_URL else None
+            if aioredis is not None:
+                self.snapshots = RedisSnapshotStore(SESSION_REDIS_URL, aioredis)
+            else:
+                if SESSION_REDIS_URL:
+                    logger.warning("SESSION_REDIS_URL set but redis is not installed; using a directory")
+                shared = pathlib.Path(SESSION_SHARED_DIR) if SESSION_SHARED_DIR else session_dir / "shared"
+                self.snapshots = DirectorySnapshotStore(shared)
+
+        # Sessions of open clients and the last snapshot written for each
+        self._open: Dict[str, Session] = {}
+        self._saved: Dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.saves = 0
+        self.imports = 0
+
+    def _encode(self, value: str) -> bytes:
+        data = value.encode()
+        return self._fernet.encrypt(data) if self._fernet else data
+
+    def _decode(self, data: bytes) -> str:
+        return (self._fernet.decrypt(data) if self._fernet else data).decode()
+
+    async def open(self, user_id: str) -> Union[str, Session]:
+        """
+        Session argument for TelegramClient: a file path in "file" mode,
+        otherwise a StringSession restored from the latest snapshot.
+        """
+        path = self.session_dir / f"session_{user_id}"
+        if self.snapshots is None:
+            return str(path)
+
+        string = ""
+        data = await self.snapshots.get(user_id)
+        if data:
+            string = self._decode(data)
+        elif path.with_suffix(".session").exists():
+            # Carry over a session created in file mode
+            legacy = SQLiteSession(str(path))
+            string = StringSession.save(legacy)
+            legacy.close()
+            self.imports += 1
+            logger.info("Imported file session into %s store", self.backend, extra={"account": user_id})
+
+        session = StringSession(string or None)
+        self._open[user_id] = session
+        self._saved[user_id] = string
+        return session
+
+    async def save(self, user_id: str):
+        """Write a snapshot if the DC or auth key changed since the last one."""
+        session = self._open.get(user_id)
+        if session is None:
+            return
+        string = StringSession.save(session)
+        if string == self._saved.get(user_id):
+            return
+        await self.snapshots.put(user_id, self._encode(string))
+        self._saved[user_id] = string
+        self.saves += 1
+
+    async def release(self, user_id: str):
+        """Final snapshot once the user's client is closed."""
+        if user_id not in self._open:
+            return
+        try:
+            await self.save(user_id)
+        except Exception as e:
+            logger.warning("Could not snapshot session: %s", e, extra={"account": user_id})
+        self._open.pop(user_id, None)
+        self._saved.pop(user_id, None)
+
+    async def delete(self, user_id: str):
+        """Forget a user's session everywhere (logout)."""
+        self._open.pop(user_id, None)
+        self._saved.pop(user_id, None)
+        if self.snapshots is not None:
+            await self.snapshots.delete(user_id)
+
+    async def _snapshot_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for user_id in list(self._open):
+                try:
+                    await self.save(user_id)
+                except Exception as e:
+                    logger.warning("Could not snapshot session: %s", e, extra={"account": user_id})
+
+    def start(self):
+        if self.snapshots is not None and self._task is None:
+            self._task = asyncio.create_task(self._snapshot_forever())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for user_id in list(self._open):
+            await self.release(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "store": self.snapshots.describe() if self.snapshots else "file",
+            "encrypted": self._fernet is not None,
+            "open": len(self._open),
+            "saves": self.saves,
+            "imports": self.imports,
+        }
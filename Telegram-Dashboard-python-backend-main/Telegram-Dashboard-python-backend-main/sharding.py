@@ -0,0 +1,275 @@
+"""
+Multi-process / multi-node mode with sticky user sharding.
+
+Telethon sessions are SQLite files and every client lives in one process's
+pool, so two workers serving the same account corrupt its session or
+double-connect it. Instead each account is owned by exactly one shard:
+- users are mapped to SHARD_COUNT shards with a consistent hash ring over
+  `x-user-id`, so changing the shard count moves as few users as possible,
+- a shard receiving a request for a user it doesn't own either proxies it
+  to the owner (SHARD_PROXY=true, needs SHARD_URLS and httpx) or answers
+  421 with an `X-Shard-Owner` header. A front proxy can route on
+  GET /shard?user_id=... or retry on that header,
+- a shard takes an exclusive lease (flock on `session_<user_id>.lease`)
+  before opening a session and releases it when the client is closed, so a
+  session moving between shards (rolling restart, shard count change) is
+  never open in two processes at once.
+
+Configuration (all optional; SHARD_COUNT=1 is the single-process default):
+    SHARD_COUNT=4 SHARD_INDEX=2
+    SHARD_URLS=http://10.0.0.1:8000,http://10.0.0.2:8000,...   (by shard index)
+    SHARD_PROXY=true
+
+`python main.py` with SHARD_COUNT>1 and no SHARD_INDEX runs every shard
+locally via launch(): shard 0 on PYTHON_PORT proxies to shards 1..N-1 on the
+following ports, so callers keep using a single URL.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, leases become no-ops
+    fcntl = None
+
+from starlette.datastructures import Headers
+
+logger = logging.getLogger(__name__)
+
+_httpx = None
+
+
+def load_httpx():
+    """
+    httpx, imported on first use: only proxying to other shards needs it and
+    it adds noticeably to startup. None when it isn't installed.
+    """
+    global _httpx
+    if _httpx is None:
+        try:
+            import httpx
+        except ImportError:
+            httpx = False
+        _httpx = httpx
+    return _httpx or None
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+SHARD_URLS = [u.strip().rstrip("/") for u in os.getenv("SHARD_URLS", "").split(",") if u.strip()]
+SHARD_PROXY = os.getenv("SHARD_PROXY", "false").lower() in ("1", "true", "yes")
+# Virtual nodes per shard on the ring; more = smoother distribution
+SHARD_VNODES = 64
+
+OWNER_HEADER = "X-Shard-Owner"
+FORWARDED_HEADER = "x-shard-forwarded"
+# Paths answered by any shard
+UNSHARDED_PATHS = ("/shard", "/admin/")
+
+
+class SessionLeased(Exception):
+    """The session is open in another process (another shard still owns it)."""
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, shards: int, vnodes: int = SHARD_VNODES):
+        self.shards = shards
+        points = sorted((_hash(f"shard-{s}-{v}"), s) for s in range(shards) for v in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def owner(self, key: str) -> int:
+        if self.shards <= 1:
+            return 0
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[i]
+
+
+class ShardMap:
+    def __init__(self, index: int = SHARD_INDEX, count: int = SHARD_COUNT,
+                 urls: List[str] = None, proxy: bool = SHARD_PROXY):
+        self.index = index
+        self.count = max(1, count)
+        self.urls = urls if urls is not None else SHARD_URLS
+        self.proxy = proxy
+        self.ring = HashRing(self.count)
+        self.misrouted = 0
+        self.proxied = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    def owner(self, user_id: str) -> int:
+        return self.ring.owner(str(user_id))
+
+    def owns(self, user_id: str) -> bool:
+        return self.owner(user_id) == self.index
+
+    def url_for(self, index: int) -> Optional[str]:
+        return self.urls[index] if index < len(self.urls) else None
+
+    def describe(self, user_id: str = None) -> dict:
+        info = {"index": self.index, "count": self.count, "urls": self.urls, "proxy": self.proxy}
+        if user_id:
+            owner = self.owner(user_id)
+            info.update({"user_id": user_id, "owner": owner, "owner_url": self.url_for(owner),
+                         "owned": owner == self.index})
+        return info
+
+    def stats(self) -> dict:
+        return {"index": self.index, "count": self.count,
+                "misrouted": self.misrouted, "proxied": self.proxied}
+
+
+class SessionLeases:
+    """
+    Exclusive per-session locks held for as long as a client is open.
+    flock locks die with the process, so a crashed shard never strands one.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self._held: Dict[str, int] = {}
+
+    def acquire(self, user_id: str):
+        if fcntl is None or user_id in self._held:
+            return
+        fd = os.open(str(self.directory / f"session_{user_id}.lease"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            raise SessionLeased(f"Session for {user_id} is open in another worker")
+        self._held[user_id] = fd
+
+    def release(self, user_id: str):
+        fd = self._held.pop(user_id, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def held(self) -> int:
+        return len(self._held)
+
+
+class ShardMiddleware:
+    """
+    Sends requests for users owned by another shard there (proxy mode) or
+    back to the caller with 421 + X-Shard-Owner.
+    """
+
+    def __init__(self, app, shards: ShardMap):
+        self.app = app
+        self.shards = shards
+        self._client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.shards.enabled or scope["path"].startswith(UNSHARDED_PATHS):
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        user_id = headers.get("x-user-id")
+        if not user_id or self.shards.owns(user_id):
+            return await self.app(scope, receive, send)
+
+        owner = self.shards.owner(user_id)
+        url = self.shards.url_for(owner)
+        # Never forward twice: shards disagreeing on the ring must surface
+        if self.shards.proxy and url and FORWARDED_HEADER not in headers and load_httpx():
+            self.shards.proxied += 1
+            return await self._proxy(scope, receive, send, url)
+
+        self.shards.misrouted += 1
+        await self._reply(send, 421, b'{"detail":"User is served by another shard"}',
+                          [(OWNER_HEADER.lower().encode(), str(owner).encode())]
+                          + ([(b"location", url.encode())] if url else []))
+
+    @staticmethod
+    async def _reply(send, status: int, body: bytes, headers: list = ()):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), *headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _proxy(self, scope, receive, send, base_url: str):
+        httpx = load_httpx()
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        if self._client is None:
+            # No timeout: long-polls and streamed batches can legitimately take minutes
+            self._client = httpx.AsyncClient(timeout=None)
+        url = base_url + scope["path"]
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode()
+        headers = [(k, v) for k, v in scope["headers"] if k not in (b"host", b"content-length")]
+        headers.append((FORWARDED_HEADER.encode(), str(self.shards.index).encode()))
+
+        try:
+            response = await self._client.send(
+                self._client.build_request(scope["method"], url, headers=headers, content=body),
+                stream=True,
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Proxy to %s failed: %s", base_url, e)
+            return await self._reply(send, 502, b'{"detail":"Owning shard unreachable"}')
+
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(k, v) for k, v in response.headers.raw
+                            if k.lower() not in (b"transfer-encoding", b"connection")],
+            })
+            # Raw bytes so streamed (NDJSON) responses pass through as they arrive
+            async for chunk in response.aiter_raw():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await response.aclose()
+
+
+def launch(app_path: str, count: int, port: int, host: str = "0.0.0.0"):
+    """
+    Run `count` local shards as uvicorn processes on port..port+count-1.
+    Shard 0 gets the public port and proxies everyone else's users.
+    """
+    urls = ",".join(f"http://127.0.0.1:{port + i}" for i in range(count))
+    processes = []
+    for index in range(count):
+        env = {**os.environ, "SHARD_COUNT": str(count), "SHARD_INDEX": str(index),
+               "SHARD_URLS": urls, "SHARD_PROXY": "true"}
+        shard_host = host if index == 0 else "127.0.0.1"
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", app_path, "--host", shard_host, "--port", str(port + index)],
+            env=env,
+        ))
+    logger.info("Started %d shards on ports %d-%d", count, port, port + count - 1)
+
+    def stop(signum, frame):
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # If any shard exits, take the rest down too so the supervisor restarts us
+    try:
+        os.wait()
+    except ChildProcessError:
+        pass
+    stop(None, None)
+    for process in processes:
+        process.wait()
@@ -0,0 +1,234 @@
+"""
+Task-level analytics rollups.
+
+Node's analyticsService.getTaskAnalytics used to pull every sentMessages
+entry of a task and aggregate the per-message dicts from /analytics/batch
+in JS. summarize() does that here instead and returns a compact summary:
+totals, a per-type (channel/group/user) breakdown, percentiles, engagement
+rates and the top/bottom recipients. Per-message detail is only included
+on request.
+
+Metrics go into one (messages x counters) float array, so every figure is
+a NumPy reduction rather than a loop over dicts. Counters a message
+doesn't have (failed fetches, ?fields=counters) are NaN and left out of
+sums and percentiles.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+
+COUNTERS = ("views", "forwards", "replies", "reactions", "voters")
+# What counts as an interaction for engagement rates (per view)
+ENGAGEMENT = ("forwards", "replies", "reactions", "voters")
+RANK_KEYS = (*COUNTERS, "engagement", "messages")
+PERCENTILES = (50, 90, 99)
+
+TOP_DEFAULT = 10
+TOP_MAX = 100
+
+
+def peer_type(chat_id: str) -> str:
+    """Best guess from a marked id when the dialog index doesn't know the chat."""
+    try:
+        marked = int(chat_id)
+    except (TypeError, ValueError):
+        return "channel"  # @username: channels are the usual case
+    if marked > 0:
+        return "user"
+    # -100... ids are channels; supergroups look the same without the index
+    return "channel" if str(marked).startswith("-100") else "group"
+
+
+def _number(value) -> Optional[float]:
+    if value is None or np.isnan(value):
+        return None
+    value = float(value)
+    return int(value) if value.is_integer() else round(value, 4)
+
+
+def _ratio(interactions: np.ndarray, views: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(views > 0, interactions / views, np.nan)
+
+
+def _counters(sums: np.ndarray, present: np.ndarray) -> dict:
+    # A counter nobody reported (e.g. voters with ?fields=counters) is None, not 0
+    return {name: _number(sums[i]) if present[i] else None for i, name in enumerate(COUNTERS)}
+
+
+class _Matrix:
+    """Rows of (recipientId, messageId, type, metrics) as arrays."""
+
+    def __init__(self, rows: List[dict]):
+        self.rows = rows
+        # None (missing counter or no metrics at all) becomes NaN
+        empty = (None,) * len(COUNTERS)
+        self.values = np.array([tuple(map(row["metrics"].get, COUNTERS)) if row.get("metrics") else empty
+                                for row in rows], dtype=float).reshape(len(rows), len(COUNTERS))
+        self.measured = ~np.isnan(self.values).all(axis=1)
+        self.present = ~np.isnan(self.values).all(axis=0)
+        self.engagement_columns = [COUNTERS.index(c) for c in ENGAGEMENT if self.present[COUNTERS.index(c)]]
+
+        self.type_names, self.type_of = np.unique([row["type"] for row in rows], return_inverse=True)
+        self.recipient_ids, self.recipient_of = np.unique([row["recipientId"] for row in rows],
+                                                          return_inverse=True)
+
+    def interactions(self, values: np.ndarray) -> np.ndarray:
+        if not self.engagement_columns:
+            return np.full(len(values), np.nan)
+        return np.nansum(values[:, self.engagement_columns], axis=1)
+
+    def grouped(self, groups: np.ndarray, size: int) -> tuple:
+        """
+        (per-group counter sums, which counters each group reported at all,
+        per-group message counts, per-group measured counts).
+        """
+        sums = np.zeros((size, len(COUNTERS)))
+        np.add.at(sums, groups, np.nan_to_num(self.values))
+        reported = np.zeros((size, len(COUNTERS)), dtype=int)
+        np.add.at(reported, groups, ~np.isnan(self.values))
+        return (sums, reported > 0, np.bincount(groups, minlength=size),
+                np.bincount(groups, weights=self.measured, minlength=size))
+
+
+def _engagement(matrix: _Matrix, sums: np.ndarray) -> Optional[np.ndarray]:
+    if not matrix.engagement_columns:
+        return None
+    views = sums[..., COUNTERS.index("views")]
+    return _ratio(sums[..., matrix.engagement_columns].sum(axis=-1), views)
+
+
+def _group_rates(matrix: _Matrix, sums: np.ndarray, measured: np.ndarray) -> Optional[np.ndarray]:
+    # A group without a single measured message has no rate, not 0
+    rates = _engagement(matrix, sums)
+    return None if rates is None else np.where(measured > 0, rates, np.nan)
+
+
+def _percentiles(matrix: _Matrix) -> dict:
+    values = matrix.values[matrix.measured]
+    rates = _ratio(matrix.interactions(values), values[:, COUNTERS.index("views")])
+    columns = {name: values[:, i] for i, name in enumerate(COUNTERS) if matrix.present[i]}
+    if matrix.engagement_columns:
+        columns["engagement"] = rates
+    out = {}
+    for name, column in columns.items():
+        column = column[~np.isnan(column)]
+        if not len(column):
+            out[name] = None
+            continue
+        points = np.percentile(column, PERCENTILES)
+        out[name] = {
+            **{f"p{p}": _number(v) for p, v in zip(PERCENTILES, points)},
+            "mean": _number(column.mean()),
+            "min": _number(column.min()),
+            "max": _number(column.max()),
+        }
+    return out
+
+
+def _ranked(scores: np.ndarray, n: int, descending: bool) -> np.ndarray:
+    """Indexes of the n best (or worst) scores, in order; NaN scores last."""
+    candidates = np.flatnonzero(~np.isnan(scores))
+    n = min(n, len(candidates))
+    if not n:
+        return candidates[:0]
+    keyed = -scores[candidates] if descending else scores[candidates]
+    picked = candidates[np.argpartition(keyed, n - 1)[:n]]
+    order = np.argsort(-scores[picked] if descending else scores[picked], kind="stable")
+    return picked[order]
+
+
+def _recipients(matrix: _Matrix, top: int, rank: str) -> dict:
+    size = len(matrix.recipient_ids)
+    sums, present, counts, measured = matrix.grouped(matrix.recipient_of, size)
+    rates = _group_rates(matrix, sums, measured)
+    types = np.empty(size, dtype=matrix.type_names.dtype)
+    types[matrix.recipient_of] = matrix.type_names[matrix.type_of]
+
+    if rank == "engagement":
+        scores = rates if rates is not None else np.full(size, np.nan)
+    elif rank == "messages":
+        scores = counts.astype(float)
+    else:
+        column = COUNTERS.index(rank)
+        scores = np.where(present[:, column], sums[:, column], np.nan)
+    # Recipients without a single measured message have nothing to rank by
+    scores = np.where(measured > 0, scores, np.nan)
+
+    def entry(i: int) -> dict:
+        return {
+            "recipientId": str(matrix.recipient_ids[i]),
+            "type": str(types[i]),
+            "messages": int(counts[i]),
+            **_counters(sums[i], present[i]),
+            "engagementRate": _number(rates[i]) if rates is not None else None,
+        }
+
+    return {
+        "top": [entry(i) for i in _ranked(scores, top, descending=True)],
+        "bottom": [entry(i) for i in _ranked(scores, top, descending=False)],
+    }
+
+
+def _by_type(matrix: _Matrix) -> dict:
+    size = len(matrix.type_names)
+    sums, present, counts, measured = matrix.grouped(matrix.type_of, size)
+    rates = _group_rates(matrix, sums, measured)
+    recipients = np.bincount(matrix.type_of[np.unique(matrix.recipient_of, return_index=True)[1]], minlength=size)
+    return {
+        str(name): {
+            "messages": int(counts[i]),
+            "measured": int(measured[i]),
+            "recipients": int(recipients[i]),
+            "totals": _counters(sums[i], present[i]),
+            "engagementRate": _number(rates[i]) if rates is not None else None,
+        }
+        for i, name in enumerate(matrix.type_names)
+    }
+
+
+def summarize(rows: List[dict], top: int = TOP_DEFAULT, rank: str = "views",
+              detail: bool = False) -> dict:
+    """
+    Roll up one task. `rows` are {"recipientId", "messageId", "type",
+    "metrics" | "error"} entries, one per sent message. `rank` orders the
+    top/bottom recipients (a counter, "engagement" or "messages").
+    """
+    if rank not in RANK_KEYS:
+        raise ValueError(f"Unknown rank '{rank}', expected one of {', '.join(RANK_KEYS)}")
+    top = min(max(int(top), 0), TOP_MAX)
+
+    errors: Dict[str, int] = {}
+    for row in rows:
+        if row.get("error"):
+            errors[row["error"]] = errors.get(row["error"], 0) + 1
+
+    summary = {
+        "messages": len(rows),
+        "measured": 0,
+        "failed": sum(errors.values()),
+        "recipients": 0,
+        "totals": {name: None for name in COUNTERS},
+        "engagementRate": None,
+        "percentiles": {},
+        "byType": {},
+        "top": [],
+        "bottom": [],
+        "errors": errors,
+    }
+    if rows:
+        matrix = _Matrix(rows)
+        totals = np.nansum(matrix.values, axis=0)
+        rate = _engagement(matrix, totals)
+        summary.update({
+            "measured": int(matrix.measured.sum()),
+            "recipients": len(matrix.recipient_ids),
+            "totals": _counters(totals, matrix.present),
+            "engagementRate": _number(rate) if rate is not None else None,
+            "percentiles": _percentiles(matrix),
+            "byType": _by_type(matrix),
+            **_recipients(matrix, top, rank),
+        })
+    if detail:
+        summary["detail"] = rows
+    return summary
@@ -0,0 +1,292 @@
+"""
+Request and RPC instrumentation: Prometheus metrics, Server-Timing and
+per-request RPC traces.
+
+- GET /metrics serves every metric in Prometheus' text format: request
+  latency histograms per route, Telethon RPC counts/latency per request type
+  (fed by the account schedulers), plus gauges collected at scrape time
+  (client pool, FloodWaits, cache hit ratios). No client library needed.
+- TelemetryMiddleware binds a RequestTrace to each request. Everything the
+  request does (RPCs, scheduler queueing, entity resolution, JSON rendering)
+  adds to it, including work in tasks it spawns, and the response carries
+  a Server-Timing header with the totals:
+      Server-Timing: rpc;dur=812.4;desc="14 calls", queue;dur=95.0, flood;dur=0, resolve;dur=3.1, serialize;dur=4.2, total;dur=931.7
+  Phases overlap when work runs concurrently (a batch fetches peers in
+  parallel), so they can add up to more than the total.
+- Sending `X-Debug-Trace: 1` also returns X-RPC-Trace: a JSON list of every
+  MTProto call the request made, [{method, ms, queued_ms, outcome}, ...],
+  capped at TRACE_MAX_CALLS.
+"""
+import bisect
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+TRACE_HEADER = "x-debug-trace"
+TRACE_MAX_CALLS = 200
+
+# Request latency (seconds): fast cache hits up to multi-minute batches
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Single Telegram round trips
+RPC_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PHASES = ("rpc", "queue", "flood", "resolve", "serialize")
+
+Labels = Tuple[Tuple[str, str], ...]
+# A collector returns (name, type, help, [(labels, value), ...]) families
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+Collector = Callable[[], Iterable[Family]]
+
+
+def _labels(values: Dict[str, str]) -> Labels:
+    return tuple(sorted(values.items()))
+
+
+def _format_labels(labels: Labels, extra: Dict[str, str] = None) -> str:
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for k, v in items)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count], sum
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key in sorted(self.counts):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self.counts[key]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {round(self.sums[key], 6)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class RequestTrace:
+    """Timings of one HTTP request, shared with every task it spawns."""
+
+    def __init__(self, detailed: bool = False):
+        self.started = time.perf_counter()
+        self.detailed = detailed
+        self.phases: Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.rpc_calls = 0
+        self.calls: List[dict] = []
+        self.dropped = 0
+        self.finished = False
+
+    def add(self, phase: str, seconds: float):
+        if not self.finished:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_rpc(self, method: str, seconds: float, queued: float, outcome: str, flood: float = 0.0):
+        if self.finished:
+            return
+        self.rpc_calls += 1
+        self.phases["rpc"] += seconds
+        self.phases["queue"] += queued - flood
+        self.phases["flood"] += flood
+        if self.detailed:
+            if len(self.calls) < TRACE_MAX_CALLS:
+                self.calls.append({"method": method, "ms": round(seconds * 1000, 2),
+                                   "queued_ms": round(queued * 1000, 2), "outcome": outcome})
+            else:
+                self.dropped += 1
+
+    def server_timing(self) -> str:
+        parts = []
+        for phase in PHASES:
+            entry = f"{phase};dur={round(self.phases[phase] * 1000, 1)}"
+            if phase == "rpc":
+                entry += f';desc="{self.rpc_calls} calls"'
+            parts.append(entry)
+        parts.append(f"total;dur={round((time.perf_counter() - self.started) * 1000, 1)}")
+        return ", ".join(parts)
+
+    def rpc_trace(self) -> str:
+        calls = self.calls + ([{"dropped": self.dropped}] if self.dropped else [])
+        return json.dumps(calls, separators=(",", ":"))
+
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar("request_trace", default=None)
+
+
+@contextmanager
+def phase(name: str):
+    """Add the time spent in the block to the current request's `name` phase."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+
+class Registry:
+    def __init__(self):
+        self.requests = Histogram("http_request_duration_seconds",
+                                  "HTTP request latency by route", REQUEST_BUCKETS)
+        self.responses = Counter("http_requests_total", "HTTP requests by route and status")
+        self.rpcs = Counter("telegram_rpc_total", "Telethon RPCs by request type and outcome")
+        self.rpc_latency = Histogram("telegram_rpc_duration_seconds",
+                                     "Telethon RPC latency by request type", RPC_BUCKETS)
+        self.rpc_queue = Histogram("telegram_rpc_queue_seconds",
+                                   "Time RPCs waited for the account scheduler", RPC_BUCKETS)
+        self._collectors: List[Collector] = []
+
+    def add_collector(self, collector: Collector):
+        """Register a function producing gauge/counter families at scrape time."""
+        self._collectors.append(collector)
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        self.requests.observe(seconds, method=method, route=route)
+        self.responses.inc(method=method, route=route, status=str(status))
+
+    def observe_rpc(self, method: str, seconds: float, queued: float, outcome: str, flood: float = 0.0):
+        """Scheduler on_rpc callback: one Telegram call attempt finished."""
+        self.rpcs.inc(method=method, outcome=outcome)
+        self.rpc_latency.observe(seconds, method=method)
+        self.rpc_queue.observe(queued)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_rpc(method, seconds, queued, outcome, flood)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.requests, self.responses, self.rpcs, self.rpc_latency, self.rpc_queue):
+            lines += metric.render()
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+                continue
+            for name, kind, help, samples in families:
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_format_labels(_labels(labels))} {_format_value(value)}"
+                          for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def dumps(content) -> bytes:
+    """
+    orjson rendering: compact UTF-8 like JSONResponse, several times faster
+    on the 10k-dialog and 5k-message bodies.
+    """
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson; rendering counts as the request's serialize phase."""
+
+    def render(self, content) -> bytes:
+        with phase("serialize"):
+            return dumps(content)
+
+
+class TelemetryMiddleware:
+    """
+    Times every request into the route histogram and adds Server-Timing
+    (and X-RPC-Trace on request) to the response headers.
+    """
+
+    def __init__(self, app, registry: Registry = registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        detailed = Headers(scope=scope).get(TRACE_HEADER, "").lower() in ("1", "true", "yes")
+        trace = RequestTrace(detailed=detailed)
+        token = current_trace.set(trace)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                if detailed:
+                    headers.append((b"x-rpc-trace", trace.rpc_trace().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.finished = True
+            current_trace.reset(token)
+            # Route templates, never raw paths, to keep label cardinality bounded
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            self.registry.observe_request(scope["method"], route, status["code"],
+                                          time.perf_counter() - trace.started)
+
+
+def family(name: str, kind: str, help: str, values: Dict[str, float] = None,
+           label: Optional[str] = None, value: float = None) -> Family:
+    """
+    Collector helper: a single-value family, or one sample per key of
+    `values` labelled `label`.
+    """
+    if values is None:
+        return name, kind, help, [({}, value or 0)]
+    return name, kind, help, [({label: key}, v or 0) for key, v in values.items()]
@@ -0,0 +1,390 @@
+"""
+Embedded time-series store for message and channel metrics.
+
+/analytics and /analytics/batch only return the current snapshot and Node
+overwrites `msg.metrics` in Mongo, so history was lost. Every snapshot that
+lands in the metrics cache is also appended here (SQLite, stdlib only):
+- `samples` keeps raw snapshots for METRICS_RAW_RETENTION,
+- `rollups` keeps hourly and daily buckets (max of each counter), updated at
+  write time, for METRICS_HOURLY_RETENTION / METRICS_DAILY_RETENTION,
+- `channel_samples` keeps follower/member counts seen by /channel-stats,
+- `task_messages` maps Node task ids to messages (from POST /analytics/track)
+  so a task's curve can be summed without Node listing its messages.
+
+Writes are buffered and flushed from a background task in one transaction;
+reads run in a worker thread. Curves are served without touching Telegram.
+"""
+import asyncio
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METRICS_DB_FLUSH_INTERVAL = float(os.getenv("METRICS_DB_FLUSH_INTERVAL", 5))  # seconds
+# Flush early once this many snapshots are buffered
+METRICS_DB_FLUSH_SIZE = int(os.getenv("METRICS_DB_FLUSH_SIZE", 1000))
+METRICS_RAW_RETENTION = int(os.getenv("METRICS_RAW_RETENTION", 7 * 86400))  # seconds
+METRICS_HOURLY_RETENTION = int(os.getenv("METRICS_HOURLY_RETENTION", 90 * 86400))  # seconds
+METRICS_DAILY_RETENTION = int(os.getenv("METRICS_DAILY_RETENTION", 2 * 365 * 86400))  # seconds
+RETENTION_INTERVAL = 3600  # seconds
+
+HOUR = 3600
+DAY = 86400
+RESOLUTIONS = {"raw": 0, "hour": HOUR, "day": DAY}
+
+COUNTERS = ("views", "forwards", "replies", "reactions", "voters")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    account TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    views INTEGER, forwards INTEGER, replies INTEGER, reactions INTEGER, voters INTEGER
+);
+CREATE INDEX IF NOT EXISTS samples_message ON samples (chat_id, msg_id, ts);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    resolution INTEGER NOT NULL,
+    account TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    views INTEGER, forwards INTEGER, replies INTEGER, reactions INTEGER, voters INTEGER,
+    samples INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (resolution, account, chat_id, msg_id, bucket)
+);
+CREATE INDEX IF NOT EXISTS rollups_chat ON rollups (resolution, chat_id, bucket);
+
+CREATE TABLE IF NOT EXISTS channel_samples (
+    chat_id TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    followers INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_samples_chat ON channel_samples (chat_id, ts);
+
+CREATE TABLE IF NOT EXISTS task_messages (
+    account TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    PRIMARY KEY (account, task_id, chat_id, msg_id)
+);
+"""
+
+UPSERT_ROLLUP = """
+INSERT INTO rollups (resolution, account, chat_id, msg_id, bucket,
+                     views, forwards, replies, reactions, voters)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (resolution, account, chat_id, msg_id, bucket) DO UPDATE SET
+    views = MAX(IFNULL(views, excluded.views), IFNULL(excluded.views, views)),
+    forwards = MAX(IFNULL(forwards, excluded.forwards), IFNULL(excluded.forwards, forwards)),
+    replies = MAX(IFNULL(replies, excluded.replies), IFNULL(excluded.replies, replies)),
+    reactions = MAX(IFNULL(reactions, excluded.reactions), IFNULL(excluded.reactions, reactions)),
+    voters = MAX(IFNULL(voters, excluded.voters), IFNULL(excluded.voters, voters)),
+    samples = samples + 1
+"""
+
+Sample = Tuple[str, str, int, int, int, int, int, int, int]
+
+
+def parse_resolution(name: str) -> int:
+    if name not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    return RESOLUTIONS[name]
+
+
+def parse_timestamp(value) -> Optional[float]:
+    """
+    Epoch seconds, epoch milliseconds (as JS Date.now()) or an ISO string.
+    """
+    if value in (None, ""):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        try:
+            return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+    return number / 1000 if number > 1e11 else number
+
+
+def _iso(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _point(ts: int, values) -> dict:
+    return {"t": _iso(ts), **dict(zip(COUNTERS, values))}
+
+
+def _higher(a, b):
+    # NULL is "not measured", not 0
+    if a is None:
+        return b
+    return a if b is None else max(a, b)
+
+
+def merge_accounts(series: Dict[tuple, List[tuple]]) -> Dict[tuple, List[tuple]]:
+    """
+    Collapse {(account, chat_id, msg_id): points} to {(chat_id, msg_id): points}.
+    Several accounts may sample the same message; each ts keeps the highest
+    value of every counter.
+    """
+    merged: Dict[tuple, Dict[int, list]] = {}
+    for (_, chat_id, msg_id), points in series.items():
+        by_ts = merged.setdefault((chat_id, msg_id), {})
+        for ts, values in points:
+            current = by_ts.get(ts)
+            by_ts[ts] = list(values) if current is None else [_higher(a, b) for a, b in zip(current, values)]
+    return {key: sorted(by_ts.items()) for key, by_ts in merged.items()}
+
+
+def sum_curves(series: Dict[tuple, List[tuple]],
+               buckets: List[int] = None) -> List[Tuple[int, List[int]]]:
+    """
+    Sum several per-message series [(ts, counters), ...] into one curve.
+    Each message carries its last known value forward, so a bucket where one
+    message wasn't sampled doesn't dip. `buckets` defaults to every sampled ts.
+    """
+    if buckets is None:
+        buckets = sorted({ts for points in series.values() for ts, _ in points})
+    last: Dict[tuple, tuple] = {}
+    cursors = {key: 0 for key in series}
+    curve = []
+    for ts in buckets:
+        for key, points in series.items():
+            i = cursors[key]
+            while i < len(points) and points[i][0] <= ts:
+                last[key] = points[i][1]
+                i += 1
+            cursors[key] = i
+        totals = [sum(values[n] or 0 for values in last.values()) for n in range(len(COUNTERS))]
+        curve.append((ts, totals))
+    return curve
+
+
+class MetricsStore:
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._buffer: List[Sample] = []
+        self._channel_buffer: List[Tuple[str, int, int]] = []
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._flush_now = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+
+        self.recorded = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    # Writes
+
+    def record(self, key: tuple, metrics: dict, ts: float = None):
+        """
+        Buffer one snapshot. `key` is a metrics_cache key (account, chat_id, msg_id),
+        so this can be passed to MetricsCache as on_put. Counters missing from
+        a partial (?fields=counters) snapshot are stored as NULL.
+        """
+        account, chat_id, msg_id = key
+        self._buffer.append((account, str(chat_id), int(msg_id), int(ts or time.time()),
+                             *(int(metrics[c] or 0) if c in metrics else None for c in COUNTERS)))
+        self.recorded += 1
+        if len(self._buffer) >= METRICS_DB_FLUSH_SIZE:
+            self._flush_now.set()
+
+    def _write(self, samples: List[Sample], channels: List[Tuple[str, int, int]]):
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.executemany("INSERT INTO channel_samples VALUES (?, ?, ?)", channels)
+                db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", samples)
+                for resolution in (HOUR, DAY):
+                    db.executemany(UPSERT_ROLLUP, [
+                        (resolution, s[0], s[1], s[2], s[3] - s[3] % resolution, *s[4:])
+                        for s in samples
+                    ])
+
+    def _query(self, sql: str, params: Iterable = ()) -> list:
+        with self._db_lock:
+            return self._connect().execute(sql, tuple(params)).fetchall()
+
+    def _prune(self):
+        now = int(time.time())
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM samples WHERE ts < ?", (now - METRICS_RAW_RETENTION,))
+                db.execute("DELETE FROM rollups WHERE resolution = ? AND bucket < ?",
+                           (HOUR, now - METRICS_HOURLY_RETENTION))
+                db.execute("DELETE FROM rollups WHERE resolution = ? AND bucket < ?",
+                           (DAY, now - METRICS_DAILY_RETENTION))
+                db.execute("DELETE FROM channel_samples WHERE ts < ?", (now - METRICS_DAILY_RETENTION,))
+
+    async def flush(self):
+        if not self._buffer and not self._channel_buffer:
+            return
+        samples, self._buffer = self._buffer, []
+        channels, self._channel_buffer = self._channel_buffer, []
+        try:
+            await asyncio.to_thread(self._write, samples, channels)
+            self.flushes += 1
+        except sqlite3.Error as e:
+            self.dropped += len(samples)
+            logger.warning("Could not write %d metric samples: %s", len(samples), e)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=METRICS_DB_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+            if time.monotonic() - self._pruned_at > RETENTION_INTERVAL:
+                self._pruned_at = time.monotonic()
+                try:
+                    await asyncio.to_thread(self._prune)
+                except sqlite3.Error as e:
+                    logger.warning("Metrics retention failed: %s", e)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def record_channel(self, chat_id, followers: int, ts: float = None):
+        """Buffer a follower/member count for a channel or group."""
+        self._channel_buffer.append((str(chat_id), int(ts or time.time()), int(followers)))
+
+    async def link_task(self, account: str, task_id: str, messages: Iterable[Tuple[str, int]]):
+        rows = [(account, str(task_id), str(chat_id), int(msg_id)) for chat_id, msg_id in messages]
+        if not rows:
+            return
+
+        def write():
+            with self._db_lock:
+                db = self._connect()
+                with db:
+                    db.executemany("INSERT OR IGNORE INTO task_messages VALUES (?, ?, ?, ?)", rows)
+
+        await asyncio.to_thread(write)
+
+    # Reads
+
+    def _series(self, resolution: int, where: str, params: list, since: int, until: int):
+        """
+        {(account, chat_id, msg_id): [(ts, counters), ...]} from samples or rollups.
+        """
+        columns = ", ".join(COUNTERS)
+        if resolution:
+            sql = (f"SELECT account, chat_id, msg_id, bucket, {columns} FROM rollups "
+                   f"WHERE resolution = ? AND {where} AND bucket BETWEEN ? AND ? ORDER BY bucket")
+            params = [resolution, *params, since - since % resolution, until]
+        else:
+            sql = (f"SELECT account, chat_id, msg_id, ts, {columns} FROM samples "
+                   f"WHERE {where} AND ts BETWEEN ? AND ? ORDER BY ts")
+            params = [*params, since, until]
+
+        series: Dict[tuple, List[tuple]] = {}
+        for row in self._query(sql, params):
+            series.setdefault(tuple(row[:3]), []).append((row[3], row[4:]))
+        return series
+
+    @staticmethod
+    def _account_filter(account: Optional[str]) -> Tuple[str, list]:
+        return ("account = ?", [account]) if account else ("1 = 1", [])
+
+    async def message_history(self, chat_id, msg_id: int, resolution: int = HOUR,
+                              since: int = 0, until: int = None, account: str = None) -> List[dict]:
+        acc_where, acc_params = self._account_filter(account)
+        series = await asyncio.to_thread(
+            self._series, resolution, f"{acc_where} AND chat_id = ? AND msg_id = ?",
+            [*acc_params, str(chat_id), int(msg_id)], since, until or int(time.time())
+        )
+        points = merge_accounts(series).get((str(chat_id), int(msg_id)), [])
+        return [_point(ts, values) for ts, values in points]
+
+    async def task_history(self, account: str, task_id: str, resolution: int = HOUR,
+                           since: int = 0, until: int = None) -> dict:
+        def load():
+            count = self._query("SELECT COUNT(*) FROM task_messages WHERE account = ? AND task_id = ?",
+                                (account, str(task_id)))[0][0]
+            where = ("account = ? AND (chat_id, msg_id) IN "
+                     "(SELECT chat_id, msg_id FROM task_messages WHERE account = ? AND task_id = ?)")
+            return count, self._series(resolution, where, [account, account, str(task_id)],
+                                       since, until or int(time.time()))
+
+        count, series = await asyncio.to_thread(load)
+        return {"messages": count, "points": [_point(ts, values) for ts, values in sum_curves(series)]}
+
+    async def channel_growth(self, chat_id, days: int, account: str = None) -> List[dict]:
+        """
+        Daily totals over the channel's recorded messages plus the highest
+        follower count seen each day.
+        """
+        now = int(time.time())
+        since = now - now % DAY - (days - 1) * DAY
+        acc_where, acc_params = self._account_filter(account)
+
+        def load():
+            series = self._series(DAY, f"{acc_where} AND chat_id = ?", [*acc_params, str(chat_id)], since, now)
+            followers = self._query(
+                "SELECT ts - ts % ? AS day, MAX(followers) FROM channel_samples "
+                "WHERE chat_id = ? AND ts >= ? GROUP BY day", (DAY, str(chat_id), since)
+            )
+            return series, dict(followers)
+
+        series, followers = await asyncio.to_thread(load)
+        # Without an account filter every account that sampled a message has
+        # its own series; count and sum each message once
+        series = merge_accounts(series)
+        days_range = list(range(since, now + 1, DAY))
+        first_seen: Dict[int, int] = {}
+        for points in series.values():
+            first_seen[points[0][0]] = first_seen.get(points[0][0], 0) + 1
+
+        result = []
+        tracked = 0
+        for day, totals in sum_curves(series, days_range):
+            tracked += first_seen.get(day, 0)
+            result.append({
+                "date": datetime.fromtimestamp(day, timezone.utc).date().isoformat(),
+                **dict(zip(COUNTERS, totals)),
+                "messages": tracked,
+                "followers": followers.get(day),
+            })
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "recorded": self.recorded,
+            "buffered": len(self._buffer),
+            "flushes": self.flushes,
+            "dropped": self.dropped,
+        }
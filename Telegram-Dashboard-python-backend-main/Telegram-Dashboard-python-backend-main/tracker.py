@@ -0,0 +1,600 @@
+"""
+Server-side metrics tracking for sent messages.
+
+Node used to re-enqueue one BullMQ job per message every 30 minutes for 48h,
+each calling GET /analytics once. Instead, messages are registered once with
+POST /analytics/track and each account's tracker refreshes them itself:
+- due messages are polled together through the batch engine (multi-id
+  get_messages per peer, feeding the metrics cache),
+- young posts refresh often, older ones less, and messages whose counters
+  stopped moving back off further,
+- channel view/forward updates and edits pushed by Telegram are applied as
+  they arrive, which pushes the next poll back,
+- only changes are recorded, in a sequence-numbered log read through
+  GET /analytics/changes?since=<seq>,
+- messages someone watches live (POST /analytics/subscribe) refresh every
+  TRACK_LIVE_INTERVAL, however many subscribers share them; each
+  subscriber is pushed only the counters that changed. Messages tracked
+  only for a subscription are dropped once nobody watches them.
+
+Tracked sets are persisted in `user_sessions/tracked_<user_id>.json` so a
+restart resumes tracking.
+"""
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+from collections import deque
+from contextlib import AbstractContextManager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telethon import TelegramClient, events, types, utils
+
+import analytics_engine
+import log_config
+import scheduler
+from metrics_cache import MetricsCache, cache_key
+from timeseries import parse_timestamp
+
+logger = logging.getLogger(__name__)
+item_log = log_config.item_logger(__name__)
+
+# How long after posting a message keeps being tracked
+TRACK_DURATION = int(os.getenv("TRACK_DURATION", 48 * 3600))  # seconds
+# How often a tracker looks for due messages when nothing wakes it earlier
+TRACK_TICK = int(os.getenv("TRACK_TICK", 15))  # seconds
+# Longest gap between two polls of the same message
+TRACK_MAX_INTERVAL = int(os.getenv("TRACK_MAX_INTERVAL", 3600))  # seconds
+# Changes kept for GET /analytics/changes; older cursors get a reset
+TRACK_CHANGES_MAX = int(os.getenv("TRACK_CHANGES_MAX", 10_000))
+# Pause before retrying when the account's client can't be reached
+TRACK_RETRY = 60  # seconds
+# Refresh interval of messages with live subscribers
+TRACK_LIVE_INTERVAL = int(os.getenv("TRACK_LIVE_INTERVAL", 30))  # seconds
+# Comment line sent to idle subscribers so proxies keep the stream open
+TRACK_KEEPALIVE = 15  # seconds
+
+# (post age up to, refresh interval), both in seconds
+TRACK_SCHEDULE = (
+    (3600, 120),
+    (6 * 3600, 600),
+    (24 * 3600, 1800),
+)
+# Double the interval per unchanged poll, up to this many times
+TRACK_MAX_BACKOFF = 3
+
+# Metrics polled per tracked message: "full", "counters" or e.g.
+# "counters,reactions" (see analytics_engine.parse_fields)
+TRACK_FIELDS = analytics_engine.parse_fields(os.getenv("TRACK_FIELDS", "full"))
+
+STORE_VERSION = 1
+
+Key = Tuple[str, int]
+# get_client(account) -> connected client
+ClientGetter = Callable[[str], Awaitable[TelegramClient]]
+# resolver_for(client, account) -> analytics_engine.Resolver
+ResolverFactory = Callable[[TelegramClient, str], analytics_engine.Resolver]
+
+
+def refresh_interval(age: float, unchanged: int = 0) -> int:
+    """
+    Seconds until the next poll of a post `age` seconds old whose metrics
+    haven't moved for `unchanged` polls.
+    """
+    interval = TRACK_MAX_INTERVAL
+    for max_age, step in TRACK_SCHEDULE:
+        if age < max_age:
+            interval = step
+            break
+    interval *= 2 ** min(unchanged, TRACK_MAX_BACKOFF)
+    return min(interval, TRACK_MAX_INTERVAL)
+
+
+def metrics_of(metrics: dict) -> dict:
+    """Drop cache annotations ("cached", "age") and untracked fields before comparing."""
+    return {field: metrics.get(field, 0) for field in TRACK_FIELDS}
+
+
+class AccountTracker:
+    def __init__(self, account: str, path: pathlib.Path, get_client: ClientGetter,
+                 busy: Callable[[str], AbstractContextManager], cache: MetricsCache = None,
+                 resolver_for: ResolverFactory = None):
+        self.account = account
+        self.path = path
+        self.get_client = get_client
+        self.busy = busy
+        self.cache = cache
+        self.resolver_for = resolver_for
+
+        self.entries: Dict[Key, dict] = {}
+        self.seq = 0
+        self.changes: deque = deque(maxlen=TRACK_CHANGES_MAX)
+        self._changed = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        # Live subscribers per message
+        self._watchers: Dict[Key, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[TelegramClient] = None
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+
+        self.polls = 0
+        self.polled_messages = 0
+        self.pushed_updates = 0
+        self.subscribers = 0
+        self._load()
+
+    # Persistence
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable tracked set %s: %s", self.path.name, e)
+            return
+        if data.get("version") != STORE_VERSION:
+            return
+        self.seq = data.get("seq", 0)
+        for entry in data.get("entries", []):
+            self.entries[(entry["recipientId"], entry["messageId"])] = entry
+
+    def _write(self, payload: str):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(payload)
+        os.replace(tmp, self.path)
+
+    def _payload(self) -> str:
+        self._dirty = False
+        return json.dumps({"version": STORE_VERSION, "seq": self.seq,
+                           "entries": list(self.entries.values())})
+
+    def flush(self):
+        """Synchronous save of pending changes (used at shutdown)."""
+        if self._dirty:
+            try:
+                self._write(self._payload())
+            except OSError as e:
+                logger.warning("Could not persist tracked set: %s", e)
+
+    def _schedule_save(self):
+        self._dirty = True
+        if self._save_task and not self._save_task.done():
+            return
+
+        async def save():
+            # One write per burst of polls/updates
+            await asyncio.sleep(5)
+            try:
+                await asyncio.to_thread(self._write, self._payload())
+            except OSError as e:
+                logger.warning("Could not persist tracked set: %s", e)
+
+        self._save_task = asyncio.get_running_loop().create_task(save())
+
+    # Registration
+
+    def track(self, items: list, live: bool = False) -> int:
+        """
+        Register [{"recipientId", "messageId", "accessHash"?, "taskId"?,
+        "postedAt"?}, ...]. Returns how many were new. New messages are
+        polled right away. With `live`, messages not tracked yet are only
+        kept while watched (see subscribe()); tracking one without `live`
+        keeps it for good.
+        """
+        now = time.time()
+        added = 0
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            chat_id, msg_id = item.get("recipientId"), item.get("messageId")
+            try:
+                msg_id = int(msg_id)
+            except (TypeError, ValueError):
+                continue
+            if not chat_id or not msg_id:
+                continue
+
+            key = (str(chat_id), msg_id)
+            entry = self.entries.get(key)
+            posted_at = (parse_timestamp(item.get("postedAt"))
+                         or (entry or {}).get("postedAt") or now)
+            if entry is None:
+                added += 1
+                entry = self.entries[key] = {
+                    "recipientId": key[0],
+                    "messageId": msg_id,
+                    "metrics": None,
+                    "unchanged": 0,
+                    "nextDue": now,
+                }
+                if live:
+                    # Time for the subscriber to start watching
+                    entry["liveUntil"] = now + TRACK_KEEPALIVE
+            elif not live:
+                entry.pop("liveUntil", None)
+            entry.update({
+                "accessHash": str(item["accessHash"]) if item.get("accessHash") else entry.get("accessHash"),
+                "taskId": item.get("taskId", entry.get("taskId")),
+                "postedAt": posted_at,
+                "expiresAt": posted_at + TRACK_DURATION,
+            })
+
+        self._schedule_save()
+        self.start()
+        self._wakeup.set()
+        return added
+
+    def untrack(self, items: list = None, task_id: str = None) -> int:
+        """
+        Stop tracking the given messages, or every message of `task_id`.
+        """
+        keys = set()
+        for item in items or []:
+            if isinstance(item, dict) and item.get("recipientId") and item.get("messageId"):
+                try:
+                    keys.add((str(item["recipientId"]), int(item["messageId"])))
+                except (TypeError, ValueError):
+                    continue
+        if task_id is not None:
+            keys.update(k for k, e in self.entries.items() if e.get("taskId") == task_id)
+
+        removed = 0
+        for key in keys:
+            if self.entries.pop(key, None) is not None:
+                removed += 1
+        if removed:
+            self._schedule_save()
+        return removed
+
+    def snapshot(self) -> dict:
+        return {
+            "seq": self.seq,
+            "items": [self._public(entry) for entry in self.entries.values()],
+        }
+
+    @staticmethod
+    def _public(entry: dict) -> dict:
+        return {
+            "recipientId": entry["recipientId"],
+            "messageId": entry["messageId"],
+            "taskId": entry.get("taskId"),
+            "metrics": entry.get("metrics"),
+            "updatedAt": entry.get("updatedAt"),
+            "expiresAt": entry["expiresAt"],
+        }
+
+    # Change log
+
+    def _record(self, entry: dict, source: str, expired: bool = False):
+        self.seq += 1
+        change = {**self._public(entry), "seq": self.seq, "source": source}
+        if expired:
+            change["expired"] = True
+        self.changes.append(change)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def changes_since(self, since: int) -> dict:
+        """
+        Latest change per message after `since`. "reset" means changes were
+        dropped from the log in between; reload GET /analytics/track instead.
+        """
+        oldest = self.changes[0]["seq"] if self.changes else self.seq + 1
+        latest: Dict[Key, dict] = {}
+        for change in self.changes:
+            if change["seq"] > since:
+                latest[(change["recipientId"], change["messageId"])] = change
+        return {
+            "seq": self.seq,
+            "reset": since < oldest - 1,
+            "changes": sorted(latest.values(), key=lambda c: c["seq"]),
+        }
+
+    async def wait_changes(self, since: int, timeout: float) -> dict:
+        """
+        changes_since(), waiting up to `timeout` seconds for the first change.
+        """
+        if self.seq <= since and timeout > 0:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.changes_since(since)
+
+    # Live subscriptions
+
+    def _next_due(self, entry: dict, now: float, unchanged: int) -> float:
+        interval = refresh_interval(now - entry["postedAt"], unchanged)
+        if (entry["recipientId"], entry["messageId"]) in self._watchers:
+            interval = min(interval, TRACK_LIVE_INTERVAL)
+        return now + interval
+
+    def watch(self, keys: Iterable[Key]):
+        """
+        Refresh `keys` every TRACK_LIVE_INTERVAL until unwatch(). Only the
+        first watcher of a message brings its next poll forward.
+        """
+        now = time.time()
+        for key in keys:
+            count = self._watchers.get(key, 0)
+            self._watchers[key] = count + 1
+            entry = self.entries.get(key)
+            if count == 0 and entry is not None:
+                entry["nextDue"] = min(entry["nextDue"], now)
+        self.start()
+        self._wakeup.set()
+
+    def unwatch(self, keys: Iterable[Key]):
+        for key in keys:
+            count = self._watchers.get(key, 0) - 1
+            if count > 0:
+                self._watchers[key] = count
+                continue
+            self._watchers.pop(key, None)
+            entry = self.entries.get(key)
+            if entry is not None and "liveUntil" in entry:
+                # Tracked only for the subscription that just ended
+                entry["liveUntil"] = 0
+                self._wakeup.set()
+
+    def _view(self, keys: Iterable[Key]) -> List[dict]:
+        return [{"recipientId": key[0], "messageId": key[1], "metrics": self.entries[key].get("metrics")}
+                for key in keys if key in self.entries]
+
+    async def subscribe(self, keys: Iterable[Key]) -> AsyncIterator[Optional[dict]]:
+        """
+        Live view of `keys`: first {"event": "snapshot", "seq", "items"} with
+        their current metrics, then {"event": "delta", "seq", "items"} with,
+        per message, only the counters that changed since the subscriber last
+        heard of it ("expired": true once it is no longer tracked). Yields
+        None after TRACK_KEEPALIVE seconds without anything to send.
+        """
+        keys = list(dict.fromkeys(keys))
+        wanted = set(keys)
+        self.watch(keys)
+        self.subscribers += 1
+        try:
+            seq = self.seq
+            items = self._view(keys)
+            seen = {(i["recipientId"], i["messageId"]): dict(i["metrics"] or {}) for i in items}
+            yield {"event": "snapshot", "seq": seq, "items": items}
+            sent_at = time.monotonic()
+
+            while True:
+                changes = await self.wait_changes(seq, TRACK_KEEPALIVE - (time.monotonic() - sent_at))
+                seq = changes["seq"]
+                if changes["reset"]:
+                    # Fell behind the change log: start over from current values
+                    items = self._view(keys)
+                    seen = {(i["recipientId"], i["messageId"]): dict(i["metrics"] or {}) for i in items}
+                    yield {"event": "snapshot", "seq": seq, "items": items}
+                    sent_at = time.monotonic()
+                    continue
+
+                deltas = []
+                for change in changes["changes"]:
+                    key = (change["recipientId"], change["messageId"])
+                    if key not in wanted:
+                        continue
+                    if change.get("expired"):
+                        seen.pop(key, None)
+                        deltas.append({"recipientId": key[0], "messageId": key[1], "expired": True})
+                        continue
+                    last = seen.setdefault(key, {})
+                    metrics = {field: value for field, value in (change["metrics"] or {}).items()
+                               if last.get(field) != value}
+                    if metrics:
+                        last.update(metrics)
+                        deltas.append({"recipientId": key[0], "messageId": key[1], "metrics": metrics})
+
+                if deltas:
+                    yield {"event": "delta", "seq": seq, "items": deltas}
+                elif time.monotonic() - sent_at < TRACK_KEEPALIVE:
+                    continue
+                else:
+                    yield None
+                sent_at = time.monotonic()
+        finally:
+            self.subscribers -= 1
+            self.unwatch(keys)
+
+    def _apply(self, entry: dict, metrics: dict, source: str) -> bool:
+        now = time.time()
+        metrics = metrics_of(metrics)
+        changed = metrics != entry.get("metrics")
+        entry["metrics"] = metrics
+        entry["updatedAt"] = now
+        entry["unchanged"] = 0 if changed else entry.get("unchanged", 0) + 1
+        entry["nextDue"] = self._next_due(entry, now, entry["unchanged"])
+        if changed:
+            self._record(entry, source)
+        if source == "update" and self.cache is not None:
+            # Polls already fill the cache through the batch engine
+            self.cache.put(cache_key(self.account, entry["recipientId"], entry["messageId"]), metrics)
+        self._schedule_save()
+        return changed
+
+    # Updates pushed by Telegram
+
+    def _attach(self, client: TelegramClient):
+        if self._client is client:
+            return
+        self._detach()
+        self._client = client
+        client.add_event_handler(self._on_counters, events.Raw(
+            types=[types.UpdateChannelMessageViews, types.UpdateChannelMessageForwards]
+        ))
+        client.add_event_handler(self._on_edit, events.MessageEdited())
+
+    def _detach(self):
+        if self._client is not None:
+            self._client.remove_event_handler(self._on_counters)
+            self._client.remove_event_handler(self._on_edit)
+            self._client = None
+
+    def _pushed(self, chat_id: int, msg_id: int) -> Optional[dict]:
+        entry = self.entries.get((str(chat_id), msg_id))
+        if entry is not None and entry.get("metrics") is not None:
+            self.pushed_updates += 1
+            return entry
+        return None
+
+    async def _on_counters(self, update):
+        chat_id = utils.get_peer_id(types.PeerChannel(update.channel_id))
+        entry = self._pushed(chat_id, update.id)
+        if entry is None:
+            return
+        field = "views" if isinstance(update, types.UpdateChannelMessageViews) else "forwards"
+        item_log.debug("Pushed %s=%s for %s in %s", field, getattr(update, field), update.id, chat_id)
+        self._apply(entry, {**entry["metrics"], field: getattr(update, field)}, "update")
+
+    async def _on_edit(self, event):
+        entry = self._pushed(event.chat_id, event.message.id)
+        if entry is None:
+            return
+        self._apply(entry, analytics_engine.extract_metrics(event.message), "update")
+
+    # Polling
+
+    def _expire(self, now: float):
+        for key, entry in list(self.entries.items()):
+            unwatched = entry.get("liveUntil", now) < now and key not in self._watchers
+            if entry["expiresAt"] <= now or unwatched:
+                del self.entries[key]
+                self._record(entry, "poll", expired=True)
+                self._schedule_save()
+
+    async def poll(self, due: List[dict]):
+        client = await self.get_client(self.account)
+        self._attach(client)
+        items = [{"recipientId": e["recipientId"], "messageId": e["messageId"],
+                  "accessHash": e.get("accessHash")} for e in due]
+        resolve = self.resolver_for(client, self.account) if self.resolver_for else None
+
+        self.polls += 1
+        self.polled_messages += len(items)
+        with self.busy(self.account), scheduler.priority(scheduler.BACKGROUND):
+            async for result in analytics_engine.iter_batch(client, items, cache=self.cache,
+                                                            account=self.account, fresh=True,
+                                                            resolve=resolve, fields=TRACK_FIELDS):
+                key = (result["recipientId"], result["messageId"])
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue  # Untracked meanwhile
+                if "metrics" in result:
+                    self._apply(entry, result["metrics"], "poll")
+                    continue
+
+                if result["error"] == "Message not found":
+                    # Deleted (e.g. expired by expiryService.js); nothing left to track
+                    del self.entries[key]
+                    self._record(entry, "poll", expired=True)
+                    continue
+                item_log.debug("Poll of %s in %s failed: %s", key[1], key[0], result["error"])
+                entry["nextDue"] = self._next_due(entry, time.time(), entry.get("unchanged", 0) + 1)
+        self._schedule_save()
+
+    async def _run(self):
+        while self.entries:
+            now = time.time()
+            self._expire(now)
+            due = [e for e in self.entries.values() if e["nextDue"] <= now]
+            delay = TRACK_TICK
+            if due:
+                try:
+                    await self.poll(due)
+                except scheduler.Throttled as e:
+                    delay = e.retry_after
+                except Exception as e:
+                    logger.warning("Tracking poll failed: %s", e, extra={"account": self.account})
+                    delay = TRACK_RETRY
+
+            upcoming = min((e["nextDue"] for e in self.entries.values()), default=None)
+            if upcoming is not None:
+                delay = max(1.0, min(delay, upcoming - time.time()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.entries and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._detach()
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self.entries),
+            "seq": self.seq,
+            "polls": self.polls,
+            "polled_messages": self.polled_messages,
+            "pushed_updates": self.pushed_updates,
+            "watched": len(self._watchers),
+            "subscribers": self.subscribers,
+        }
+
+
+class TrackerStore:
+    def __init__(self, directory: pathlib.Path, get_client: ClientGetter,
+                 busy: Callable[[str], AbstractContextManager], cache: MetricsCache = None,
+                 resolver_for: ResolverFactory = None):
+        self.directory = directory
+        self.get_client = get_client
+        self.busy = busy
+        self.cache = cache
+        self.resolver_for = resolver_for
+        self._trackers: Dict[str, AccountTracker] = {}
+
+    def get(self, account: str) -> AccountTracker:
+        tracker = self._trackers.get(account)
+        if tracker is None:
+            tracker = AccountTracker(account, self.directory / f"tracked_{account}.json",
+                                     self.get_client, self.busy, self.cache, self.resolver_for)
+            self._trackers[account] = tracker
+        return tracker
+
+    def peek(self, account: str) -> Optional[AccountTracker]:
+        return self._trackers.get(account)
+
+    def resume(self, owns: Callable[[str], bool] = None):
+        """
+        Restart tracking for every account with a persisted tracked set
+        (only those `owns` accepts, when sharded).
+        """
+        for path in self.directory.glob("tracked_*.json"):
+            account = path.stem[len("tracked_"):]
+            if owns is None or owns(account):
+                self.get(account).start()
+
+    def forget(self, account: str):
+        tracker = self._trackers.pop(account, None)
+        if tracker:
+            tracker.stop()
+        path = tracker.path if tracker else self.directory / f"tracked_{account}.json"
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        for tracker in self._trackers.values():
+            tracker.stop()
+            tracker.flush()
+
+    def stats(self) -> dict:
+        return {
+            "accounts": len(self._trackers),
+            "tracked": sum(len(t.entries) for t in self._trackers.values()),
+            "polls": sum(t.polls for t in self._trackers.values()),
+            "pushed_updates": sum(t.pushed_updates for t in self._trackers.values()),
+            "subscribers": sum(t.subscribers for t in self._trackers.values()),
+        }
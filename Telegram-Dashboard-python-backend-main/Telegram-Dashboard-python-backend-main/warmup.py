@@ -0,0 +1,193 @@
+"""
+Warm start after a deploy or restart.
+
+Without it every user's first request after a rollout pays for opening the
+session, the MTProto connect/handshake and the authorization check, and
+right after a deploy that is everyone at once.
+- ActivityLog remembers when each account last used its client, in
+  `user_sessions/active_users.json` (one file per shard when sharded).
+- At startup Warmup reconnects the WARM_START_USERS most recently active
+  accounts (seen within WARM_START_WINDOW) in the background, at most
+  WARM_START_CONCURRENCY at a time and at background scheduler priority.
+  The service serves requests meanwhile; a request for an account being
+  warmed simply joins its in-flight connect in the pool.
+- GET /ready reports warm-up progress next to readiness.
+"""
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import scheduler
+
+logger = logging.getLogger(__name__)
+
+WARM_START_USERS = int(os.getenv("WARM_START_USERS", 50))
+WARM_START_CONCURRENCY = int(os.getenv("WARM_START_CONCURRENCY", 4))
+WARM_START_WINDOW = int(os.getenv("WARM_START_WINDOW", 3 * 86400))  # seconds
+ACTIVITY_SAVE_DELAY = 30  # seconds
+
+STORE_VERSION = 1
+
+
+class ActivityLog:
+    """Last time each account used its client, persisted across restarts."""
+
+    def __init__(self, directory: pathlib.Path, shard: Optional[int] = None):
+        self.directory = directory
+        self.path = directory / (f"active_users_{shard}.json" if shard is not None else "active_users.json")
+        self._last_seen: Dict[str, float] = self._load()
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+
+    def _load(self) -> Dict[str, float]:
+        # Every shard's file: after a resize an account may move to this shard
+        last_seen: Dict[str, float] = {}
+        for path in self.directory.glob("active_users*.json"):
+            try:
+                data = json.loads(path.read_text())
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable activity log %s: %s", path.name, e)
+                continue
+            if data.get("version") != STORE_VERSION:
+                continue
+            for user_id, seen in data.get("users", {}).items():
+                last_seen[user_id] = max(seen, last_seen.get(user_id, 0))
+        return last_seen
+
+    def touch(self, user_id: str):
+        self._last_seen[user_id] = time.time()
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_later())
+
+    def forget(self, user_id: str):
+        if self._last_seen.pop(user_id, None) is not None:
+            self._dirty = True
+
+    def recent(self, window: float = WARM_START_WINDOW) -> List[str]:
+        """Accounts seen within `window` seconds, most recent first."""
+        cutoff = time.time() - window
+        users = [(seen, user_id) for user_id, seen in self._last_seen.items() if seen >= cutoff]
+        return [user_id for _, user_id in sorted(users, reverse=True)]
+
+    def _payload(self) -> str:
+        self._dirty = False
+        cutoff = time.time() - WARM_START_WINDOW
+        return json.dumps({"version": STORE_VERSION, "users": {
+            user_id: seen for user_id, seen in self._last_seen.items() if seen >= cutoff
+        }})
+
+    @staticmethod
+    def _write(path: pathlib.Path, payload: str):
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(payload)
+        os.replace(tmp, path)
+
+    async def _save_later(self):
+        await asyncio.sleep(ACTIVITY_SAVE_DELAY)
+        try:
+            await asyncio.to_thread(self._write, self.path, self._payload())
+        except OSError as e:
+            logger.warning("Could not persist activity log: %s", e)
+
+    def flush(self):
+        if self._save_task:
+            self._save_task.cancel()
+            self._save_task = None
+        if self._dirty:
+            try:
+                self._write(self.path, self._payload())
+            except OSError as e:
+                logger.warning("Could not persist activity log: %s", e)
+
+    def stats(self) -> dict:
+        return {"known": len(self._last_seen), "recent": len(self.recent())}
+
+
+class Warmup:
+    """
+    Background reconnect of recently active accounts. `connect(user_id)`
+    opens the account's client and returns whether it is authorized.
+    """
+
+    def __init__(self, activity: ActivityLog, connect: Callable[[str], Awaitable[bool]],
+                 limit: int = WARM_START_USERS, concurrency: int = WARM_START_CONCURRENCY,
+                 window: int = WARM_START_WINDOW):
+        self.activity = activity
+        self.connect = connect
+        self.limit = limit
+        self.concurrency = concurrency
+        self.window = window
+        self._task: Optional[asyncio.Task] = None
+
+        self.state = "idle"
+        self.total = 0
+        self.connected = 0
+        self.unauthorized = 0
+        self.failed = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self.state == "running"
+
+    def start(self, owns: Callable[[str], bool] = None):
+        users = [user_id for user_id in self.activity.recent(self.window) if owns is None or owns(user_id)]
+        users = users[:max(0, self.limit)]
+        self.total = len(users)
+        self.connected = self.unauthorized = self.failed = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        if not users:
+            self.state = "done"
+            self.finished_at = self.started_at
+            return
+        self.state = "running"
+        self._task = asyncio.create_task(self._run(users))
+
+    async def _run(self, users: List[str]):
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def warm(user_id: str):
+            async with semaphore:
+                try:
+                    with scheduler.priority(scheduler.BACKGROUND):
+                        authorized = await self.connect(user_id)
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning("Warm start failed: %s", e, extra={"account": user_id})
+                    return
+                if authorized:
+                    self.connected += 1
+                else:
+                    self.unauthorized += 1
+
+        await asyncio.gather(*(warm(user_id) for user_id in users))
+        self.state = "done"
+        self.finished_at = time.time()
+        logger.info("Warm start: %d of %d sessions connected in %.1fs (%d unauthorized, %d failed)",
+                    self.connected, self.total, self.finished_at - self.started_at,
+                    self.unauthorized, self.failed)
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self.state = "cancelled"
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "total": self.total,
+            "done": self.connected + self.unauthorized + self.failed,
+            "connected": self.connected,
+            "unauthorized": self.unauthorized,
+            "failed": self.failed,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }